@@ -21,7 +21,7 @@ class ParametersWidget(QtWidgets.QWidget, ui_parameters_widget):
         # Define variables
         self.main_window = main_window
         self.last_params = None
-        self.selected_bands_by_type = {"rp": []}
+        self.selected_bands_by_type = {"rp": [], "sb": []}
         self.rp_band_editor = None
 
         # Define the header (description) of the widget
@@ -68,12 +68,17 @@ class ParametersWidget(QtWidgets.QWidget, ui_parameters_widget):
             widget.setVisible(False)
         self.rpCBox.toggled.connect(self.toggle_relative_power)
         self.rpButton.clicked.connect(lambda: self.open_band_table("rp"))
+        for widget in [self.sbselectedbandsLabel, self.sbLabel, self.sbButton]:
+            widget.setVisible(False)
+        self.sbCBox.toggled.connect(self.toggle_spectral_bands)
+        self.sbButton.clicked.connect(lambda: self.open_band_table("sb"))
 
         # STATISTICS AND NONLINEAR - Element setup
         for widget in [self.ctmrLabel, self.ctmrBox, self.sampenmLabel, self.sampenmBox, self.sampenrLabel, self.sampenrBox,
                        self.maxscaleLabel, self.msampenscaleBox, self.msampenmLabel, self.msampenmBox, self.msampenrLabel,
                        self.msampenrBox, self.mlzcscalesLabel, self.mlzcEdit, self.windowpsdLabel,
-                       self.psdcomboBox, self.overlappsdBox, self.segmentpsdBox, self.segmentpsdLabel, self.overlappsdLabel]:
+                       self.psdcomboBox, self.overlappsdBox, self.segmentpsdBox, self.segmentpsdLabel, self.overlappsdLabel,
+                       self.sampenmethodLabel, self.sampenmethodcomboBox]:
             widget.setVisible(False)
         self.msampenCBox.toggled.connect(self.toggle_msampen)
         self.sampenCBox.toggled.connect(self.toggle_sampen)
@@ -150,6 +155,39 @@ class ParametersWidget(QtWidgets.QWidget, ui_parameters_widget):
     def reset_relative_power(self):
         self.rpCBox.setChecked(False)
 
+    def toggle_spectral_bands(self):
+        """
+            Manages the visibility of the spectral bands (from the broadband PSD) config parameters
+        """
+        visible = self.sbCBox.isChecked()
+        if visible and self.main_window.preproc_config['band_segmentation']:
+            QtWidgets.QMessageBox.warning(
+                self,
+                "Spectral bands",
+                "Band segmentation has been applied during preprocessing, so the spectral metrics are already "
+                "computed for each filtered band.\n\n"
+                "Spectral bands from the broadband PSD are only available without band segmentation."
+            )
+            self.sbCBox.setChecked(False)
+            return
+
+        for widget in [self.sbselectedbandsLabel, self.sbLabel, self.sbButton]:
+            widget.setVisible(visible)
+        if not visible:
+            self.sbLabel.setText("None")
+            self.selected_bands_by_type["sb"] = []
+        else:
+            broadband = {
+                "name": "broadband",
+                "min": self.main_window.preproc_config["broadband_min"],
+                "max": self.main_window.preproc_config["broadband_max"],
+            }
+            self.selected_bands_by_type["sb"] = [broadband]
+            self.sbLabel.setText(f"broadband ({broadband['min']}–{broadband['max']} Hz)")
+
+    def reset_spectral_bands(self):
+        self.sbCBox.setChecked(False)
+
 
     def toggle_ctm(self):
         """
@@ -169,6 +207,7 @@ class ParametersWidget(QtWidgets.QWidget, ui_parameters_widget):
             widget.setVisible(visible)
         self.sampenmBox.setValue(self.defaults["sampm"])
         self.sampenrBox.setValue(self.defaults["sampradius"])
+        self.update_sampen_method()
 
     def toggle_msampen(self):
         """
@@ -181,6 +220,15 @@ class ParametersWidget(QtWidgets.QWidget, ui_parameters_widget):
         self.msampenscaleBox.setValue(self.defaults["multisampmaxscale"])
         self.msampenmBox.setValue(self.defaults["multisampm"])
         self.msampenrBox.setValue(self.defaults["multisampradius"])
+        self.update_sampen_method()
+
+    def update_sampen_method(self):
+        """
+            Shows the sample entropy method selector if SampEn or multiscale SampEn are enabled
+        """
+        visible = self.sampenCBox.isChecked() or self.msampenCBox.isChecked()
+        for widget in [self.sampenmethodLabel, self.sampenmethodcomboBox]:
+            widget.setVisible(visible)
 
     def toggle_mlzc(self):
         """
@@ -266,6 +314,8 @@ class ParametersWidget(QtWidgets.QWidget, ui_parameters_widget):
             "relative_power": True if self.rpCBox.isChecked() else None,
             "selected_rp_bands": self.selected_bands_by_type["rp"] if self.rpCBox.isChecked() else None,
             "absolute_power": True if self.apCBox.isChecked() else None,
+            "spectral_bands": True if self.sbCBox.isChecked() else None,
+            "selected_spectral_bands": self.selected_bands_by_type["sb"] if self.sbCBox.isChecked() else None,
             "median_frequency": True if self.mfCBox.isChecked() else None,
             "spectral_entropy": True if self.seCBox.isChecked() else None,
             "ctm": True if self.ctmCBox.isChecked() else None,
@@ -277,6 +327,8 @@ class ParametersWidget(QtWidgets.QWidget, ui_parameters_widget):
             "multiscale_sample_entropy_r": self.msampenrBox.value() if self.msampenCBox.isChecked() else None,
             "multiscale_sample_entropy_m": self.msampenmBox.value() if self.msampenCBox.isChecked() else None,
             "multiscale_sample_entropy_scale": self.msampenscaleBox.value() if self.msampenCBox.isChecked() else None,
+            "sample_entropy_method": self.sampenmethodcomboBox.currentText() if self.sampenCBox.isChecked()
+                                                                                or self.msampenCBox.isChecked() else None,
             "lzc": True if self.lzcCBox.isChecked() else None,
             "multiscale_lzc": True if self.mlzcCBox.isChecked() else None,
             "multiscale_lzc_scales": ast.literal_eval(self.mlzcEdit.text()) if self.mlzcCBox.isChecked()
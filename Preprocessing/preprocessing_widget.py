@@ -6,6 +6,7 @@ from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
 from matplotlib.figure import Figure
 from scipy.signal import firwin, freqz
 from bands_table import BandTable
+from recording_probe import probe_recordings, probe_duration
 import numpy as np
 import os
 from conversor_to_rec import conversor_to_rec
@@ -70,6 +71,7 @@ class PreprocessingWidget(QtWidgets.QWidget, ui_preprocessing_widget):
 
         # Data loading
         self.selected_files = []  # Store the selected files
+        self.file_probes = {}  # Metadata of the selected files (see recording_probe)
         self.convertButton.setStyleSheet("""
             QPushButton {
                 color: white;
@@ -281,18 +283,29 @@ class PreprocessingWidget(QtWidgets.QWidget, ui_preprocessing_widget):
         self.main_window.segmentation_widget.reset_segmentation_state()
 
         if count > 0:
+            # Metadata of the files (header-only probes, in parallel). Only the new files are probed
+            new_files = [f for f in self.selected_files if f not in self.file_probes]
+            for file, probe in zip(new_files, probe_recordings(new_files)):
+                self.file_probes[file] = probe
+            probes = [self.file_probes[f] for f in self.selected_files]
+            if isinstance(probes[0], Exception):
+                QtWidgets.QMessageBox.critical(
+                    self, "Invalid File", f"{self.selected_files[0]} cannot be read:\n{str(probes[0])}"
+                )
+                return
+            self.check_selected_files(probes, new_files)
+            duration = sum(probe_duration(p) for p in probes)
+            self.selectLabel.setText(f"{count} selected files ({duration / 60:.1f} min)")
+
             self.main_window.nextButton.setDisabled(False)
-            recording = components.Recording.load(self.selected_files[0])
-            self.biosignals = recording.biosignals
-            for key, value in recording.biosignals.items():
-                if value['class_name'] not in ['EEG', 'EMG', 'ECG']:
+            self.biosignals = {}
+            for key, info in probes[0]['biosignals'].items():
+                self.biosignals[key] = {'module_name': info['module_name'], 'class_name': info['class_name']}
+                if info['class_name'] not in ['EEG', 'EMG', 'ECG']:
                     continue
-                self.biosignals[key]['fs'] = getattr(recording, key).fs
-                try:
-                    self.biosignals[key]['num_chann'] = len(getattr(recording, key).channel_set.l_cha)
-                except:
-                    self.biosignals[key]['num_chann'] = getattr(recording, key).channel_set['n_cha']
-                self.biosignalBox.addItem(f"Name: {key} - Type: {value['class_name']}")
+                self.biosignals[key]['fs'] = info['fs']
+                self.biosignals[key]['num_chann'] = info['n_cha']
+                self.biosignalBox.addItem(f"Name: {key} - Type: {info['class_name']}")
             self.biosignalBox.setCurrentIndex(0)
             # default_biosignal = next(iter(recording.biosignals))
             # self.main_window.sampling_frequency = getattr(recording, default_biosignal).fs
@@ -316,6 +329,29 @@ class PreprocessingWidget(QtWidgets.QWidget, ui_preprocessing_widget):
             [elm.setDisabled(True) for elm in self.element_group]
             self.biosignalBox.clear()
 
+    def check_selected_files(self, probes, new_files):
+        """
+            Warns about the new files that cannot be read or that have other sampling frequencies than the first
+            selected file, since they cannot be processed with the same settings
+        """
+        first = probes[0]['biosignals']
+        problems = []
+        for file, probe in zip(self.selected_files, probes):
+            if file not in new_files:
+                continue
+            if isinstance(probe, Exception):
+                problems.append(f"{os.path.basename(file)}: cannot be read ({probe})")
+                continue
+            for key, info in probe['biosignals'].items():
+                if key in first and info['fs'] != first[key]['fs']:
+                    problems.append(f"{os.path.basename(file)}: {key} sampled at {info['fs']} Hz "
+                                    f"(instead of {first[key]['fs']} Hz)")
+        if problems:
+            QtWidgets.QMessageBox.warning(
+                self, "Incompatible Files",
+                "These files cannot be processed with the first selected file:\n" + "\n".join(problems)
+            )
+
     def open_file_list_dialog(self):
         """
             Function that opens the file list dialog, and stores the updated file list
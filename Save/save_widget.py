@@ -1,14 +1,61 @@
 import os
 import json
+import threading
 from PySide6 import QtWidgets, QtGui, QtCore
 from PySide6.QtUiTools import loadUiType
 from PySide6.QtGui import QTextCursor
-from PySide6.QtWidgets import QApplication
 from core_process import run_pipeline
+from result_cache import ResultCache
+from run_journal import has_journal
+from output_store import OUTPUT_FORMATS
+from recording_loader import clear_sidecars, DEFAULT_SIDECAR_DIR
 
 # Load UI class
 ui_save_widget = loadUiType("Save/save_widget.ui")[0]
 
+
+class PipelineWorker(QtCore.QObject):
+    """
+        Runs the pipeline in a background thread. Logs and progress are sent to the GUI thread through (queued)
+        signals, so the window stays responsive during long computations.
+    """
+    log_signal = QtCore.Signal(str, object)
+    progress_signal = QtCore.Signal(int, str)
+    finished_signal = QtCore.Signal(bool)
+
+    def __init__(self, settings_dic, output_folder, outputs, cache=None, resume=False, output_format='mat',
+                 n_workers=1, sidecar_dir=None):
+        super().__init__()
+        self.settings_dic = settings_dic
+        self.output_folder = output_folder
+        self.outputs = outputs
+        self.cache = cache
+        self.resume = resume
+        self.output_format = output_format
+        self.n_workers = n_workers
+        self.sidecar_dir = sidecar_dir
+        self.cancel_event = threading.Event()
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    @QtCore.Slot()
+    def run(self):
+        success = False
+        try:
+            success = run_pipeline(self.settings_dic, self.output_folder,
+                                   log_callback=lambda msg, style=None: self.log_signal.emit(msg, style),
+                                   progress_callback=self.progress_signal.emit,
+                                   output_callback=lambda key: self.outputs[key],
+                                   cancel_callback=self.cancel_event.is_set,
+                                   n_workers=self.n_workers, cache=self.cache, resume=self.resume,
+                                   output_format=self.output_format, sidecar_dir=self.sidecar_dir)
+        except Exception as e:
+            self.log_signal.emit(f"[ERROR] run_pipeline: {str(e)}", 'error')
+        finally:
+            self.finished_signal.emit(success)
+
+
 class SaveWidget(QtWidgets.QWidget, ui_save_widget):
     """
         Main windget element. Manages the saving options. It also manages the functions to preprocess, segment and
@@ -40,7 +87,7 @@ class SaveWidget(QtWidgets.QWidget, ui_save_widget):
             <div style="font-size: 11pt; font-family: Arial; line-height: 1;">
                 <p>
                     Please select an <b>empty folder</b> where processed data will be saved. This step allows you to export 
-                    results from each stage of the workflow.
+                    results from each stage of the workflow. Select the folder of an interrupted run to resume it.
             </div>
         """)
         # Remove background
@@ -54,12 +101,30 @@ class SaveWidget(QtWidgets.QWidget, ui_save_widget):
         # --- ELEMENT SETUP ---
         self.selectfolderButton.clicked.connect(self.select_folder)
         self.runButton.clicked.connect(self.run_tasks)
+        self.cancelButton.clicked.connect(self.cancel_tasks)
+        self.clearcacheButton.clicked.connect(self.clear_cache)
+        self.clearsidecarsButton.clicked.connect(self.clear_sidecars)
         # States
         self.progressLabel.hide()
         self.progressBar.hide()
         self.selected_folder = None
+        self.resume = False
+        self.pipeline_thread = None
+        self.pipeline_worker = None
+        # The application was closed during a run: it is closed when the run stops
+        self.close_requested = False
+        self.result_cache = ResultCache()
         for w in [self.settingsCBox, self.prepsignalsCBox, self.segsignalsCBox, self.paramsignalsCBox]:
             w.setChecked(True)
+        # The feature table is opt-in: it repeats all the parameters in one large table
+        self.featuresCBox.setChecked(False)
+        # The result cache is opt-in: it can grow up to ResultCache.max_bytes in the user folder
+        self.cacheCBox.setChecked(False)
+        # The sidecars are opt-in too: they take as much disk as the recordings
+        self.sidecarsCBox.setChecked(False)
+        # One worker by default, as in the command line: each worker keeps a whole recording in memory
+        self.workersSpinBox.setMaximum(os.cpu_count() or 1)
+        self.workersSpinBox.setValue(1)
 
     def handle_exception(func):
         """
@@ -98,20 +163,37 @@ class SaveWidget(QtWidgets.QWidget, ui_save_widget):
 
     def select_folder(self, *args, **kwargs):
         """
-            Manages the selection of an empty folder to save the results. It includes all the associated error check
+            Manages the selection of an empty folder to save the results. It includes all the associated error check.
+            The folder of a previous run (with a run journal) can be selected to resume it
         """
 
         while True:
             folder = QtWidgets.QFileDialog.getExistingDirectory(self, "Select Folder")
             if not folder:
                 return  # User cancelled
-            if os.listdir(folder):
+            if os.listdir(folder) and has_journal(folder):
+                if self.ask_resume():
+                    self.resume = True
+                    self.selected_folder = folder
+                    self.selectfolderLabel.setText(f"{folder} (resume)")
+                    break
+            elif os.listdir(folder):
                 QtWidgets.QMessageBox.warning(self, "Error", "The selected folder is not empty. Please select an empty folder.")
             else:
+                self.resume = False
                 self.selected_folder = folder
                 self.selectfolderLabel.setText(folder)
                 break
 
+    def ask_resume(self):
+        """
+            Asks whether the previous run stored in the selected folder must be resumed
+        """
+        answer = QtWidgets.QMessageBox.question(
+            self, "Resume run", "The selected folder contains the results of a previous run. Do you want to "
+                                "resume it? The results already stored will not be computed again.")
+        return answer == QtWidgets.QMessageBox.Yes
+
     @handle_exception
     def run_tasks(self, *args, **kwargs):
         """
@@ -120,6 +202,14 @@ class SaveWidget(QtWidgets.QWidget, ui_save_widget):
         if not self.selected_folder:
             QtWidgets.QMessageBox.warning(self, "Error", "Please, select one folder to save the data.")
             return
+        # The folder may have been filled since it was selected (e.g., by the previous run), so it is checked again
+        if not self.resume and os.listdir(self.selected_folder):
+            if not (has_journal(self.selected_folder) and self.ask_resume()):
+                QtWidgets.QMessageBox.warning(self, "Error",
+                                              "The selected folder is not empty. Please select an empty folder.")
+                return
+            self.resume = True
+            self.selectfolderLabel.setText(f"{self.selected_folder} (resume)")
 
         # Visibility of progress bars
         self.progressLabel.show()
@@ -127,15 +217,6 @@ class SaveWidget(QtWidgets.QWidget, ui_save_widget):
         self.progressBar.setValue(0)
         self.error_occurred = False
 
-        # Get the total number of tasks to perform
-        total_tasks = sum([
-            self.settingsCBox.isChecked(),
-            self.prepsignalsCBox.isChecked(),
-            self.segsignalsCBox.isChecked(),
-            self.paramsignalsCBox.isChecked()
-        ])
-        total_tasks = max(total_tasks, 1)  # To avoid division by 0
-
         # Get configuration data
         try:
             preprocessing = self.main_window.preproc_widget.get_preprocessing_config()
@@ -154,10 +235,104 @@ class SaveWidget(QtWidgets.QWidget, ui_save_widget):
         if self.settingsCBox.isChecked():
             self.prepare_data(preprocessing, segmentation, parameters)
 
-        # Run the pipeline
-        success = run_pipeline(self, self.settings_dic, total_tasks)
+        # Run the pipeline in a background thread
+        outputs = {'prep': self.prepsignalsCBox.isChecked(), 'seg': self.segsignalsCBox.isChecked(),
+                   'param': self.paramsignalsCBox.isChecked(), 'features': self.featuresCBox.isChecked()}
+        self.pipeline_thread = QtCore.QThread(self)
+        cache = self.result_cache if self.cacheCBox.isChecked() else None
+        output_format = OUTPUT_FORMATS[self.formatComboBox.currentIndex()]
+        sidecar_dir = DEFAULT_SIDECAR_DIR if self.sidecarsCBox.isChecked() else None
+        self.pipeline_worker = PipelineWorker(self.settings_dic, self.selected_folder, outputs, cache, self.resume,
+                                              output_format, self.workersSpinBox.value(), sidecar_dir)
+        self.pipeline_worker.moveToThread(self.pipeline_thread)
+        self.pipeline_thread.started.connect(self.pipeline_worker.run)
+        self.pipeline_worker.log_signal.connect(self.log_message)
+        self.pipeline_worker.progress_signal.connect(self.update_progress)
+        self.pipeline_worker.finished_signal.connect(self.on_pipeline_finished)
+        self.pipeline_worker.finished_signal.connect(self.pipeline_thread.quit)
+        # The references are kept until the thread has finished (see on_thread_finished)
+        self.pipeline_thread.finished.connect(self.on_thread_finished)
+        self.pipeline_thread.finished.connect(self.pipeline_worker.deleteLater)
+        self.pipeline_thread.finished.connect(self.pipeline_thread.deleteLater)
+        self.runButton.setEnabled(False)
+        self.cancelButton.setEnabled(True)
+        self.clearcacheButton.setEnabled(False)
+        self.clearsidecarsButton.setEnabled(False)
+        self.pipeline_thread.start()
+
+    def cancel_tasks(self):
+        """
+            Asks the running pipeline to stop after the current file/band
+        """
+        if self.pipeline_worker is not None:
+            self.pipeline_worker.cancel()
+            self.cancelButton.setEnabled(False)
+            self.log_message("Cancelling... the run will stop after the current file/band", style='warning')
+
+    @handle_exception
+    def clear_cache(self, *args, **kwargs):
+        """
+            Removes all the results stored in the result cache
+        """
+        self.result_cache.clear()
+        self.log_message(f"Result cache cleared: {self.result_cache.folder}")
+
+    @handle_exception
+    def clear_sidecars(self, *args, **kwargs):
+        """
+            Removes the sidecars of the recordings (see recording_loader)
+        """
+        clear_sidecars(DEFAULT_SIDECAR_DIR)
+        self.log_message(f"Recording sidecars cleared: {DEFAULT_SIDECAR_DIR}")
+
+    def on_pipeline_finished(self, success):
+        """
+            Notifies the main window once the pipeline is finished. The thread is still running until it processes the
+            quit request, so a new run is enabled in on_thread_finished
+        """
+        self.cancelButton.setEnabled(False)
         self.main_window.validate_save_step(success)
 
+    def on_thread_finished(self):
+        """
+            Releases the worker and the thread once the thread has finished (they are deleted later by Qt) and restores
+            the state of the widget
+        """
+        self.pipeline_thread = None
+        self.pipeline_worker = None
+        # A new run in the same folder asks again whether to resume it (see run_tasks)
+        self.resume = False
+        self.selectfolderLabel.setText(self.selected_folder)
+        self.runButton.setEnabled(True)
+        self.clearcacheButton.setEnabled(True)
+        self.clearsidecarsButton.setEnabled(True)
+        if self.close_requested:
+            self.main_window.close()
+
+    def stop_pipeline(self):
+        """
+            Cancels the running pipeline before closing the application, without blocking the window: the main window
+            is closed again when the thread has finished (see on_thread_finished). Returns True if the pipeline is
+            still running
+        """
+        if self.pipeline_thread is None:
+            return False
+        if not self.close_requested:
+            self.close_requested = True
+            if self.pipeline_worker is not None:
+                self.pipeline_worker.cancel()
+            self.cancelButton.setEnabled(False)
+            self.log_message("Closing... the application will close when the current file/band is finished",
+                             style='warning')
+        return True
+
+    def update_progress(self, progress, file):
+        """
+            Updates the progress bar and label with the state of the pipeline
+        """
+        self.progressLabel.setText(f"Processing: {os.path.basename(file)}")
+        self.progressBar.setValue(progress)
+
     def log_message(self, msg, style=None):
         """
             Manages the format of the error and warning messages
@@ -183,4 +358,3 @@ class SaveWidget(QtWidgets.QWidget, ui_save_widget):
         formatted = f'<p style="margin:0;margin-top:2;{style_str}"> >> {msg} </p>'
         self.logtextBrowser.append(formatted)
         self.logtextBrowser.moveCursor(QTextCursor.End)
-        QApplication.processEvents()
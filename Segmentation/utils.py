@@ -2,6 +2,7 @@ import numpy as np
 from medusa import components
 import medusa.bci.erp_spellers
 import medusa.ecg
+from recording_loader import load_recording
 
 def find_valid_conditions(vector):
     """
@@ -137,7 +138,7 @@ def extract_condition_events(files):
     events = []
     events_condition = []
     for file in files:
-        rec = components.Recording.load(file)
+        rec = load_recording(file)
 
         if not hasattr(rec, "marks"):
             # Empty marks
@@ -0,0 +1,178 @@
+"""
+    Connectivity utilities of the processing engine. The analytic signal (Hilbert transform) of a set of epochs is
+    computed once and shared by all the connectivity metrics (IAC, AEC, PLV, PLI and wPLI). The orthogonalized
+    versions of IAC and AEC are also derived from it: the Hilbert transform is linear, so the analytic signal of
+    x_j orthogonalized regarding x_i is A_j - beta * A_i. The results match the medusa connectivity metrics.
+"""
+import numpy as np
+from scipy.signal import hilbert
+
+
+class ConnectivityEngine:
+    """
+        Connectivity metrics of one set of epochs [n_epochs x n_samples x n_channels]. The analytic signal and the
+        phases are computed the first time they are needed. It must be created for each set of epochs (e.g., in each
+        call to compute_parameters)
+    """
+
+    def __init__(self, epoched):
+        epoched = np.asarray(epoched, dtype=float)
+        if epoched.ndim == 1:
+            epoched = epoched[:, None]
+        self.epoched = epoched[None] if epoched.ndim == 2 else epoched
+        self.n_samples = self.epoched.shape[1]
+        self.n_channels = self.epoched.shape[2]
+        self._analytic = None
+        self._phase = None
+        self._phase_lag = None
+
+    @property
+    def analytic(self):
+        """
+            Analytic signal of the epochs [n_epochs x n_samples x n_channels]
+        """
+        if self._analytic is None:
+            self._analytic = hilbert(self.epoched, axis=1)
+        return self._analytic
+
+    @property
+    def phase(self):
+        """
+            Instantaneous phase of the epochs [n_epochs x n_samples x n_channels]
+        """
+        if self._phase is None:
+            self._phase = np.angle(self.analytic)
+        return self._phase
+
+    def zscored(self):
+        """
+            Epochs z-scored along the samples axis
+        """
+        return (self.epoched - np.mean(self.epoched, axis=1, keepdims=True)) / np.std(self.epoched, axis=1,
+                                                                                       keepdims=True)
+
+    def zscored_analytic(self):
+        """
+            Analytic signal of the z-scored epochs. Since the Hilbert transform of a constant is the constant itself,
+            it is obtained from the analytic signal of the original epochs
+        """
+        mean = np.mean(self.epoched, axis=1, keepdims=True)
+        std = np.std(self.epoched, axis=1, keepdims=True)
+        return (self.analytic - mean) / std
+
+    def orthogonalized(self, analytic, beta, i):
+        """
+            Analytic signal of all the channels orthogonalized regarding channel i [n_epochs x n_samples x
+            n_channels]. The channel i itself is not orthogonalized (as in medusa.signal_orthogonalization)
+        """
+        ort = analytic - beta[:, None, :, i] * analytic[:, :, i:i + 1]
+        ort[:, :, i] = analytic[:, :, i]
+        return ort
+
+    def aec(self, ort=True):
+        """
+            Amplitude envelope correlation [n_epochs x n_channels x n_channels]
+        """
+        envelope = np.log(np.abs(self.analytic) ** 2)
+        if not ort:
+            return correlation(envelope, envelope)
+
+        # aec_half[:, j, i] = corr(envelope of x_j orthogonalized regarding x_i, envelope of x_i)
+        beta = orthogonalization_coefficients(self.epoched)
+        aec_half = np.empty((self.epoched.shape[0], self.n_channels, self.n_channels))
+        for i in range(self.n_channels):
+            with np.errstate(divide='ignore'):
+                envelope_ort = np.log(np.abs(self.orthogonalized(self.analytic, beta, i)) ** 2)
+            aec_half[:, :, i] = correlation(envelope_ort, envelope[:, :, i:i + 1])[:, :, 0]
+        return symmetrize(aec_half, diagonal=None)
+
+    def iac(self, ort=True):
+        """
+            Instantaneous amplitude correlation [n_epochs x n_channels x n_channels x n_samples]
+        """
+        envelope_analytic = self.zscored_analytic()
+        envelope = np.abs(envelope_analytic)
+        n_epochs = self.epoched.shape[0]
+        if not ort:
+            iac = np.einsum('esi,esj->eijs', envelope, envelope)
+            iac[:, np.arange(self.n_channels), np.arange(self.n_channels), :] = 0
+            return iac
+
+        # iac_half[:, j, i, :] = envelope of x_j orthogonalized regarding x_i * envelope of x_i. As in medusa, the
+        # z-scored signals are orthogonalized
+        beta = orthogonalization_coefficients(self.zscored())
+        iac_half = np.empty((n_epochs, self.n_channels, self.n_channels, self.n_samples))
+        for i in range(self.n_channels):
+            envelope_ort = np.abs(self.orthogonalized(envelope_analytic, beta, i))
+            iac_half[:, :, i, :] = np.moveaxis(envelope_ort * envelope[:, :, i:i + 1], 1, 2)
+        return symmetrize(iac_half, diagonal=0)
+
+    def plv(self):
+        """
+            Phase locking value [n_epochs x n_channels x n_channels]
+        """
+        phasor = np.exp(1j * self.phase)
+        return np.abs(np.einsum('esi,esj->eij', phasor, np.conj(phasor))) / self.n_samples
+
+    def pli(self):
+        """
+            Phase lag index [n_epochs x n_channels x n_channels]
+        """
+        return self.phase_lag()[0]
+
+    def wpli(self):
+        """
+            Weighted phase lag index [n_epochs x n_channels x n_channels]
+        """
+        return self.phase_lag()[1]
+
+    def phase_lag(self):
+        """
+            Computes PLI and wPLI in the same pass over the phase differences, since both are obtained from
+            sin(phase_i - phase_j)
+        """
+        if self._phase_lag is None:
+            shape = (self.epoched.shape[0], self.n_channels, self.n_channels)
+            pli, wpli = np.empty(shape), np.empty(shape)
+            for i in range(self.n_channels):
+                imz = np.sin(self.phase[:, :, i:i + 1] - self.phase)
+                pli[:, i, :] = np.abs(np.mean(np.sign(imz), axis=1))
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    wpli[:, i, :] = np.abs(np.mean(imz, axis=1)) / np.mean(np.abs(imz), axis=1)
+            self._phase_lag = (pli, np.nan_to_num(wpli))
+        return self._phase_lag
+
+
+def orthogonalization_coefficients(epoched):
+    """
+        Orthogonalization coefficients of the epochs [n_epochs x n_samples x n_channels]. beta[:, j, i] is the
+        projection coefficient of channel j onto channel i (<x_j, x_i> / <x_i, x_i>) [n_epochs x n_channels x
+        n_channels]
+    """
+    inner = np.einsum('esj,esi->eji', epoched, epoched)
+    return inner / np.diagonal(inner, axis1=1, axis2=2)[:, None, :]
+
+
+def correlation(x, y):
+    """
+        Pearson correlation between the channels of x [n_epochs x n_samples x n_x] and y [n_epochs x n_samples x n_y]
+        of each epoch [n_epochs x n_x x n_y]
+    """
+    x = x - np.mean(x, axis=1, keepdims=True)
+    y = y - np.mean(y, axis=1, keepdims=True)
+    cov = np.einsum('esi,esj->eij', x, y)
+    norm = np.sqrt(np.sum(x ** 2, axis=1))[:, :, None] * np.sqrt(np.sum(y ** 2, axis=1))[:, None, :]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return cov / norm
+
+
+def symmetrize(half, diagonal=None):
+    """
+        Builds the symmetric connectivity matrix (axes 1 and 2) of an orthogonalized metric. Orthogonalizing x_i
+        regarding x_j is not the same as orthogonalizing x_j regarding x_i, so both values are averaged. If diagonal
+        is None, the diagonal of half is kept
+    """
+    symmetric = np.abs(half + np.swapaxes(half, 1, 2)) / 2
+    idx = np.arange(half.shape[1])
+    symmetric[:, idx, idx] = np.abs(half[:, idx, idx]) if diagonal is None else diagonal
+    return symmetric
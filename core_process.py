@@ -1,91 +1,875 @@
-from PySide6 import QtCore, QtGui, QtWidgets
-def run_pipeline(self, settings_dic, total_tasks):
+"""
+    Processing engine of MEDUSA Analyzer. It runs the preprocessing, segmentation and parameters computation defined in
+    a settings dictionary (the same one that SaveWidget stores in "settings.json"). It does not depend on Qt, so it
+    can be used from the GUI or from the command line:
+
+        python core_process.py path/to/settings.json path/to/output_folder
+"""
+import sys
+import json
+import argparse
+from glob import glob
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from os.path import basename, join, splitext
+from os import cpu_count
+from multiprocessing import get_context
+import numpy as np
+from scipy.stats import kurtosis, skew
+import medusa
+import medusa.artifact_removal
+import medusa.transforms
+from medusa.signal_metrics import band_power, median_frequency, shannon_spectral_entropy, central_tendency
+from filtering import fir_filter, filter_bank
+from spectral_engine import SpectralCache, band_metrics
+from connectivity_engine import ConnectivityEngine
+from nonlinear_engine import EntropyCache, ComplexityCache
+from marks_index import MarksIndex
+from epoch_views import EpochSegments, get_segments_epochs, materialize
+from result_cache import ResultCache, DEFAULT_CACHE_DIR, DEFAULT_MAX_BYTES
+from run_journal import RunJournal
+from output_store import open_output_store, AsyncOutputWriter, OUTPUT_FORMATS, HDF5_STORE_NAME, \
+    DEFAULT_WRITE_BUFFER_BYTES
+from feature_table import FeatureTable
+from recording_loader import load_recording, RecordingPrefetcher, DEFAULT_PREFETCH_DEPTH, DEFAULT_PREFETCH_BYTES, \
+    DEFAULT_SIDECAR_DIR, clear_sidecars
+from recording_probe import probe_recordings
+
+# Outputs that can be stored: preprocessed signals, segmented signals, parameters and cohort feature table
+OUTPUT_KEYS = ('prep', 'seg', 'param', 'features')
+# Interval (seconds) between checks of the cancellation while the files are processed by worker processes
+CANCEL_POLL_SECONDS = 0.5
+
+
+def print_log(msg, style=None):
+    """
+        Default logging callback. Prints the messages in the console
+    """
+    prefix = '[ERROR] ' if style == 'error' else '[WARNING] ' if style == 'warning' else ''
+    print(f"{prefix}{msg}", flush=True)
+
+
+def apply_preprocessing(signal, fs, cfg):
+    """
+        Filtering and CAR
+    """
+    if cfg.get('bandpass') and None not in (cfg.get('bp_min'), cfg.get('bp_max'), cfg.get('bp_order')):
+        signal = fir_filter(signal, fs, cfg['bp_order'], [cfg['bp_min'], cfg['bp_max']], 'bandpass',
+                            window=cfg['bp_win'])
+    if cfg.get('notch') and None not in (cfg.get('notch_min'), cfg.get('notch_max'), cfg.get('notch_order')):
+        signal = fir_filter(signal, fs, cfg['notch_order'], [cfg['notch_min'], cfg['notch_max']], 'bandstop',
+                            window=cfg['notch_win'])
+    return medusa.car(signal) if cfg.get('car') else signal
+
+
+def band_signals(signal, fs, bands, cfg):
+    """
+        Yields the preprocessed signal of each band. With band segmentation, the band-pass filters of all the bands
+        are applied from one shared FFT of the recording (see filtering.filter_bank) and the rest of the preprocessing
+        (notch and CAR) is applied afterwards, in the same order as apply_preprocessing. Band signals are computed
+        lazily, so only one of them is kept in memory
+    """
+    apply_prep = cfg.get('apply_preprocessing')
+    if not cfg.get('band_segmentation', False):
+        yield apply_preprocessing(signal, fs, cfg) if apply_prep else signal
+        return
+
+    cutoffs = []
+    for band in bands:
+        bp_min, bp_max = band.get('min'), band.get('max')
+        if bp_max == cfg['fs'] / 2:
+            bp_max -= 1e-6
+        cutoffs.append([bp_min, bp_max])
+
+    if apply_prep:
+        if not cfg.get('bandpass') or cfg.get('bp_order') is None:
+            # Without bandpass filter, the preprocessing is the same for all the bands
+            processed_signal = apply_preprocessing(signal, fs, cfg)
+            for _ in bands:
+                yield processed_signal
+            return
+        order, win = cfg['bp_order'], cfg['bp_win']
+        post_cfg = {**cfg, 'bandpass': False}
+    else:  # If no preprocessing, apply only the band segmentation
+        order = 1000 if cfg.get('bandpass') is False else cfg.get('bp_order')
+        win = 'hamming' if cfg.get('bandpass') is False else cfg.get('bp_win')
+        post_cfg = None
+
+    for band_signal in filter_bank(signal, fs, cutoffs, order, win):
+        yield apply_preprocessing(band_signal, fs, post_cfg) if post_cfg is not None else band_signal
+
+
+def filter_margin(cfg):
     """
-        This function runs all the tasks after the data preparation in "run_tasks".
+        Number of samples at each side of an interval that the preprocessing and band segmentation filters need, so
+        the filtered interval matches the filtering of the whole signal. A zero-phase FIR filter of order taps depends
+        on the order - 1 samples at each side, and the margins of cascaded filters add up. Returns (margin, max_order)
     """
-    import medusa
-    import medusa.artifact_removal
-    import medusa.transforms
-    from medusa.signal_metrics import band_power, median_frequency, shannon_spectral_entropy, central_tendency
-    from medusa.signal_metrics import sample_entropy, multiscale_entropy, multiscale_lempelziv_complexity, \
-        lempelziv_complexity
-    from medusa.connectivity_metrics import iac, aec, plv, pli, wpli
-    import numpy as np
-    from os.path import basename, join, splitext
-    from os import makedirs
-    from copy import deepcopy
-    from scipy.stats import kurtosis, skew
-    from scipy.io import savemat
+    orders = []
+    apply_prep = cfg.get('apply_preprocessing')
+    if apply_prep and cfg.get('bandpass') and cfg.get('bp_order') is not None:
+        orders.append(cfg['bp_order'])
+    elif cfg.get('band_segmentation', False) and not apply_prep:
+        orders.append(1000 if cfg.get('bandpass') is False else cfg.get('bp_order'))
+    if apply_prep and cfg.get('notch') and cfg.get('notch_order') is not None:
+        orders.append(cfg['notch_order'])
+    orders = [int(o) for o in orders if o]
+    return sum(orders), max(orders, default=0)
+
+
+def segmentation_intervals(data, marks_index, settings, fs):
+    """
+        Sample intervals [start, end) of the recording that the segmentation will use (condition segments, or event
+        epochs and baselines). Returns None if the whole signal is needed (e.g., 'no-condition' in segmentation by
+        condition)
+    """
+    seg = settings['segmentation']
+    intervals = []
+    if seg['segmentation_type'] == 'condition':
+        for cond in seg['selected_conditions']:
+            if cond == 'no-condition':
+                return None
+            cond_key = data.marks.app_settings['conditions'][cond]['label']
+            intervals += marks_index.condition_samples(cond_key) or []
+    elif seg['segmentation_type'] == 'event':
+        # Epoch and baseline windows (ms) relative to each onset, with one extra sample for the rounding
+        windows = [[seg['window_start'], seg['window_end']]]
+        if seg['norm']:
+            windows.append([seg['baseline_start'], seg['baseline_end']])
+        before = int(np.ceil(max(-min(w[0] for w in windows), 0) * fs / 1000)) + 1
+        after = int(np.ceil(max(max(w[1] for w in windows), 0) * fs / 1000)) + 1
+        for cond in seg['selected_conditions']:
+            for evt in seg['selected_events']:
+                evt_key = data.marks.app_settings['events'][evt]['label']
+                if cond == 'no-condition':
+                    onsets = marks_index.event_times(evt_key)
+                else:
+                    cond_key = data.marks.app_settings['conditions'][cond]['label']
+                    onsets = [t for start_idx, end_idx in marks_index.condition_samples(cond_key) or []
+                              for t in marks_index.event_times(evt_key, data.eeg.times[start_idx],
+                                                               data.eeg.times[end_idx])]
+                for onset in onsets:
+                    idx = marks_index.nearest_index(onset)
+                    intervals.append((idx - before, idx + after))
+    else:
+        return None
+    return intervals
+
+
+def crop_intervals(intervals, n_samples, margin, min_length):
+    """
+        Adds the filter margin to the intervals, makes them at least min_length samples long (the filters need more
+        samples than their padding) and merges the overlapping ones. Returns a sorted list of [start, end)
+    """
+    expanded = []
+    for start, end in intervals:
+        start, end = start - margin, end + margin
+        if end - start < min_length:
+            extra = (min_length - (end - start) + 1) // 2
+            start, end = start - extra, end + extra
+        expanded.append((max(int(start), 0), min(int(end), n_samples)))
+    merged = []
+    for start, end in sorted(expanded):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def cropped_band_signals(signal, fs, bands, cfg, crops):
+    """
+        Same as band_signals, but only the crops ([start, end) intervals) of the signal are filtered. The samples
+        outside the crops are NaN
+    """
+    generators = [band_signals(signal[start:end], fs, bands, cfg) for start, end in crops]
+    for _ in bands:
+        band_signal = np.full(signal.shape, np.nan)
+        for (start, end), generator in zip(crops, generators):
+            band_signal[start:end] = next(generator)
+        yield band_signal
+
+
+def band_limit(cfg, band):
+    """
+        Upper frequency (Hz) and order of the band-pass filter applied to the band, or None if the band signal is not
+        band-pass filtered (see band_signals)
+    """
+    apply_prep = cfg.get('apply_preprocessing')
+    if cfg.get('band_segmentation', False):
+        if apply_prep and (not cfg.get('bandpass') or cfg.get('bp_order') is None):
+            return None
+        order = cfg['bp_order'] if apply_prep or cfg.get('bandpass') is not False else 1000
+        return band.get('max'), order
+    if apply_prep and cfg.get('bandpass') and None not in (cfg.get('bp_max'), cfg.get('bp_order')):
+        return cfg['bp_max'], cfg['bp_order']
+    return None
+
+
+def decimation_factor(fs, cfg, band):
+    """
+        Decimation factor of the band signal in multirate mode ("multirate" preprocessing option). The band-pass
+        filter acts as the anti-aliasing filter, so the new Nyquist frequency must be above the upper edge of the band
+        plus the transition width of the filter (about 4 * fs / order), and the new rate must be at least
+        "multirate_oversampling" (default 4) times the upper edge. The factor divides fs when possible, so the new
+        rate is an integer. Returns 1 if the band is not decimated
+    """
+    limit = band_limit(cfg, band) if cfg.get('multirate', False) else None
+    if limit is None or not limit[0] or not limit[1]:
+        return 1
+    max_freq, order = limit
+    transition = 4 * fs / int(order)
+    min_fs = max(cfg.get('multirate_oversampling', 4) * max_freq, 2 * (max_freq + transition))
+    factor = max(int(fs // min_fs), 1)
+    if float(fs).is_integer():
+        while factor > 1 and int(fs) % factor:
+            factor -= 1
+    return factor
+
+
+def signal_statistics(signal, chunk_samples=None):
+    """
+        Reference statistics of the signal [n_samples x n_channels] for the thresholding of noisy epochs: the mean
+        (ignoring NaNs) and the standard deviation of each channel. If chunk_samples is given, they are computed in a
+        single streaming pass over chunks of that length (e.g., for memory-mapped signals), merging the partial
+        results with Chan's parallel algorithm
+    """
+    if not chunk_samples:
+        return np.nanmean(signal, axis=0), np.std(signal, axis=0)
+
+    n_channels = signal.shape[1]
+    valid_count, valid_sum = np.zeros(n_channels), np.zeros(n_channels)
+    count, mean, m2 = 0, np.zeros(n_channels), np.zeros(n_channels)
+    for start in range(0, signal.shape[0], int(chunk_samples)):
+        chunk = np.asarray(signal[start:start + int(chunk_samples)], dtype=float)
+        valid = ~np.isnan(chunk)
+        valid_count += valid.sum(axis=0)
+        valid_sum += np.where(valid, chunk, 0).sum(axis=0)
+        # As in np.std, NaNs propagate to the standard deviation
+        chunk_count = chunk.shape[0]
+        chunk_mean = chunk.mean(axis=0)
+        delta = chunk_mean - mean
+        total = count + chunk_count
+        m2 += ((chunk - chunk_mean) ** 2).sum(axis=0) + delta ** 2 * count * chunk_count / total
+        mean += delta * chunk_count / total
+        count = total
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return valid_sum / valid_count, np.sqrt(m2 / count)
+
+
+# Basic statistics
+STAT_FUNCS = {
+    'mean': np.mean,
+    'variance': np.var,
+    'median': np.median,
+    'kurtosis': kurtosis,
+    'skewness': skew
+}
+
+
+def segments_parameters(segments, settings, fs, band, executor=None):
+    """
+        compute_parameters of the epochs of an epoch_views.EpochSegments. The parameters of each segment are computed
+        per epoch and concatenated, so the epochs are not gathered in a single array. Then, they are averaged as
+        compute_parameters does. Same values as compute_parameters of the concatenated epochs
+    """
+    per_epoch = {**settings, 'segmentation': {**settings['segmentation'], 'average': False}}
+    reference = segments.first_epoch()
+    parts = [compute_parameters(segment, per_epoch, fs, band, executor, reference=reference if idx else None)
+             for idx, segment in enumerate(segments)]
+    avg = settings['segmentation']['average']
+    # Outputs that compute_parameters does not average: the broadband PSD of the relative power replaces the PSD
+    unaveraged = ('norm_psd_broadband', 'psd_broadband') if (settings['parameters'].get('relative_power', False)
+                                                             and band in (None, 'broadband')) else ()
+    params = {}
+    for key, val in parts[0].items():
+        if key.startswith('psd_freq_'):
+            # Frequencies of the PSD, the same for all the segments
+            params[key] = val
+            continue
+        val = np.concatenate([part[key] for part in parts], axis=0)
+        if avg and key not in unaveraged:
+            val = np.mean(val, axis=0) if key in STAT_FUNCS else np.nanmean(val, axis=0)
+        params[key] = val
+    return params
+
+
+def compute_parameters(epoched, settings, fs, band, executor=None, reference=None):
+    """
+        Manages the computation of all the parameters. executor is the process pool of the run used by the metrics
+        that can be parallelized (Lempel-Ziv complexity), or None to compute them in this process. epoched can also be
+        an epoch_views.EpochSegments (see segments_parameters). reference is the first epoch of the whole set of epochs
+        when epoched is a part of it (see nonlinear_engine.EntropyCache)
+    """
+    if isinstance(epoched, EpochSegments):
+        return segments_parameters(epoched, settings, fs, band, executor)
+    params = {}
+
+    # Basic statistics
+    axis = 0 if epoched.ndim == 2 else 1
+    avg = settings['segmentation']['average']
+    for name, func in STAT_FUNCS.items():
+        if settings['parameters'].get(name, False):
+            val = func(epoched, axis=axis)
+            params[name] = np.mean(val, axis=0) if avg and epoched.ndim == 3 else val
+
+    # --- PSD de la banda actual (para abs_power, median_freq, entropy, etc.) ---
+    psd_enabled = settings['parameters'].get('psd', False)
+    needs_psd = any([
+        settings['parameters'].get(k, False)
+        for k in ['absolute_power', 'median_frequency', 'spectral_entropy']
+    ])
+    should_compute_psd = psd_enabled or needs_psd
+    # The PSD of these epochs is computed once per configuration and shared by all the spectral parameters
+    spectral_cache = SpectralCache(epoched, fs)
+    psd_config = (
+        settings['parameters']['psd_segment_pct'],
+        settings['parameters']['psd_overlap_pct'],
+        settings['parameters']['psd_window']
+    ) if psd_enabled else ()
+    if should_compute_psd:
+        fxx_band, psd_band = spectral_cache.psd(*psd_config)
+
+        band_label = band if band is not None else "broadband"
+        params[f'psd_{band_label}'] = np.nanmean(psd_band, axis=0) if avg else psd_band
+        params[f'psd_freq_{band_label}'] = fxx_band
+
+    # Spectral bands from the broadband PSD: without band segmentation, the spectral parameters of all the configured
+    # bands are derived from the PSD of the broadband epochs instead of filtering the signal once per band
+    spectral_bands = (settings['parameters'].get('spectral_bands', False)
+                      and not settings['preprocessing'].get('band_segmentation', False)
+                      and bool(settings['parameters'].get('selected_spectral_bands')))
+    if spectral_bands:
+        spectral_labels = [b.get('name', 'unknown') for b in settings['parameters']['selected_spectral_bands']]
+        spectral_ranges = [[b['min'], b['max']] for b in settings['parameters']['selected_spectral_bands']]
+
+    # --- PSD broadband (solo una vez, para relative power) ---
+    if settings['parameters'].get('relative_power', False):
+        bb = [settings['preprocessing']['broadband_min'], settings['preprocessing']['broadband_max']]
+
+        # Calcular PSD broadband (respetando configuración de psd_enabled). Same epochs and settings as the PSD
+        # above, so it is taken from the cache
+        fxx_bb, psd_bb = spectral_cache.psd(*psd_config)
+
+        # Normalizar PSD broadband
+        norm_psd = medusa.transforms.normalize_psd(psd_bb, bb, fxx_bb, norm='rel')
+        if band == 'broadband' or band is None:
+            params['norm_psd_broadband'] = norm_psd
+            params['psd_broadband'] = psd_bb
+            params['psd_freq_broadband'] = fxx_bb
 
-    def apply_preprocessing(signal, fs, cfg):
+        # --- Calcular relative power ---
+        if settings['preprocessing'].get('band_segmentation', False):
+            # Caso 1: hubo band segmentation → usar bandas de preprocessing
+            selected_bands = settings['preprocessing'].get('selected_bands')
+            band_info = next((b for b in selected_bands if b.get("name") == band), None)
+            band_range = [band_info.get("min"), band_info.get("max")]
+            band_label = band
+            val = medusa.signal_metrics.band_power.band_power(norm_psd, fs, band_range)
+            params[f"relative_power_{band_label}"] = np.nanmean(val, axis=0) if avg else val
+        elif spectral_bands:
+            # Caso 3: bandas espectrales a partir de la PSD broadband → todas las bandas en una pasada
+            val = band_metrics(norm_psd, fs, spectral_ranges, ('band_power',))['band_power']
+            for band_label, band_val in zip(spectral_labels, val):
+                params[f"relative_power_{band_label}"] = np.nanmean(band_val, axis=0) if avg else band_val
+        else:
+            # Caso 2: NO hubo band segmentation → usar solo la banda broadband completa
+            val = medusa.signal_metrics.band_power.band_power(norm_psd, fs, bb)
+            params["relative_power_broadband"] = np.nanmean(val, axis=0) if avg else val
+
+    # # RP
+    # if settings['parameters'].get('relative_power', False):
+    #     bb = [settings['parameters']['broadband_min'], settings['parameters']['broadband_max']]
+    #     if band == 'broadband' or band is None:
+    #         norm_psd = medusa.transforms.normalize_psd(psd, bb, fxx, norm='rel')
+    #         params['norm_psd'] = norm_psd
+    #         if settings['preprocessing'].get('band_segmentation', False) and (band == 'broadband'): # Band segmentation
+    #             for b in settings['preprocessing'].get('selected_bands'):
+    #                 val = medusa.signal_metrics.band_power.band_power(norm_psd, fs, [b.get('min'), b.get('max')])
+    #                 params[f"relative_power_{b.get('name', 'unknown')}"] = np.nanmean(val, axis=0) if avg else val
+    #         else:
+    #             for b in settings['parameters']['selected_rp_bands']:
+    #                 val = medusa.signal_metrics.band_power.band_power(norm_psd, fs, [b['min'], b['max']])
+    #                 params[f"relative_power_{b.get('name', 'unknown')}"] = np.nanmean(val, axis=0) if avg else val
+
+    # if settings['parameters'].get('relative_power', False) and (band == 'broadband' or band is None):
+    #     bb = [settings['parameters']['broadband_min'], settings['parameters']['broadband_max']]
+    #     norm_psd = medusa.transforms.normalize_psd(psd, bb, fxx, norm='rel')
+    #     params['norm_psd'] = norm_psd
+    #     for b in settings['parameters']['selected_rp_bands']:
+    #         val = medusa.signal_metrics.band_power.band_power(norm_psd, fs, [b['min'], b['max']])
+    #         params[f"relative_power_{b.get('name', 'unknown')}"] = np.nanmean(val, axis=0) if avg else val
+
+    metrics = {
+        "absolute_power": medusa.signal_metrics.band_power.band_power,
+        "median_frequency": medusa.signal_metrics.median_frequency.median_frequency,
+        "spectral_entropy": medusa.signal_metrics.shannon_spectral_entropy.shannon_spectral_entropy,
+    }
+
+    if spectral_bands:
+        # One vectorized pass over the shared PSD for all the metrics and bands
+        enabled_metrics = [m for m in metrics if settings['parameters'].get(m, False)]
+        engine_names = {"absolute_power": "band_power", "median_frequency": "median_frequency",
+                        "spectral_entropy": "spectral_entropy"}
+        if enabled_metrics:
+            results = band_metrics(psd_band, fs, spectral_ranges, [engine_names[m] for m in enabled_metrics])
+            for metric_name in enabled_metrics:
+                for band_label, val in zip(spectral_labels, results[engine_names[metric_name]]):
+                    params[f"{metric_name}_{band_label}"] = np.nanmean(val, axis=0) if avg else val
+        metrics = {}
+
+    for metric_name, metric_func in metrics.items():
+        if settings['parameters'].get(metric_name, False):
+            if band is None or band == 'broadband':
+                band_range = [
+                    settings['preprocessing']['broadband_min'],
+                    settings['preprocessing']['broadband_max']
+                ]
+                band_label = "broadband"
+            else:
+                selected_bands = settings['preprocessing'].get('selected_bands')
+                band_info = next((b for b in selected_bands if b.get("name") == band), None)
+                band_range = [band_info.get("min"), band_info.get("max")]
+                band_label = band
+
+            val = metric_func(psd_band, fs, band_range)
+            params[f"{metric_name}_{band_label}"] = np.nanmean(val, axis=0) if avg else val
+
+    # Nonlinear and connectivity. The analytic signal of these epochs is computed once and shared by all the
+    # connectivity metrics
+    connectivity = ConnectivityEngine(epoched)
+    # The coarse-grained series and the sample entropies of each scale are shared by SampEn and multiscale SampEn
+    entropy_cache = EntropyCache(epoched, settings['parameters'].get('sample_entropy_method') or 'fast', reference)
+    # LZC and multiscale LZC sequences are binarized at once and parsed in a single batch
+    complexity_cache = ComplexityCache(epoched, executor)
+    complexity_cache.prepare(lzc=settings['parameters'].get('lzc', False),
+                             scales=settings['parameters']['multiscale_lzc_scales']
+                             if settings['parameters'].get('multiscale_lzc', False) else None)
+    param_map = {
+        'ctm': lambda: medusa.signal_metrics.central_tendency.central_tendency_measure(epoched,
+                                                                                       settings['parameters'][
+                                                                                           'ctm_r']),
+        'sample_entropy': lambda: entropy_cache.sample_entropy(settings['parameters']['sample_entropy_m'],
+                                                               settings['parameters']['sample_entropy_r']),
+        'multiscale_sample_entropy': lambda: entropy_cache.multiscale_entropy(
+            settings['parameters']['multiscale_sample_entropy_scale'],
+            settings['parameters']['multiscale_sample_entropy_m'],
+            settings['parameters']['multiscale_sample_entropy_r']),
+        'lzc': complexity_cache.lempel_ziv_complexity,
+        'multiscale_lzc': lambda: complexity_cache.multiscale_lempel_ziv_complexity(
+            settings['parameters']['multiscale_lzc_scales']),
+        'iac': lambda: connectivity.iac(bool(settings['parameters']['ort_iac'])),
+        'aec': lambda: connectivity.aec(bool(settings['parameters']['ort_aec'])),
+        'plv': connectivity.plv,
+        'pli': connectivity.pli,
+        'wpli': connectivity.wpli,
+    }
+
+    for name, func in param_map.items():
+        if settings['parameters'].get(name, False):
+            val = func()
+            params[name] = np.nanmean(val, axis=0) if avg else val
+
+    return params
+
+
+# Settings of the 'parameters' section that each parameter depends on (result cache keys)
+PSD_SETTINGS = ('psd', 'psd_segment_pct', 'psd_overlap_pct', 'psd_window')
+SPECTRAL_SETTINGS = PSD_SETTINGS + ('spectral_bands', 'selected_spectral_bands')
+PARAMETER_SETTINGS = {
+    'mean': (), 'variance': (), 'median': (), 'kurtosis': (), 'skewness': (),
+    'psd': PSD_SETTINGS,
+    'relative_power': SPECTRAL_SETTINGS,
+    'absolute_power': SPECTRAL_SETTINGS,
+    'median_frequency': SPECTRAL_SETTINGS,
+    'spectral_entropy': SPECTRAL_SETTINGS,
+    'ctm': ('ctm_r',),
+    'sample_entropy': ('sample_entropy_m', 'sample_entropy_r'),
+    'multiscale_sample_entropy': ('multiscale_sample_entropy_scale', 'multiscale_sample_entropy_m',
+                                  'multiscale_sample_entropy_r'),
+    'lzc': (),
+    'multiscale_lzc': ('multiscale_lzc_scales',),
+    'iac': ('ort_iac',),
+    'aec': ('ort_aec',),
+    'plv': (),
+    'pli': (),
+    'wpli': (),
+}
+
+
+def preprocessing_signature(settings, band):
+    """
+        Settings that the preprocessed signal of the band depends on (result cache keys)
+    """
+    cfg = {k: v for k, v in settings['preprocessing'].items()
+           if k not in ('selected_files', 'selected_bands', 'crop_to_segments')}
+    return cfg, band
+
+
+def segmentation_signature(settings):
+    """
+        Settings that the epochs of one condition (and event) depend on (result cache keys). The selected conditions
+        and events are part of the key of each epoched unit
+    """
+    return {k: v for k, v in settings['segmentation'].items()
+            if k not in ('selected_conditions', 'selected_events', 'zero_copy_epochs', 'thres_chunk_samples')}
+
+
+# Parameters derived from the PSD of the epochs
+SPECTRAL_PARAMETERS = ('relative_power', 'absolute_power', 'median_frequency', 'spectral_entropy')
+
+
+def parameter_outputs(name, params, settings):
+    """
+        Entries of the output of compute_parameters that the parameter name produces. The spectral parameters also
+        produce the PSD entries they are derived from, unless the PSD is a parameter itself (then, those entries are
+        the outputs of 'psd')
+    """
+    psd_enabled = settings['parameters'].get('psd', False)
+    if name == 'psd':
+        prefixes = ('psd_',)
+    elif name == 'relative_power':
+        prefixes = ('relative_power_', 'norm_psd_') + (() if psd_enabled else ('psd_broadband', 'psd_freq_broadband'))
+    elif name in SPECTRAL_PARAMETERS:
+        prefixes = (f"{name}_",) + (() if psd_enabled else ('psd_',))
+    else:
+        return {name: params[name]} if name in params else {}
+    return {k: v for k, v in params.items() if k.startswith(prefixes)}
+
+
+def parameter_keys(settings, cache, epochs_key):
+    """
+        Result cache keys of the outputs of each enabled parameter (name -> key). epochs_key is the cache key of the
+        epochs they are computed from
+    """
+    return {name: cache.key('param', epochs_key, name,
+                            {k: settings['parameters'].get(k) for k in PARAMETER_SETTINGS[name]})
+            for name in PARAMETER_SETTINGS if settings['parameters'].get(name, False)}
+
+
+def cached_parameters(epoched, settings, fs, band, cache, epochs_key, executor=None):
+    """
+        Same as compute_parameters, but the outputs of each parameter are read from the result cache (see
+        result_cache.ResultCache) when possible. Only the parameters that are not cached are computed, and they are
+        stored in the cache. epochs_key is the cache key of the epochs. If epoched is None, the parameters are only
+        read from the cache: returns None if some of them are not cached
+    """
+    keys = parameter_keys(settings, cache, epochs_key)
+    enabled = list(keys)
+    outputs = {name: cache.get(keys[name]) for name in enabled}
+    missing = [name for name in enabled if outputs[name] is None]
+    if missing and epoched is None:
+        return None
+    if missing:
+        # The cached parameters are disabled, so the shared computations (e.g., PSD or analytic signal) are only
+        # done for the missing ones. The PSD settings are kept if a spectral parameter is missing, since they define
+        # the PSD it is derived from
+        keep = set(missing)
+        if keep.intersection(SPECTRAL_PARAMETERS):
+            keep.add('psd')
+        missing_settings = {**settings, 'parameters': {**settings['parameters'],
+                                                       **{name: False for name in enabled if name not in keep}}}
+        computed = compute_parameters(epoched, missing_settings, fs, band, executor)
+        for name in missing:
+            outputs[name] = parameter_outputs(name, computed, settings)
+            cache.put(keys[name], outputs[name])
+    params = {}
+    for name in enabled:
+        params.update(outputs[name])
+    return params
+
+
+def duplicate_subjects(files):
+    """
+        Subjects (base names of the files, which name their outputs) shared by several files, e.g., recordings with the
+        same name in different folders. Returns a dict subject -> files
+    """
+    subjects = {}
+    for file in files:
+        subjects.setdefault(splitext(basename(file))[0], []).append(file)
+    return {subject: paths for subject, paths in subjects.items() if len(paths) > 1}
+
+
+class PipelineEngine:
+    """
+        Runs all the tasks (preprocessing, segmentation and parameters computation) defined in the settings dictionary
+        for each selected file. It has no GUI dependency: the caller is notified through callbacks.
+
+        Callbacks:
+            - log_callback(msg, style=None): receives every log message. Style can be None, 'error' or 'warning'.
+            - progress_callback(progress, file): receives the global progress (0-100) and the file being processed.
+            - output_callback(key): returns True if the output 'key' ('prep', 'seg' or 'param') must be stored.
+            - cancel_callback(): returns True if the user has cancelled the run. It is checked after each band and
+              file, so the pipeline stops once the current band is finished.
+
+        If n_workers > 1, the files are distributed among n_workers processes. The logs of each file are sent to
+        log_callback when the file is finished, and the progress is updated per file. A cancellation is forwarded to
+        the workers, which stop after their current band. If only one file is processed, a pool of n_workers
+        processes, created once for the run, is used to compute the parameters that can be parallelized.
+
+        If cache is a result_cache.ResultCache, the preprocessed band signals and the outputs of each parameter are
+        read from it when the input file and the settings they depend on have not changed, so re-runs only compute
+        what is new (e.g., one more parameter). The epochs are not cached: they are computed again only if they are
+        stored or some parameter is not cached.
+
+        Each run records its completed units (files, preprocessed bands and segmentation units) in a journal in the
+        output folder (see run_journal.RunJournal). If resume is True, the units recorded by a previous run with the
+        same settings are skipped, so an interrupted run continues where it stopped.
+
+        output_format is the layout of the outputs: 'mat' (one .mat file per output), 'hdf5' (one HDF5 store per run)
+        or 'hdf5-subject' (one HDF5 store per subject). See output_store.
+
+        If async_writes is True, the outputs are written in a background thread (output_store.AsyncOutputWriter) while
+        the next conditions and bands are computed, with at most write_buffer_bytes of outputs waiting to be written.
+        The writes of each file are finished before the file is recorded as completed.
+
+        When the files are processed in this process, the next prefetch recordings (with files of at most
+        prefetch_bytes in total) are loaded in the background while the current one is processed (see
+        recording_loader.RecordingPrefetcher). Use prefetch=0 to load each file when it is processed. There is no
+        prefetching with sidecars (below).
+
+        The .bson recordings are parsed from the files. If sidecar_dir is given, they are loaded from their
+        memory-mapped sidecars in that folder, created the first time they are loaded (see
+        recording_loader.load_recording).
+    """
+
+    def __init__(self, settings_dic, output_folder, log_callback=None, progress_callback=None,
+                 output_callback=None, cancel_callback=None, n_workers=1, cache=None, resume=False, journal=None,
+                 output_format='mat', store_path=None, async_writes=True, write_buffer_bytes=DEFAULT_WRITE_BUFFER_BYTES,
+                 prefetch=DEFAULT_PREFETCH_DEPTH, prefetch_bytes=DEFAULT_PREFETCH_BYTES, sidecar_dir=None):
+        self.settings_dic = settings_dic
+        self.output_format = output_format
+        self.store_path = store_path
+        self.store = None
+        self.async_writes = async_writes
+        self.write_buffer_bytes = write_buffer_bytes
+        self.writer = None
+        self.prefetch = prefetch
+        self.prefetch_bytes = prefetch_bytes
+        self.prefetcher = None
+        self.sidecar_dir = sidecar_dir
+        self.feature_table = None
+        # Journal records of the units whose outputs are not written yet (background writes and feature table)
+        self.pending_units = []
+        self.cache = cache
+        self.resume = resume
+        self.journal = journal
+        self.output_folder = output_folder
+        self.n_workers = n_workers if n_workers and n_workers > 0 else cpu_count()
+        # Process pool used to compute the parameters of a single file (see run_serial)
+        self.executor = None
+        self.log_callback = log_callback if log_callback is not None else print_log
+        self.progress_callback = progress_callback
+        self.output_callback = output_callback if output_callback is not None else lambda key: True
+        self.cancel_callback = cancel_callback if cancel_callback is not None else lambda: False
+
+    def log(self, msg, style=None):
+        self.log_callback(msg, style=style)
+
+    def is_cancelled(self):
+        return self.cancel_callback()
+
+    def notify_progress(self, progress, file):
+        if self.progress_callback is not None:
+            self.progress_callback(progress, file)
+
+    def load_recording(self, file):
         """
-            Filtering and CAR
+            Recording of the file, loaded in advance if the files are prefetched
         """
-        if cfg.get('bandpass') and None not in (cfg.get('bp_min'), cfg.get('bp_max'), cfg.get('bp_order')):
-            signal = medusa.FIRFilter(cfg['bp_order'], [cfg['bp_min'], cfg['bp_max']], 'bandpass', window=cfg['bp_win']).fit_transform(
-                signal, fs)
-        if cfg.get('notch') and None not in (cfg.get('notch_min'), cfg.get('notch_max'), cfg.get('notch_order')):
-            signal = medusa.FIRFilter(cfg['notch_order'], [cfg['notch_min'], cfg['notch_max']],
-                                      'bandstop', window=cfg['notch_win']).fit_transform(signal, fs)
-        return medusa.car(signal) if cfg.get('car') else signal
+        if self.prefetcher is not None:
+            return self.prefetcher.get(file)
+        return load_recording(file, self.sidecar_dir)
 
-    def band_segmentation(signal, bp_min, bp_max, fs, cfg):
+    def check_recordings(self, files):
         """
-            Band segmentation
+            Probes the metadata of the files (see recording_probe), so the ones that cannot be processed with the
+            settings (other sampling frequency) are reported before processing any file. Returns the files that can
+            be processed. Files that cannot be probed are kept: their errors are reported when they are processed
         """
-        order = 1000 if cfg.get('bandpass') is False else cfg.get('bp_order')
-        win = 'hamming' if cfg.get('bandpass') is False else cfg.get('bp_win')
-        bp_filter = medusa.FIRFilter(order, [bp_min, bp_max], 'bandpass', window=win)
-        signal = bp_filter.fit_transform(signal, fs)
-        return signal
+        fs = self.settings_dic['preprocessing']['fs']
+        valid = []
+        for file, probe in zip(files, probe_recordings(files, self.sidecar_dir)):
+            eeg = probe['biosignals'].get('eeg') if not isinstance(probe, Exception) else None
+            if eeg is not None and eeg['fs'] is not None and eeg['fs'] != fs:
+                self.log(f"Error preprocessing {file}: the sampling frequency ({eeg['fs']:g} Hz) is not the one of "
+                         f"the settings ({fs:g} Hz)", style='error')
+                continue
+            valid.append(file)
+        return valid
 
-    def find_nearest_index(array, value):
+    def output_store(self):
         """
-            For segmentation: find the nearest value to the given index
+            Output backend of the engine (see output_store.open_output_store). It is opened the first time an output
+            is stored
         """
-        array = np.array(array)
-        idx = (np.abs(array - value)).argmin()
-        return idx
+        if self.store is None:
+            self.store = open_output_store(self.output_format, self.output_folder, self.log, self.store_path)
+        return self.store
 
-    def find_nearest_index_array(reference_times, query_times):
+    def output_writer(self):
         """
-            For segmentation: find the nearest value to the given index in array format
+            Object that stores the outputs: the output backend, or the background writer of the backend if
+            async_writes is True
         """
-        reference_times = np.asarray(reference_times)
-        query_times = np.asarray(query_times)
+        if not self.async_writes:
+            return self.output_store()
+        if self.writer is None:
+            self.writer = AsyncOutputWriter(self.output_store(), self.write_buffer_bytes)
+        return self.writer
 
-        indices = np.searchsorted(reference_times, query_times)
-        indices = np.clip(indices, 1, len(reference_times) - 1)
+    def close_store(self):
+        """
+            Finishes the pending writes and closes the output backend. Returns the errors of the pending writes
+        """
+        errors = []
+        if self.writer is not None:
+            errors = self.writer.close()
+            self.writer = None
+        for error in errors:
+            self.log(f"Output not written: {error}", style='error')
+        if self.store is not None:
+            self.store.close()
+            self.store = None
+        return errors
 
-        left = reference_times[indices - 1]
-        right = reference_times[indices]
+    def save_outputs(self, data, base_name, suffix, key, location=None):
+        """
+            Stores the outputs according to the user selections. location (dict with subject, band, condition and
+            event) is the position of the output in the hierarchical formats
+        """
+        if not self.output_callback(key):
+            return
+        if key == 'prep' and not self.settings_dic['preprocessing'].get('apply_preprocessing'):
+            return
+        self.output_writer().save(key, data, location or {'subject': base_name, 'band': suffix}, base_name, suffix)
 
-        closest = np.where(
-            np.abs(query_times - left) < np.abs(query_times - right), left, right)
-        return closest
+    def add_features(self, params, location, data):
+        """
+            Adds the parameters of one location to the rows of the feature table of the current file
+        """
+        if not self.output_callback('features'):
+            return
+        if self.feature_table is None:
+            self.feature_table = FeatureTable(self.output_folder, self.settings_dic, self.log)
+        channel_set = getattr(data.eeg, 'channel_set', None)
+        self.feature_table.add(params, location, getattr(channel_set, 'l_cha', None),
+                               averaged=bool(self.settings_dic['segmentation'].get('average')))
 
-    def get_condition_indices(data, condition_key):
+    def flush_outputs(self, base_name):
         """
-            Get indices of conditions by name
+            Waits for the pending writes of the current file and writes its features as a new part of the feature
+            table. Then, the units they belong to are recorded in the run journal. If some write failed, nothing is
+            recorded and the features are discarded, so a resumed run computes the units again without duplicating
+            their rows. Returns the errors of the writes
         """
-        return np.where(np.array(data.marks.conditions_labels) == condition_key)[0]
+        errors = self.writer.flush() if self.writer is not None else []
+        for error in errors:
+            self.log(f"Output not written: {error}", style='error')
+        if errors:
+            if self.feature_table is not None:
+                self.feature_table.parts = []
+        else:
+            if self.feature_table is not None:
+                self.feature_table.flush(base_name)
+            for record in self.pending_units:
+                self.journal.mark_done(*record)
+        self.pending_units = []
+        return errors
 
-    def get_event_indices_in_range(data, event_key, start_time, end_time):
+    def is_done(self, stage, file, band=None, unit=None):
+        """
+            True if the unit was completed by a resumed run (see run_journal.RunJournal.is_done)
+        """
+        return self.journal is not None and file is not None and self.journal.is_done(stage, file, band, unit)
+
+    def mark_done(self, stage, file, band=None, unit=None):
+        """
+            Records a completed unit in the run journal. If the outputs are written in the background or the feature
+            table is stored, the units are recorded once their outputs are written (see flush_outputs)
         """
-            Get indices of events by name whithin an interval
+        if self.journal is None or file is None:
+            return
+        if stage in ('prep', 'seg') and self.async_writes or stage == 'seg' and self.output_callback('features'):
+            self.pending_units.append((stage, file, band, unit))
+        else:
+            self.journal.mark_done(stage, file, band, unit)
+
+    def segmentation_units(self):
+        """
+            List of the segmentation units: (condition,) in segmentation by condition, (condition, event) in
+            segmentation by event
+        """
+        seg = self.settings_dic['segmentation']
+        if seg['segmentation_type'] == 'condition':
+            return [(cond,) for cond in seg['selected_conditions']]
+        if seg['segmentation_type'] == 'event':
+            return [(cond, evt) for cond in seg['selected_conditions'] for evt in seg['selected_events']]
+        return []
+
+    def epochs_key(self, band_key, unit):
         """
-        events_labels = np.array(data.marks.events_labels)
-        events_times = np.array(data.marks.events_times)
-        return np.where(
-            (events_labels == event_key) &
-            (events_times >= start_time) &
-            (events_times <= end_time)
-        )[0]
+            Result cache key of the epochs of one segmentation unit, or None if the cache is disabled. The epochs are
+            not stored: the entry only records if the unit has epochs, and it keys the outputs of the parameters
+        """
+        if self.cache is None or band_key is None:
+            return None
+        return self.cache.key('unit', band_key, segmentation_signature(self.settings_dic), list(unit))
+
+    def unit_cached(self, band_key, unit):
+        """
+            True if the results of one segmentation unit can be read from the result cache without segmenting the
+            signal: the segmented signals are not stored and the unit has no epochs or all its parameters are cached
+        """
+        key = self.epochs_key(band_key, unit)
+        if key is None or self.output_callback('seg'):
+            return False
+        entry = self.cache.get(key)
+        if entry is None:
+            return False
+        return not entry['has_epochs'] or all(self.cache.contains(param_key) for param_key in
+                                              parameter_keys(self.settings_dic, self.cache, key).values())
+
+    def unit_results(self, band_key, unit, make_epochs, fs, band):
+        """
+            Epochs and parameters of one segmentation unit. With the result cache, the parameters are read from it
+            when possible, and the epochs are only computed (make_epochs()) if they must be stored or some parameter
+            is not cached. Returns (epoched, params): both are None if the unit has no epochs, and epoched is also None
+            if it was not computed
+        """
+        key = self.epochs_key(band_key, unit)
+        if key is None:
+            epoched = make_epochs()
+            if epoched is None:
+                return None, None
+            return epoched, compute_parameters(epoched, self.settings_dic, fs, band, self.executor)
+        if not self.output_callback('seg'):
+            entry = self.cache.get(key)
+            if entry is not None:
+                if not entry['has_epochs']:
+                    return None, None
+                params = cached_parameters(None, self.settings_dic, fs, band, self.cache, key, self.executor)
+                if params is not None:
+                    return None, params
+        epoched = make_epochs()
+        # Units without epochs are also recorded, so they are not segmented again
+        self.cache.put(key, {'has_epochs': np.array(epoched is not None)})
+        if epoched is None:
+            return None, None
+        return epoched, cached_parameters(epoched, self.settings_dic, fs, band, self.cache, key, self.executor)
 
-    def segment_by_condition(data, current_signal, settings, base_name, norm, band):
+    def segment_by_condition(self, data, current_signal, base_name, norm, fs, band, marks_index=None, thres_stats=None,
+                             band_key=None, file=None):
         """
-            Manages the segmentation by condition. It includes the signal thresholding, resampling and normalization
+            Manages the segmentation by condition. It includes the signal thresholding, resampling and normalization.
+            marks_index is the MarksIndex of the recording and thres_stats the (mean, std) of current_signal used for
+            the thresholding (they are computed if not given). band_key is the result cache key of current_signal;
+            current_signal can be None if the results of all the pending conditions are cached. If file is given, the
+            conditions are recorded in the run journal and the completed ones are skipped
         """
+        settings = self.settings_dic
+        if marks_index is None:
+            marks_index = MarksIndex.from_recording(data)
+
         # Variable definition
         fs_seg = fs / 1000
         trial_len = int(settings['segmentation']['trial_length']) * fs_seg
@@ -100,34 +884,39 @@ def run_pipeline(self, settings_dic, total_tasks):
         thres_k = settings['segmentation']['thres_k']
         thres_samples = settings['segmentation']["thres_samples"]
         thres_channels = settings['segmentation']["thres_channels"]
+        if thresholding and thres_stats is None and current_signal is not None:
+            thres_stats = signal_statistics(current_signal, settings['segmentation'].get('thres_chunk_samples'))
+        zero_copy = settings['segmentation'].get('zero_copy_epochs', True)
 
-        def save_and_compute(epoched, cond_name):
+        def per_segment(epoched, func):
             """
-                Save the segmented signals, compute the parameters, and store them
+                Applies a per-epoch stage to the epochs (to each segment, if they are an EpochSegments)
             """
-            if epoched is None:
-                return
-            save_outputs(epoched, f"{base_name}_segmentation_{cond_name}", band or 'broadband', 'seg')
-            params = compute_parameters(epoched, settings, fs, band)
-            save_outputs(params, f"{base_name}_parameters_{cond_name}", band or 'broadband', 'param')
+            return epoched.map(func) if isinstance(epoched, EpochSegments) else func(epoched)
 
-        # For each condition...
-        for cond in selected_conditions:
+        def make_epochs(cond):
+            """
+                Epochs of the condition (after thresholding and resampling), or None
+            """
             if cond == 'no-condition':
-                epoched = medusa.get_epochs(current_signal, trial_len, stride=trial_stride, norm=norm_type)
+                condition_samples = [(0, len(current_signal))]
             else:
                 cond_key = data.marks.app_settings['conditions'][cond]['label']
-                idx = get_condition_indices(data, cond_key)
+                condition_samples = marks_index.condition_samples(cond_key)
 
                 # If the condition do not have even indices (start and end in all cases) in all segments, continue
-                if len(idx) % 2 != 0:
-                    continue
+                if condition_samples is None:
+                    return None
 
+            if zero_copy:
+                # Read-only views into the signal: overlapping epochs do not duplicate the samples
+                epoched = get_segments_epochs(current_signal, condition_samples, trial_len, trial_stride, norm_type)
+            elif cond == 'no-condition':
+                epoched = medusa.get_epochs(current_signal, trial_len, stride=trial_stride, norm=norm_type)
+            else:
                 # For each segment, make epochs
                 segments = []
-                for i in range(0, len(idx), 2):
-                    start = find_nearest_index(data.eeg.times, data.marks.conditions_times[idx[i]])
-                    end = find_nearest_index(data.eeg.times, data.marks.conditions_times[idx[i + 1]])
+                for start, end in condition_samples:
                     segment = current_signal[start:end]
                     epochs = medusa.get_epochs(segment, trial_len, stride=trial_stride, norm=norm_type)
                     if epochs is not None:
@@ -136,25 +925,52 @@ def run_pipeline(self, settings_dic, total_tasks):
 
             # Thresholding
             if epoched is not None and thresholding:
-                _, epoched, _ = medusa.artifact_removal.reject_noisy_epochs(
-                    epoched,
-                    np.nanmean(current_signal, axis=0),
-                    np.std(current_signal, axis=0),
+                thres_mean, thres_std = thres_stats
+                epoched = per_segment(epoched, lambda epochs: medusa.artifact_removal.reject_noisy_epochs(
+                    epochs,
+                    thres_mean,
+                    thres_std,
                     k=thres_k,
                     n_samp=thres_samples,
                     n_cha=thres_channels
-                )
+                )[1])
 
             # Resampling
             if epoched is not None and resample:
-                epoched = medusa.resample_epochs(epoched, t_window, resample_fs)
+                epoched = per_segment(epoched, lambda epochs: medusa.resample_epochs(epochs, t_window, resample_fs))
+            return epoched
 
-            save_and_compute(epoched, cond)
+        # For each condition...
+        for cond in selected_conditions:
+            if self.is_done('seg', file, band or 'broadband', (cond,)):
+                continue
+            epoched, params = self.unit_results(band_key, (cond,), lambda: make_epochs(cond), fs, band)
+            if params is not None:
+                # Save the segmented signals and the parameters
+                location = {'subject': base_name, 'band': band or 'broadband', 'condition': cond}
+                if epoched is not None and self.output_callback('seg'):
+                    # The epochs of several segments are only gathered in a single array here
+                    self.save_outputs(materialize(epoched), f"{base_name}_segmentation_{cond}", band or 'broadband',
+                                      'seg', location)
+                self.save_outputs(params, f"{base_name}_parameters_{cond}", band or 'broadband', 'param', location)
+                self.add_features(params, location, data)
+            self.mark_done('seg', file, band or 'broadband', (cond,))
 
-    def segment_by_event(data, current_signal, settings, base_name, norm, fs, band):
+    def segment_by_event(self, data, current_signal, base_name, norm, fs, band, marks_index=None, thres_stats=None,
+                         band_key=None, file=None):
         """
-            Manages the segmentation by event. It includes the signal thresholding, resampling and normalization
+            Manages the segmentation by event. It includes the signal thresholding, resampling and normalization.
+            marks_index is the MarksIndex of the recording and thres_stats the (mean, std) of current_signal used for
+            the thresholding (they are computed if not given). band_key is the result cache key of current_signal;
+            current_signal can be None if the results of all the pending conditions and events are cached. If file is
+            given, the (condition, event) units are recorded in the run journal and the completed ones are skipped
         """
+        settings = self.settings_dic
+        if marks_index is None:
+            marks_index = MarksIndex.from_recording(data)
+        # Time vector of current_signal (decimated in multirate mode)
+        times = marks_index.times
+
         # Variable definition
         w_start, w_end = settings['segmentation']['window_start'], settings['segmentation']['window_end']
         window = [w_start, w_end]
@@ -169,327 +985,499 @@ def run_pipeline(self, settings_dic, total_tasks):
         thres_k = settings['segmentation']['thres_k']
         thres_samples = settings['segmentation']["thres_samples"]
         thres_channels = settings['segmentation']["thres_channels"]
+        if thresholding and thres_stats is None and current_signal is not None:
+            thres_stats = signal_statistics(current_signal, settings['segmentation'].get('thres_chunk_samples'))
 
-        def save_and_compute(epoched, cond, evt):
+        def make_epochs(cond, evt):
             """
-                Save the segmented signals, compute the parameters, and store them
+                Epochs of the event within the condition (after thresholding and resampling), or None
             """
-            if epoched is None:
-                return
-            label = f"{base_name}_segmentation_{cond}_{evt}"
-            band_lbl = band or 'broadband'
-            save_outputs(epoched, label, band_lbl, 'seg')
-            params = compute_parameters(epoched, settings, fs, band)
-            save_outputs(params, label, band_lbl, 'param')
+            if cond == 'no-condition':
+                evt_key = data.marks.app_settings['events'][evt]['label']
+                onsets_idx = marks_index.nearest_times(marks_index.event_times(evt_key))
+                epoched = medusa.get_epochs_of_events(times, current_signal, onsets_idx, fs, window,
+                                                      baseline_window, norm=norm_type)
+            else:
+                cond_key = data.marks.app_settings['conditions'][cond]['label']
+                evt_key = data.marks.app_settings['events'][evt]['label']
+                condition_samples = marks_index.condition_samples(cond_key)
+
+                # If the condition do not have even indices (start and end in all cases) in all segments, continue
+                if condition_samples is None:
+                    return None
+
+                segments = []
+                for start_idx, end_idx in condition_samples:
+                    start_time, end_time = times[start_idx], times[end_idx]
+                    onsets = marks_index.event_times(evt_key, start_time, end_time)
+                    onsets_idx = marks_index.nearest_times(onsets)
+
+                    epochs = medusa.get_epochs_of_events(times, current_signal, onsets_idx, fs, window,
+                                                         baseline_window, norm=norm_type)
+                    if epochs is not None:
+                        segments.append(epochs)
+
+                epoched = np.concatenate(segments, axis=0) if segments else None
+
+            # Thresholding
+            if epoched is not None and thresholding:
+                thres_mean, thres_std = thres_stats
+                _, epoched, _ = medusa.artifact_removal.reject_noisy_epochs(
+                    epoched,
+                    thres_mean,
+                    thres_std,
+                    k=thres_k,
+                    n_samp=thres_samples,
+                    n_cha=thres_channels
+                )
+
+            # Resample
+            if epoched is not None and resample:
+                epoched = medusa.resample_epochs(epoched, window, resample_fs)
+            return epoched
 
         # For each condition and event
         for cond in selected_conditions:
             for evt in selected_events:
-                if cond == 'no-condition':
-                    evt_key = data.marks.app_settings['events'][evt]['label']
-                    onsets = np.array(data.marks.events_times)[np.array(data.marks.events_labels) == evt_key]
-                    onsets_idx = find_nearest_index_array(data.eeg.times, onsets)
-                    epoched = medusa.get_epochs_of_events(data.eeg.times, current_signal, onsets_idx, fs, window,
-                                                          baseline_window, norm=norm_type)
-                else:
-                    cond_key = data.marks.app_settings['conditions'][cond]['label']
-                    evt_key = data.marks.app_settings['events'][evt]['label']
-                    idx = get_condition_indices(data, cond_key)
+                band_lbl = band or 'broadband'
+                if self.is_done('seg', file, band_lbl, (cond, evt)):
+                    continue
+                epoched, params = self.unit_results(band_key, (cond, evt), lambda: make_epochs(cond, evt), fs, band)
+                if params is not None:
+                    # Save the segmented signals and the parameters
+                    label = f"{base_name}_segmentation_{cond}_{evt}"
+                    location = {'subject': base_name, 'band': band_lbl, 'condition': cond, 'event': evt}
+                    if epoched is not None:
+                        self.save_outputs(epoched, label, band_lbl, 'seg', location)
+                    self.save_outputs(params, label, band_lbl, 'param', location)
+                    self.add_features(params, location, data)
+                self.mark_done('seg', file, band_lbl, (cond, evt))
 
-                    # If the condition do not have even indices (start and end in all cases) in all segments, continue
-                    if len(idx) % 2 != 0:
-                        continue
+    def get_crops(self, data, marks_index, fs, file):
+        """
+            Intervals of the recording that are filtered when the "crop_to_segments" preprocessing option is enabled,
+            or None to filter the whole signal. Cropping is only applied if the whole preprocessed signal is not
+            needed: the preprocessed signals are not stored and the thresholding (which uses the statistics of the
+            whole signal) is disabled
+        """
+        cfg = self.settings_dic['preprocessing']
+        if not cfg.get('crop_to_segments', False):
+            return None
+        if cfg.get('apply_preprocessing') and self.output_callback('prep'):
+            self.log(f"{basename(file)}: the whole signal is filtered because the preprocessed signals are stored",
+                     style='warning')
+            return None
+        if self.settings_dic['segmentation'].get('thresholding'):
+            self.log(f"{basename(file)}: the whole signal is filtered because the thresholding uses its statistics",
+                     style='warning')
+            return None
+        margin, max_order = filter_margin(cfg)
+        intervals = segmentation_intervals(data, marks_index, self.settings_dic, fs) if max_order else None
+        if intervals is None:
+            return None
+        n_samples = data.eeg.signal.shape[0]
+        crops = crop_intervals(intervals, n_samples, margin, 3 * max_order + 1)
+        cropped_samples = sum(end - start for start, end in crops)
+        if cropped_samples >= n_samples:
+            return None
+        self.log(f"Filtering {cropped_samples / n_samples:.1%} of the signal ({len(crops)} intervals)")
+        return crops
 
-                    segments = []
-                    for i in range(0, len(idx), 2):
-                        start_idx = find_nearest_index(data.eeg.times, data.marks.conditions_times[idx[i]])
-                        end_idx = find_nearest_index(data.eeg.times, data.marks.conditions_times[idx[i + 1]])
-                        start_time, end_time = data.eeg.times[start_idx], data.eeg.times[end_idx]
-
-                        evt_idx = get_event_indices_in_range(data, evt_key, start_time, end_time)
-                        onsets = np.array(data.marks.events_times)[evt_idx]
-                        onsets_idx = find_nearest_index_array(data.eeg.times, onsets)
-
-                        epochs = medusa.get_epochs_of_events(data.eeg.times, current_signal, onsets_idx, fs, window,
-                                                             baseline_window, norm=norm_type)
-                        if epochs is not None:
-                            segments.append(epochs)
-
-                    epoched = np.concatenate(segments, axis=0) if segments else None
-
-                # Thresholding
-                if epoched is not None and thresholding:
-                    _, epoched, _ = medusa.artifact_removal.reject_noisy_epochs(
-                        epoched,
-                        np.nanmean(current_signal, axis=0),
-                        np.std(current_signal, axis=0),
-                        k=thres_k,
-                        n_samp=thres_samples,
-                        n_cha=thres_channels
-                    )
-
-                # Resample
-                if epoched is not None and resample:
-                    epoched = medusa.resample_epochs(epoched, window, resample_fs)
-
-                save_and_compute(epoched, cond, evt)
-
-    def compute_parameters(epoched, settings, fs, band):
-        """
-            Manages the computation of all the parameters
-        """
-        params = {}
-
-        # Basic statistics
-        stat_funcs = {
-            'mean': np.mean,
-            'variance': np.var,
-            'median': np.median,
-            'kurtosis': kurtosis,
-            'skewness': skew
-        }
-        axis = 0 if epoched.ndim == 2 else 1
-        avg = settings['segmentation']['average']
-        for name, func in stat_funcs.items():
-            if settings['parameters'].get(name, False):
-                val = func(epoched, axis=axis)
-                params[name] = np.mean(val, axis=0) if avg and epoched.ndim == 3 else val
-
-        # --- PSD de la banda actual (para abs_power, median_freq, entropy, etc.) ---
-        psd_enabled = settings['parameters'].get('psd', False)
-        needs_psd = any([
-            settings['parameters'].get(k, False)
-            for k in ['absolute_power', 'median_frequency', 'spectral_entropy']
-        ])
-        should_compute_psd = psd_enabled or needs_psd
-        if should_compute_psd:
-            if psd_enabled:
-                segment_pct, overlap_pct, window = (
-                    settings['parameters']['psd_segment_pct'],
-                    settings['parameters']['psd_overlap_pct'],
-                    settings['parameters']['psd_window']
-                )
-                fxx_band, psd_band = medusa.transforms.power_spectral_density(epoched, fs, segment_pct, overlap_pct,
-                                                                              window)
-            else:
-                fxx_band, psd_band = medusa.transforms.power_spectral_density(epoched, fs)
-
-            band_label = band if band is not None else "broadband"
-            params[f'psd_{band_label}'] = np.nanmean(psd_band, axis=0) if avg else psd_band
-            params[f'psd_freq_{band_label}'] = fxx_band
-
-        # --- PSD broadband (solo una vez, para relative power) ---
-        if settings['parameters'].get('relative_power', False):
-            bb = [settings['preprocessing']['broadband_min'], settings['preprocessing']['broadband_max']]
-
-            # Calcular PSD broadband (respetando configuración de psd_enabled)
-            if psd_enabled:
-                segment_pct, overlap_pct, window = (
-                    settings['parameters']['psd_segment_pct'],
-                    settings['parameters']['psd_overlap_pct'],
-                    settings['parameters']['psd_window']
-                )
-                fxx_bb, psd_bb = medusa.transforms.power_spectral_density(epoched, fs, segment_pct, overlap_pct, window)
-            else:
-                fxx_bb, psd_bb = medusa.transforms.power_spectral_density(epoched, fs)
-
-            # Normalizar PSD broadband
-            norm_psd = medusa.transforms.normalize_psd(psd_bb, bb, fxx_bb, norm='rel')
-            if band == 'broadband' or band is None:
-                params['norm_psd_broadband'] = norm_psd
-                params['psd_broadband'] = psd_bb
-                params['psd_freq_broadband'] = fxx_bb
-
-            # --- Calcular relative power ---
-            if settings['preprocessing'].get('band_segmentation', False):
-                # Caso 1: hubo band segmentation → usar bandas de preprocessing
-                selected_bands = settings['preprocessing'].get('selected_bands')
-                band_info = next((b for b in selected_bands if b.get("name") == band), None)
-                band_range = [band_info.get("min"), band_info.get("max")]
-                band_label = band
-                val = medusa.signal_metrics.band_power.band_power(norm_psd, fs, band_range)
-                params[f"relative_power_{band_label}"] = np.nanmean(val, axis=0) if avg else val
-            else:
-                # Caso 2: NO hubo band segmentation → usar solo la banda broadband completa
-                val = medusa.signal_metrics.band_power.band_power(norm_psd, fs, bb)
-                params["relative_power_broadband"] = np.nanmean(val, axis=0) if avg else val
-
-        # # RP
-        # if settings['parameters'].get('relative_power', False):
-        #     bb = [settings['parameters']['broadband_min'], settings['parameters']['broadband_max']]
-        #     if band == 'broadband' or band is None:
-        #         norm_psd = medusa.transforms.normalize_psd(psd, bb, fxx, norm='rel')
-        #         params['norm_psd'] = norm_psd
-        #         if settings['preprocessing'].get('band_segmentation', False) and (band == 'broadband'): # Band segmentation
-        #             for b in settings['preprocessing'].get('selected_bands'):
-        #                 val = medusa.signal_metrics.band_power.band_power(norm_psd, fs, [b.get('min'), b.get('max')])
-        #                 params[f"relative_power_{b.get('name', 'unknown')}"] = np.nanmean(val, axis=0) if avg else val
-        #         else:
-        #             for b in settings['parameters']['selected_rp_bands']:
-        #                 val = medusa.signal_metrics.band_power.band_power(norm_psd, fs, [b['min'], b['max']])
-        #                 params[f"relative_power_{b.get('name', 'unknown')}"] = np.nanmean(val, axis=0) if avg else val
-
-        # if settings['parameters'].get('relative_power', False) and (band == 'broadband' or band is None):
-        #     bb = [settings['parameters']['broadband_min'], settings['parameters']['broadband_max']]
-        #     norm_psd = medusa.transforms.normalize_psd(psd, bb, fxx, norm='rel')
-        #     params['norm_psd'] = norm_psd
-        #     for b in settings['parameters']['selected_rp_bands']:
-        #         val = medusa.signal_metrics.band_power.band_power(norm_psd, fs, [b['min'], b['max']])
-        #         params[f"relative_power_{b.get('name', 'unknown')}"] = np.nanmean(val, axis=0) if avg else val
-
-        metrics = {
-            "absolute_power": medusa.signal_metrics.band_power.band_power,
-            "median_frequency": medusa.signal_metrics.median_frequency.median_frequency,
-            "spectral_entropy": medusa.signal_metrics.shannon_spectral_entropy.shannon_spectral_entropy,
-        }
-
-        for metric_name, metric_func in metrics.items():
-            if settings['parameters'].get(metric_name, False):
-                if band is None or band == 'broadband':
-                    band_range = [
-                        settings['preprocessing']['broadband_min'],
-                        settings['preprocessing']['broadband_max']
-                    ]
-                    band_label = "broadband"
-                else:
-                    selected_bands = settings['preprocessing'].get('selected_bands')
-                    band_info = next((b for b in selected_bands if b.get("name") == band), None)
-                    band_range = [band_info.get("min"), band_info.get("max")]
-                    band_label = band
-
-                val = metric_func(psd_band, fs, band_range)
-                params[f"{metric_name}_{band_label}"] = np.nanmean(val, axis=0) if avg else val
-
-        # Nonlinear and connectivity
-        param_map = {
-            'ctm': lambda: medusa.signal_metrics.central_tendency.central_tendency_measure(epoched,
-                                                                                           settings['parameters'][
-                                                                                               'ctm_r']),
-            'sample_entropy': lambda: medusa.signal_metrics.sample_entropy.sample_entropy(epoched,
-                                                                                          settings['parameters'][
-                                                                                              'sample_entropy_m'],
-                                                                                          settings['parameters'][
-                                                                                              'sample_entropy_r']),
-            'multiscale_sample_entropy': lambda: medusa.signal_metrics.multiscale_entropy.multiscale_entropy(
-                epoched, settings['parameters']['multiscale_sample_entropy_scale'],
-                settings['parameters']['multiscale_sample_entropy_m'],
-                settings['parameters']['multiscale_sample_entropy_r']),
-            'lzc': lambda: medusa.signal_metrics.lempelziv_complexity.lempelziv_complexity(epoched),
-            'multiscale_lzc': lambda: medusa.signal_metrics.multiscale_lempelziv_complexity.multiscale_lempelziv_complexity(
-                epoched,
-                settings['parameters']['multiscale_lzc_scales']),
-            'iac': lambda: medusa.connectivity_metrics.iac(epoched, settings['parameters']['ort_iac']),
-            'aec': lambda: medusa.connectivity_metrics.aec(epoched, settings['parameters']['ort_aec']),
-            'plv': lambda: medusa.connectivity_metrics.plv(epoched),
-            'pli': lambda: medusa.connectivity_metrics.pli(epoched),
-            'wpli': lambda: medusa.connectivity_metrics.wpli(epoched),
-        }
-
-        for name, func in param_map.items():
-            if settings['parameters'].get(name, False):
-                val = func()
-                params[name] = np.nanmean(val, axis=0) if avg else val
-
-        return params
-
-    def save_outputs(data, base_name, suffix, key):
-        """
-            Stores the files according to the user selections
-        """
-        # Stores the preprocessed signals
-        if self.prepsignalsCBox.isChecked() and settings_dic['preprocessing'].get(
-                'apply_preprocessing') and key == 'prep':
-            output_dir = join(self.selected_folder, "Preprocessed_signals")
-            makedirs(output_dir, exist_ok=True)
-            output_path = join(output_dir, f"{base_name}_preprocessing_{suffix}.mat")
-            data.save_to_mat(output_path)
-            self.log_message(f"Preprocessed saved in: {output_path}")
-
-        # Stores the segmented signals
-        if self.segsignalsCBox.isChecked() and key == 'seg':
-            output_dir = join(self.selected_folder, "Segmented_signals")
-            makedirs(output_dir, exist_ok=True)
-            output_path = join(output_dir, f"{base_name}_{suffix}.mat")
-            savemat(output_path, {'epochs': data})
-            self.log_message(f"Segmentation saved in: {output_path}")
-
-        # Stores the parameters
-        if self.paramsignalsCBox.isChecked() and key == 'param':
-            output_dir = join(self.selected_folder, "Signal_parameters")
-            makedirs(output_dir, exist_ok=True)
-            self.log_message(f"Parameters: folder ready in {output_dir}")
-            output_path = join(output_dir, f"{base_name}_{suffix}.mat")
-            savemat(output_path, {'parameters': data})
-            self.log_message(f"Parameters saved in: {output_path}")
-
-    # Here is where run_pipeline begins
-
-    selected_files = settings_dic['preprocessing'].get('selected_files', [])
-    total_files = len(selected_files)
-
-    error_found = False
-    # For each file...
-    for i, file in enumerate(selected_files):
+    def process_file(self, file, file_idx, total_files):
+        """
+            Preprocesses, segments and computes the parameters of one file. Exceptions are propagated to the caller
+        """
+        settings_dic = self.settings_dic
+
+        # Variable definition
+        base_name = splitext(basename(file))[0]
+        data = self.load_recording(file)
+        current_signal = data.eeg.signal
+        fs = data.eeg.fs
+        if fs != settings_dic['preprocessing']['fs']:
+            raise Exception("One of the selected signals do not have the same sampling frequency: " + file)
+        band_seg = settings_dic['preprocessing'].get('band_segmentation', False)  #
+        segmentation_type = settings_dic['segmentation']['segmentation_type']
+        norm = settings_dic['segmentation']['norm'] or None
+        bands = settings_dic['preprocessing'].get('selected_bands', []) if band_seg else [
+            {'name': 'broadband', 'min': settings_dic['preprocessing']['broadband_min'],
+             'max': settings_dic['preprocessing']['broadband_max']}]
+        total_steps = total_files * len(bands)
+        # Marks lookup shared by all the bands
+        marks_index = MarksIndex.from_recording(data)
+
+        # For each band....
+        crops = self.get_crops(data, marks_index, fs, file)
+        if crops is not None:
+            processed_signals = cropped_band_signals(current_signal, fs, bands, settings_dic['preprocessing'], crops)
+        else:
+            processed_signals = band_signals(current_signal, fs, bands, settings_dic['preprocessing'])
+        # The band signals are generated lazily and only when they are needed (result cache misses)
+        processed_signals = iter(processed_signals)
+        n_generated = 0
+        cache = self.cache
+        file_key = cache.file_key(file) if cache is not None else None
+        store_prep = bool(settings_dic['preprocessing'].get('apply_preprocessing') and self.output_callback('prep'))
+        completed = False
         try:
-            # Logging: Preprocessing
-            self.log_message(f"Processing file: {file}")
-            self.progressLabel.setText(f"Processing: {basename(file)}")
-            QtWidgets.QApplication.processEvents()
-            # Variable definition
-            base_name = splitext(basename(file))[0]
-            data = medusa.components.Recording.load(file)
-            current_signal = data.eeg.signal
-            fs = data.eeg.fs
-            if fs != settings_dic['preprocessing']['fs']:
-                raise Exception("One of the selected signals do not have the same sampling frequency: " + file)
-            band_seg = settings_dic['preprocessing'].get('band_segmentation', False)  #
-            segmentation_type = settings_dic['segmentation']['segmentation_type']
-            norm = settings_dic['segmentation']['norm'] or None
-            bands = settings_dic['preprocessing'].get('selected_bands', []) if band_seg else [
-                {'name': 'broadband', 'min': settings_dic['preprocessing']['broadband_min'],
-                 'max': settings_dic['preprocessing']['broadband_max']}]
-            total_steps = total_files * len(bands)
-
-            # For each band....
             for j, band in enumerate(bands):
                 band_name = band.get('name', 'unknown')
-                bp_min, bp_max = band.get('min'), band.get('max')
-                if bp_max == settings_dic['preprocessing']['fs'] / 2:
-                    bp_max -= 1e-6
-                cfg = {**settings_dic['preprocessing']}
 
-                # Preprocessing
-                if settings_dic['preprocessing'].get('apply_preprocessing'):
-                    if band_seg:
-                        cfg.update({'bp_min': bp_min, 'bp_max': bp_max})
-                        signal_to_process = current_signal.copy()
+                # Resumed runs: units of this band that are not in the journal yet
+                pending_prep = store_prep and not self.is_done('prep', file, band_name)
+                pending_units = [unit for unit in self.segmentation_units()
+                                 if not self.is_done('seg', file, band_name, unit)]
+
+                # Result cache: the band signal is only needed if it must be stored or some results are not cached
+                band_key = cache.key('band', file_key, preprocessing_signature(settings_dic, band)) \
+                    if cache is not None else None
+                if cache is None:
+                    needs_signal = pending_prep or bool(pending_units)
+                else:
+                    needs_signal = pending_prep or not all(self.unit_cached(band_key, unit) for unit in pending_units)
+                processed_signal = None
+                if needs_signal:
+                    prep_key = cache.key('prep', band_key, crops) if cache is not None else None
+                    entry = cache.get(prep_key) if cache is not None else None
+                    if entry is not None:
+                        processed_signal = entry['signal']
                     else:
-                        signal_to_process = current_signal
-
-                    processed_signal = apply_preprocessing(signal_to_process, fs, cfg)
-                    data.eeg.signal = processed_signal
-                    save_outputs(deepcopy(data), base_name, band_name, 'prep')
-                else:  # If no preprocessing, apply only the band segmentation (if apply)
-                    if band_seg:
-                        processed_signal = band_segmentation(current_signal.copy(), bp_min, bp_max, fs, cfg)
+                        for _ in range(j - n_generated):
+                            next(processed_signals)
+                        processed_signal = next(processed_signals)
+                        n_generated = j + 1
+                        if cache is not None:
+                            cache.put(prep_key, {'signal': processed_signal})
+
+                # Preprocessing
+                if processed_signal is not None:
+                    if settings_dic['preprocessing'].get('apply_preprocessing'):
                         data.eeg.signal = processed_signal
-                    else:
-                        processed_signal = current_signal
+                        # The band signal is written from the recording as is (the stores do not modify it)
+                        if pending_prep:
+                            self.save_outputs(data, base_name, band_name, 'prep',
+                                              {'subject': base_name, 'band': band_name})
+                            self.mark_done('prep', file, band_name)
+                    elif band_seg:
+                        data.eeg.signal = processed_signal
+
+                # Multirate mode: the band-pass filtered signal is decimated to a rate safe for its band
+                band_fs, band_marks_index = fs, marks_index
+                factor = decimation_factor(fs, settings_dic['preprocessing'], band)
+                if factor > 1:
+                    band_fs, band_marks_index = fs / factor, marks_index.decimated(factor)
+                    if processed_signal is not None:
+                        processed_signal = np.ascontiguousarray(processed_signal[::factor])
+                        self.log(f"Band {band_name}: decimated by {factor} ({band_fs:g} Hz)")
+
+                # Thresholding statistics, shared by all the conditions and events of this band
+                thres_stats = None
+                if settings_dic['segmentation'].get('thresholding') and processed_signal is not None:
+                    thres_stats = signal_statistics(processed_signal,
+                                                    settings_dic['segmentation'].get('thres_chunk_samples'))
 
                 # Segmentation and parameter's computation
                 if segmentation_type == 'condition':
-                    segment_by_condition(data, processed_signal, settings_dic, base_name, norm,
-                                         band=band_name if band_seg else None)
+                    self.segment_by_condition(data, processed_signal, base_name, norm, band_fs,
+                                              band=band_name if band_seg else None, marks_index=band_marks_index,
+                                              thres_stats=thres_stats, band_key=band_key, file=file)
                 elif segmentation_type == 'event':
-                    segment_by_event(data, processed_signal, settings_dic, base_name, norm, fs,
-                                     band=band_name if band_seg else None)
-
-                # Update the progress bar and labels
-                global_progress = int(((i * len(bands) + j + 1) / total_steps) * 100)
-                self.progressBar.setValue(global_progress)
-
-        # Exception handling
-        except Exception as e:
-            error_found = True
-            self.log_message(f"Error preprocessing {file}: {e}", style='error')
-    return not error_found
\ No newline at end of file
+                    self.segment_by_event(data, processed_signal, base_name, norm, band_fs,
+                                          band=band_name if band_seg else None, marks_index=band_marks_index,
+                                          thres_stats=thres_stats, band_key=band_key, file=file)
+
+                # Update the progress
+                global_progress = int(((file_idx * len(bands) + j + 1) / total_steps) * 100)
+                self.notify_progress(global_progress, file)
+                if self.is_cancelled():
+                    break
+            else:
+                completed = True
+        finally:
+            # The outputs of the finished units are written even if the file fails or the run is cancelled
+            write_errors = self.flush_outputs(base_name)
+        if write_errors:
+            raise IOError(f"{len(write_errors)} outputs could not be written")
+        if completed:
+            self.mark_done('file', file)
+
+        if cache is not None:
+            cache.evict()
+
+    def run(self):
+        """
+            Runs the pipeline for all the selected files. Returns True if no error was found
+        """
+        selected_files = self.settings_dic['preprocessing'].get('selected_files', [])
+        # The outputs are named after the subject, so files with the same name would overwrite each other
+        duplicates = duplicate_subjects(selected_files)
+        if duplicates:
+            for subject, files in duplicates.items():
+                self.log(f"Several files have the same name ({subject}), so their outputs would overwrite each other: "
+                         f"{', '.join(files)}. Rename them before running the pipeline", style='error')
+            return False
+        if self.journal is None:
+            outputs = {key: bool(self.output_callback(key)) for key in OUTPUT_KEYS}
+            try:
+                self.journal = RunJournal(self.output_folder, self.settings_dic,
+                                          {**outputs, 'format': self.output_format}, resume=self.resume)
+            except ValueError as e:
+                self.log(str(e), style='error')
+                return False
+        completed = [file for file in selected_files if self.is_done('file', file)]
+        if completed:
+            self.log(f"Resuming the run: {len(completed)} of {len(selected_files)} files were already processed")
+            selected_files = [file for file in selected_files if not self.is_done('file', file)]
+        checked_files = self.check_recordings(selected_files)
+        mismatch_found = len(checked_files) < len(selected_files)
+        try:
+            if self.output_format == 'hdf5':
+                # Staging stores of an interrupted parallel run (their units are already in the journal)
+                for path in glob(join(self.output_folder, ".staging_*.h5")):
+                    self.output_store().merge(path)
+            if self.n_workers > 1 and len(checked_files) > 1:
+                success = self.run_parallel(checked_files)
+            else:
+                success = self.run_serial(checked_files)
+            return success and not mismatch_found
+        finally:
+            self.close_store()
+
+    def run_serial(self, selected_files):
+        """
+            Runs the pipeline for the files in this process. Returns True if no error was found
+        """
+        total_files = len(selected_files)
+        if self.n_workers > 1:
+            # One pool for the whole run, used to compute the parameters. Its processes are spawned instead of forked,
+            # so they do not inherit the state of the background writer and prefetcher threads
+            self.executor = ProcessPoolExecutor(max_workers=self.n_workers, mp_context=get_context('spawn'))
+        if self.prefetch and total_files > 1 and self.sidecar_dir is not None:
+            # Loading a sidecar only reads its header and maps its signals, so there is nothing to load in advance
+            self.log("Prefetching disabled: the recordings are memory-mapped from their sidecars")
+        elif self.prefetch and total_files > 1:
+            self.prefetcher = RecordingPrefetcher(selected_files, self.prefetch, self.prefetch_bytes)
+
+        error_found = False
+        try:
+            # For each file...
+            for i, file in enumerate(selected_files):
+                if self.is_cancelled():
+                    break
+                try:
+                    # Logging: Preprocessing
+                    self.log(f"Processing file: {file}")
+                    self.notify_progress(int(i / total_files * 100), file)
+                    self.process_file(file, i, total_files)
+
+                # Exception handling
+                except Exception as e:
+                    error_found = True
+                    self.log(f"Error preprocessing {file}: {e}", style='error')
+        finally:
+            if self.prefetcher is not None:
+                self.prefetcher.close()
+                self.prefetcher = None
+            if self.executor is not None:
+                self.executor.shutdown()
+                self.executor = None
+
+        if self.is_cancelled():
+            self.log("The run has been cancelled by the user", style='warning')
+            return False
+        return not error_found
+
+    def run_parallel(self, selected_files):
+        """
+            Runs the pipeline distributing the files among a pool of worker processes. Returns True if no error was
+            found
+        """
+        total_files = len(selected_files)
+        # Callbacks cannot be sent to the workers, so the output selection is resolved here
+        outputs = {key: bool(self.output_callback(key)) for key in OUTPUT_KEYS}
+        n_workers = min(self.n_workers, total_files)
+        self.log(f"Processing {total_files} files with {n_workers} workers")
+
+        # A single HDF5 store cannot be written by several processes: each worker writes its file to a staging
+        # store, which is merged into the store of the run when the file is finished
+        staging = {file: join(self.output_folder, f".staging_{i}_{splitext(basename(file))[0]}.h5")
+                   if self.output_format == 'hdf5' else None for i, file in enumerate(selected_files)}
+
+        error_found, cancelled = False, False
+        # The workers are spawned instead of forked: the pool can be started from a thread (e.g., the GUI worker) of
+        # a process with other threads running
+        context = get_context('spawn')
+        with context.Manager() as manager, ProcessPoolExecutor(max_workers=n_workers, mp_context=context) as executor:
+            # Shared with the workers, which stop after the current band when it is set
+            cancel_event = manager.Event()
+            futures = {executor.submit(_process_file_worker, self.settings_dic, self.output_folder, outputs, file,
+                                       self.cache, self.journal, self.output_format, staging[file],
+                                       self.async_writes, self.write_buffer_bytes, self.sidecar_dir, cancel_event):
+                       file for file in selected_files}
+            pending, n_done = set(futures), 0
+            while pending:
+                # The cancellation is checked periodically, not only when a file is finished
+                done, pending = wait(pending, timeout=CANCEL_POLL_SECONDS, return_when=FIRST_COMPLETED)
+                if self.is_cancelled() and not cancelled:
+                    # The pending files are discarded and the running ones stop after their current band
+                    cancelled = True
+                    cancel_event.set()
+                    for future in pending:
+                        future.cancel()
+                    self.log("The run has been cancelled by the user. Waiting for the running files to stop...",
+                             style='warning')
+                for future in done:
+                    n_done += 1
+                    if future.cancelled():
+                        continue
+                    file = futures[future]
+                    try:
+                        messages, error = future.result()
+                    except Exception as e:  # The worker process died
+                        messages, error = [], str(e)
+                    for msg, style in messages:
+                        self.log(msg, style=style)
+                    if staging[file] is not None:
+                        try:
+                            self.output_store().merge(staging[file])
+                        except Exception as e:
+                            error = error or f"the outputs could not be merged into {HDF5_STORE_NAME}: {e}"
+                    if error is not None:
+                        error_found = True
+                        self.log(f"Error preprocessing {file}: {error}", style='error')
+                    self.notify_progress(int(n_done / total_files * 100), file)
+        return not (error_found or cancelled)
+
+
+def _process_file_worker(settings_dic, output_folder, outputs, file, cache=None, journal=None, output_format='mat',
+                         store_path=None, async_writes=True, write_buffer_bytes=DEFAULT_WRITE_BUFFER_BYTES,
+                         sidecar_dir=None, cancel_event=None):
+    """
+        Processes one file in a worker process. The log messages are stored and returned with the error (if any), so
+        the main process can merge them into its log. cancel_event (a multiprocessing.Manager Event) cancels the run
+        after the current band
+    """
+    messages = []
+    engine = PipelineEngine(settings_dic, output_folder,
+                            log_callback=lambda msg, style=None: messages.append((msg, style)),
+                            output_callback=lambda key: outputs[key], cache=cache, journal=journal,
+                            output_format=output_format, store_path=store_path, async_writes=async_writes,
+                            write_buffer_bytes=write_buffer_bytes, sidecar_dir=sidecar_dir,
+                            cancel_callback=cancel_event.is_set if cancel_event is not None else None)
+    messages.append((f"Processing file: {file}", None))
+    try:
+        engine.process_file(file, 0, 1)
+    except Exception as e:
+        return messages, str(e)
+    finally:
+        engine.close_store()
+    return messages, None
+
+
+def run_pipeline(settings_dic, output_folder, log_callback=None, progress_callback=None, output_callback=None,
+                 cancel_callback=None, n_workers=1, cache=None, resume=False, output_format='mat', async_writes=True,
+                 write_buffer_bytes=DEFAULT_WRITE_BUFFER_BYTES, prefetch=DEFAULT_PREFETCH_DEPTH,
+                 prefetch_bytes=DEFAULT_PREFETCH_BYTES, sidecar_dir=None):
+    """
+        Runs all the tasks defined in settings_dic and stores the results in output_folder. See PipelineEngine for
+        the description of the callbacks, n_workers, cache, resume, output_format, the background writes, the
+        prefetching and the sidecars. Returns
+        True if no error was found and the run was not cancelled.
+    """
+    engine = PipelineEngine(settings_dic, output_folder, log_callback=log_callback,
+                            progress_callback=progress_callback, output_callback=output_callback,
+                            cancel_callback=cancel_callback, n_workers=n_workers, cache=cache, resume=resume,
+                            output_format=output_format, async_writes=async_writes,
+                            write_buffer_bytes=write_buffer_bytes, prefetch=prefetch, prefetch_bytes=prefetch_bytes,
+                            sidecar_dir=sidecar_dir)
+    return engine.run()
+
+
+def load_settings(json_path):
+    """
+        Loads the settings dictionary stored by SaveWidget ("settings.json")
+    """
+    with open(json_path, "r") as f:
+        settings_dic = json.load(f)
+    for key in ("preprocessing", "segmentation", "parameters"):
+        if key not in settings_dic:
+            raise ValueError(f"The settings file {json_path} has no '{key}' section")
+    return settings_dic
+
+
+def main(argv=None):
+    """
+        Command line entry point. Runs the pipeline without GUI
+    """
+    parser = argparse.ArgumentParser(description="Runs the MEDUSA Analyzer pipeline without GUI.")
+    parser.add_argument("settings", help="Path to the settings.json file created by MEDUSA Analyzer")
+    parser.add_argument("output_folder", help="Folder where the results will be saved")
+    parser.add_argument("--files", nargs="+", default=None,
+                        help="Files to process. By default, the selected files in the settings are used")
+    parser.add_argument("--no-prep", action="store_true", help="Do not store the preprocessed signals")
+    parser.add_argument("--no-seg", action="store_true", help="Do not store the segmented signals")
+    parser.add_argument("--no-params", action="store_true", help="Do not store the signal parameters")
+    parser.add_argument("--features", action="store_true", help="Also store the cohort feature table")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of worker processes (one file per worker). Use 0 to use all the CPU cores")
+    parser.add_argument("--cache", nargs="?", const=DEFAULT_CACHE_DIR, default=None, metavar="FOLDER",
+                        help="Reuse the results of previous runs stored in the result cache (default folder: "
+                             f"{DEFAULT_CACHE_DIR})")
+    parser.add_argument("--cache-size", type=float, default=DEFAULT_MAX_BYTES / 1024 ** 3,
+                        help="Maximum size of the result cache in GB. The least recently used results are removed")
+    parser.add_argument("--clear-cache", action="store_true", help="Remove all the results of the cache before the run")
+    parser.add_argument("--format", choices=OUTPUT_FORMATS, default='mat',
+                        help="Output layout: one .mat file per output (mat), one HDF5 store per run (hdf5) or one HDF5 "
+                             "store per subject (hdf5-subject)")
+    parser.add_argument("--sync-writes", action="store_true",
+                        help="Write each output before continuing, instead of writing them in the background")
+    parser.add_argument("--write-buffer", type=float, default=DEFAULT_WRITE_BUFFER_BYTES / 1024 ** 2,
+                        help="Maximum size in MB of the outputs waiting to be written in the background")
+    parser.add_argument("--prefetch", type=int, default=DEFAULT_PREFETCH_DEPTH,
+                        help="Number of recordings loaded in advance while the current one is processed (0 to disable)")
+    parser.add_argument("--prefetch-size", type=float, default=DEFAULT_PREFETCH_BYTES / 1024 ** 3,
+                        help="Maximum total size in GB of the files of the recordings loaded in advance")
+    parser.add_argument("--sidecar-dir", nargs="?", const=DEFAULT_SIDECAR_DIR, default=None, metavar="FOLDER",
+                        help="Load the .bson recordings from memory-mapped copies (sidecars), created the first time "
+                             f"they are loaded (default folder: {DEFAULT_SIDECAR_DIR})")
+    parser.add_argument("--clear-sidecars", action="store_true",
+                        help="Remove all the sidecars of the recordings before the run")
+    parser.add_argument("--resume", action="store_true",
+                        help="Continue an interrupted run in output_folder, skipping the results already stored")
+    parser.add_argument("--quiet", action="store_true", help="Only log errors")
+    args = parser.parse_args(argv)
+
+    settings_dic = load_settings(args.settings)
+    if args.files is not None:
+        settings_dic['preprocessing']['selected_files'] = args.files
+
+    disabled = {'prep': args.no_prep, 'seg': args.no_seg, 'param': args.no_params, 'features': not args.features}
+
+    def log_callback(msg, style=None):
+        if not args.quiet or style == 'error':
+            print_log(msg, style)
+
+    cache = None
+    if args.cache is not None or args.clear_cache:
+        cache = ResultCache(args.cache or DEFAULT_CACHE_DIR, int(args.cache_size * 1024 ** 3))
+        if args.clear_cache:
+            cache.clear()
+            log_callback(f"Result cache cleared: {cache.folder}")
+        if args.cache is None:
+            cache = None
+    if args.clear_sidecars:
+        sidecar_dir = args.sidecar_dir or DEFAULT_SIDECAR_DIR
+        clear_sidecars(sidecar_dir)
+        log_callback(f"Recording sidecars cleared: {sidecar_dir}")
+
+    success = run_pipeline(settings_dic, args.output_folder, log_callback=log_callback,
+                           output_callback=lambda key: not disabled[key], n_workers=args.workers, cache=cache,
+                           resume=args.resume, output_format=args.format, async_writes=not args.sync_writes,
+                           write_buffer_bytes=int(args.write_buffer * 1024 ** 2), prefetch=args.prefetch,
+                           prefetch_bytes=int(args.prefetch_size * 1024 ** 3),
+                           sidecar_dir=args.sidecar_dir)
+    return 0 if success else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,113 @@
+"""
+    Zero-copy epoching. The sliding-window epochs of a signal are returned as read-only strided views into the signal,
+    so overlapping epochs do not duplicate the samples. The stages that need to write (normalization, resampling,
+    thresholding) create new arrays, as they already do in medusa. The epochs of several segments are kept as one view
+    per segment (EpochSegments) instead of being concatenated, and they are only gathered in a single array when they
+    are written to an output.
+"""
+import numpy as np
+import medusa
+
+
+def get_epochs_view(signal, epochs_length, stride=None):
+    """
+        Read-only view [n_epochs x epochs_length x n_channels] with the sliding-window epochs of the signal
+        [n_samples x n_channels]. The epochs are the same as medusa.get_epochs (without normalization), but the
+        singleton dimensions are kept
+    """
+    if stride is None:
+        stride = epochs_length
+    if stride <= 0:
+        raise ValueError('Parameter stride must be None or greater than 0')
+    epochs_length, stride = int(epochs_length), int(stride)
+    signal = np.asarray(signal)
+    view = np.lib.stride_tricks.sliding_window_view(signal, epochs_length, axis=0)[::stride]
+    # sliding_window_view puts the window axis last: [n_epochs x n_channels x epochs_length]
+    return np.swapaxes(view, 1, 2)
+
+
+class EpochSegments:
+    """
+        Epochs [n_epochs x epochs_length x n_channels] of several segments of a signal, kept as one array (e.g., a
+        read-only view into the signal) per segment. They are the same epochs as the concatenation of the segments
+        along the first axis, without copying them. The per-epoch stages (normalization, thresholding, resampling) are
+        applied to each segment with map, and the parameters are computed per segment (see
+        core_process.compute_parameters). Use array() to get the concatenated epochs
+    """
+
+    def __init__(self, segments):
+        self.segments = list(segments)
+
+    def __len__(self):
+        return self.n_epochs
+
+    def __iter__(self):
+        return iter(self.segments)
+
+    @property
+    def n_epochs(self):
+        return sum(len(segment) for segment in self.segments)
+
+    @property
+    def shape(self):
+        return (self.n_epochs,) + self.segments[0].shape[1:]
+
+    @property
+    def ndim(self):
+        return self.segments[0].ndim
+
+    def first_epoch(self):
+        """
+            First epoch [epochs_length x n_channels] of the whole set
+        """
+        return next(segment[0] for segment in self.segments if len(segment))
+
+    def map(self, func):
+        """
+            Applies func (a per-epoch stage that takes and returns [n_epochs x epochs_length x n_channels]) to each
+            segment. The segments left without epochs are dropped. If none of them keeps any epoch, returns the
+            concatenated (empty) result, as if func had been applied to the concatenated epochs
+        """
+        segments = [func(segment) for segment in self.segments]
+        kept = [segment for segment in segments if len(segment)]
+        if not kept:
+            return np.concatenate(segments, axis=0)
+        return EpochSegments(kept)
+
+    def array(self):
+        """
+            Concatenated epochs (a copy)
+        """
+        return np.concatenate(self.segments, axis=0)
+
+
+def materialize(epochs):
+    """
+        Epochs as a single array (EpochSegments are concatenated, arrays are returned as they are)
+    """
+    return epochs.array() if isinstance(epochs, EpochSegments) else epochs
+
+
+def get_segments_epochs(signal, segments, epochs_length, stride=None, norm=None):
+    """
+        Sliding-window epochs of several segments ([start, end) sample indices) of the signal. Same epochs as calling
+        medusa.get_epochs for each segment and concatenating them. If there is only one segment, the result is a
+        read-only view into the signal (zero-copy). With several segments, the result is an EpochSegments with one
+        view per segment, so the epochs are not copied. Only when the concatenation would lose some dimension in the
+        squeeze of medusa.get_epochs (a single channel, sample or epoch), the epochs are concatenated into an array.
+        Normalization creates a new array per segment. Returns None if there are no segments
+    """
+    views = [get_epochs_view(signal[start:end], epochs_length, stride) for start, end in segments]
+    if not views:
+        return None
+    if norm is not None:
+        views = [medusa.epoching.normalize_epochs(view, norm=norm) for view in views]
+    if len(views) > 1:
+        epochs = EpochSegments(views)
+        if min(epochs.shape) > 1:
+            return epochs
+        epochs = epochs.array()
+    else:
+        epochs = views[0]
+    # Same output dimensions as medusa.get_epochs
+    return epochs.squeeze()
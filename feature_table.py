@@ -0,0 +1,159 @@
+"""
+    Cohort feature table. The parameters computed by the pipeline are also written as a tidy columnar table with one
+    row per (subject, band, condition, event, epoch, channel[, channel2], metric) and its value, so group-level
+    statistics over the whole cohort are a single scan of the table instead of reloading every parameters file.
+
+    The table is a folder with one part per processed file, written when the file is finished (Parquet if pyarrow is
+    installed, otherwise compressed .npz with the same columns). Parts are only appended, so the table grows
+    incrementally during the run and the parallel workers write their own parts. Use read_feature_table to load it.
+"""
+import os
+from os.path import join, exists
+import numpy as np
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:  # Optional dependency: the parts are stored as .npz without it
+    pyarrow = None
+
+FEATURE_TABLE_FOLDER = "Feature_table"
+COLUMNS = ('subject', 'band', 'condition', 'event', 'epoch', 'channel', 'channel2', 'metric', 'value')
+
+# Axes of the values of each parameter after the epochs axis (the rest of parameters have one value per channel)
+FEATURE_AXES = {
+    'multiscale_sample_entropy': ('scale', 'channel'),
+    'multiscale_lzc': ('scale', 'channel'),
+    'aec': ('channel', 'channel2'),
+    'plv': ('channel', 'channel2'),
+    'pli': ('channel', 'channel2'),
+    'wpli': ('channel', 'channel2'),
+}
+# Outputs that are not scalar features (spectra and time-resolved connectivity) are not added to the table
+EXCLUDED_OUTPUTS = ('psd_', 'norm_psd_', 'iac')
+
+
+def parameter_rows(name, value, channels=None, scales=None, averaged=False):
+    """
+        Columns (dict of arrays) of the rows of one parameter. The leading axes of the value (if any) are the epochs.
+        If averaged is True, the value has no epochs axis and epoch is -1. The scales of the multiscale parameters are
+        added to the metric name. Returns None if the value does not have the expected axes
+    """
+    axes = FEATURE_AXES.get(name, ('channel',))
+    value = np.asarray(value, dtype=float)
+    if averaged:
+        value = value[None]
+    if value.ndim < len(axes):
+        return None
+    feature_shape = value.shape[value.ndim - len(axes):]
+    value = value.reshape((-1,) + feature_shape)
+    index = np.indices(value.shape).reshape(value.ndim, -1)
+    n_channels = value.shape[-1]
+    labels = np.array(channels if channels is not None and len(channels) == n_channels
+                      else [str(i) for i in range(n_channels)], dtype=str)
+    columns = {
+        'epoch': np.full(index.shape[1], -1, dtype=np.int32) if averaged else index[0].astype(np.int32),
+        'channel': labels[index[axes.index('channel') + 1]],
+        'channel2': labels[index[axes.index('channel2') + 1]] if 'channel2' in axes
+        else np.full(index.shape[1], '', dtype=str),
+        'value': value.ravel(),
+    }
+    if 'scale' in axes:
+        n_scales = value.shape[axes.index('scale') + 1]
+        scale_values = np.asarray(scales if scales is not None and len(scales) == n_scales
+                                  else np.arange(1, n_scales + 1))
+        columns['metric'] = np.char.add(f"{name}_", scale_values[index[axes.index('scale') + 1]].astype(str))
+    else:
+        columns['metric'] = np.full(index.shape[1], name)
+    return columns
+
+
+class FeatureTable:
+    """
+        Rows of the feature table of the current file. Use add for each set of parameters and flush when the file
+        is finished to write its part
+    """
+
+    def __init__(self, output_folder, settings_dic, log):
+        self.folder = join(output_folder, FEATURE_TABLE_FOLDER)
+        self.settings_dic = settings_dic
+        self.log = log
+        self.parts = []
+
+    def scales(self, name):
+        """
+            Scales of the multiscale parameters
+        """
+        params = self.settings_dic['parameters']
+        if name == 'multiscale_lzc':
+            return params.get('multiscale_lzc_scales')
+        if name == 'multiscale_sample_entropy' and params.get('multiscale_sample_entropy_scale'):
+            return list(range(1, int(params['multiscale_sample_entropy_scale']) + 1))
+        return None
+
+    def add(self, params, location, channels=None, averaged=False):
+        """
+            Adds the rows of the parameters (output of compute_parameters) of one location (dict with subject, band,
+            condition and event). channels are the channel labels. If averaged is True, the values have no epochs
+            axis
+        """
+        for name, value in params.items():
+            if name.startswith(EXCLUDED_OUTPUTS):
+                continue
+            rows = parameter_rows(name, value, channels, self.scales(name), averaged)
+            if rows is None:
+                continue
+            n_rows = rows['value'].shape[0]
+            for column in ('subject', 'band', 'condition', 'event'):
+                label = location.get(column)
+                rows[column] = np.full(n_rows, '' if label is None else str(label))
+            self.parts.append(rows)
+
+    def flush(self, name):
+        """
+            Writes the rows added since the last flush as a new part of the table. Returns the path of the part, or
+            None if there were no rows
+        """
+        if not self.parts:
+            return None
+        columns = {column: np.concatenate([part[column] for part in self.parts]) for column in COLUMNS}
+        self.parts = []
+        os.makedirs(self.folder, exist_ok=True)
+        extension = 'parquet' if pyarrow is not None else 'npz'
+        index = 0
+        while exists(join(self.folder, f"{name}_{index:03d}.{extension}")):
+            index += 1
+        path = join(self.folder, f"{name}_{index:03d}.{extension}")
+        tmp_path = f"{path}.tmp"
+        if pyarrow is not None:
+            table = pyarrow.table({column: columns[column] for column in COLUMNS})
+            pyarrow.parquet.write_table(table, tmp_path, compression='zstd')
+        else:
+            with open(tmp_path, 'wb') as f:
+                np.savez_compressed(f, **columns)
+        # Readers never see partially written parts
+        os.replace(tmp_path, path)
+        self.log(f"Feature table updated: {path}")
+        return path
+
+
+def read_feature_table(output_folder, columns=None):
+    """
+        Loads the feature table of a run (output folder or Feature_table folder) as a pandas DataFrame. If columns is
+        given, only those columns are read
+    """
+    import pandas as pd
+    folder = output_folder if os.path.basename(os.path.normpath(output_folder)) == FEATURE_TABLE_FOLDER \
+        else join(output_folder, FEATURE_TABLE_FOLDER)
+    names = sorted(name for name in os.listdir(folder) if name.endswith(('.parquet', '.npz')))
+    frames = []
+    for name in names:
+        path = join(folder, name)
+        if name.endswith('.parquet'):
+            frames.append(pd.read_parquet(path, columns=list(columns) if columns is not None else None))
+        else:
+            with np.load(path, allow_pickle=False) as part:
+                frames.append(pd.DataFrame({column: part[column] for column in (columns or COLUMNS)}))
+    if not frames:
+        return pd.DataFrame(columns=list(columns or COLUMNS))
+    return pd.concat(frames, ignore_index=True)
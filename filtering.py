@@ -0,0 +1,135 @@
+"""
+    Filtering utilities of the processing engine. FIR filters are designed once per (order, band, type, window, fs)
+    and reused for all the files and bands of a run. High-order filters are applied with FFT (overlap-add)
+    convolution, which gives the same result as the direct forward-backward filtering (filtfilt). Several bands of
+    the same recording can be obtained from one shared FFT with filter_bank.
+"""
+from functools import lru_cache
+import numpy as np
+from scipy import signal as scipy_signal
+from scipy import fft as scipy_fft
+import medusa
+
+# Maximum number of designed filters kept in memory. Interactive sessions that change the settings between runs
+# only keep the most recently used ones
+FILTER_CACHE_SIZE = 32
+
+# Minimum number of coefficients for which FFT convolution is faster than direct filtering
+FFT_MIN_TAPS = 32
+
+
+@lru_cache(maxsize=FILTER_CACHE_SIZE)
+def _design_fir_filter(order, cutoff, btype, window, fs):
+    """
+        Designs (fits) a FIR filter. Use get_fir_filter, which normalizes the arguments of the cache key
+    """
+    fir_filter = medusa.FIRFilter(order, list(cutoff), btype, window=window)
+    fir_filter.fit(fs)
+    return fir_filter
+
+
+def get_fir_filter(order, cutoff, btype, window, fs):
+    """
+        Returns a fitted medusa.FIRFilter. Filters are memoized in a process-wide LRU cache, so the kernel is only
+        designed the first time it is requested
+    """
+    return _design_fir_filter(int(order), tuple(float(c) for c in cutoff), btype, window, float(fs))
+
+
+def odd_extension(signal, padlen):
+    """
+        Extends the signal [n_samples x ...] at both ends with padlen samples using odd extension (the same padding
+        applied by scipy.signal.filtfilt)
+    """
+    left = 2 * signal[:1] - signal[padlen:0:-1]
+    right = 2 * signal[-1:] - signal[-2:-padlen - 2:-1]
+    return np.concatenate((left, signal, right), axis=0)
+
+
+def zero_phase_kernel(b):
+    """
+        Impulse response of the forward-backward filtering with the FIR coefficients b
+    """
+    return np.convolve(b, b[::-1])
+
+
+def use_fft_filtering(n_taps, n_samples, method='auto'):
+    """
+        Chooses between direct and FFT convolution from the kernel and signal lengths. The signal must be longer than
+        the padding of filtfilt (3 * n_taps); otherwise, the direct method reports the error
+    """
+    if n_samples <= 3 * n_taps or method == 'direct':
+        return False
+    return method == 'fft' or n_taps >= FFT_MIN_TAPS
+
+
+def filtfilt_fft(b, signal):
+    """
+        Zero-phase FIR filtering along the first axis using overlap-add FFT convolution. The signal is padded as in
+        scipy.signal.filtfilt and convolved with the forward-backward kernel, so both methods match within numerical
+        precision
+    """
+    padlen = 3 * len(b)
+    kernel = zero_phase_kernel(b)
+    kernel = kernel.reshape((-1,) + (1,) * (signal.ndim - 1))
+    filtered = scipy_signal.oaconvolve(odd_extension(signal, padlen), kernel, mode='same', axes=0)
+    return filtered[padlen:-padlen]
+
+
+def fir_filter(signal, fs, order, cutoff, btype, window='hamming', method='auto'):
+    """
+        Filters the signal [n_samples x n_channels] with a (cached) zero-phase FIR filter. Method can be 'direct'
+        (medusa.FIRFilter), 'fft' or 'auto', which chooses the fastest one from the kernel and signal lengths
+    """
+    fitted_filter = get_fir_filter(order, cutoff, btype, window, fs)
+    signal = np.asarray(signal)
+    if use_fft_filtering(len(fitted_filter.b), signal.shape[0], method):
+        return filtfilt_fft(fitted_filter.b, signal)
+    return fitted_filter.transform(signal)
+
+
+def filter_bank(signal, fs, cutoffs, order, window='hamming', btype='bandpass'):
+    """
+        Applies one zero-phase FIR filter per cutoff (e.g., [[1, 4], [4, 8], ...]) to the signal [n_samples x
+        n_channels]. The padded signal is transformed to the frequency domain only once and the filtered signals are
+        yielded lazily, in the same order as cutoffs, so only one of them needs to be in memory at a time. The results
+        match fir_filter within numerical precision.
+    """
+    signal = np.asarray(signal)
+    fitted_filters = [get_fir_filter(order, cutoff, btype, window, fs) for cutoff in cutoffs]
+    n_taps = len(fitted_filters[0].b) if fitted_filters else 0
+    n_samples = signal.shape[0]
+    if not use_fft_filtering(n_taps, n_samples, 'fft'):
+        for fitted_filter in fitted_filters:
+            yield fitted_filter.transform(signal)
+        return
+
+    # Shared spectrum of the padded signal. The FFT length avoids circular aliasing of the linear convolution
+    padlen = 3 * n_taps
+    kernel_len = 2 * n_taps - 1
+    padded = odd_extension(signal, padlen)
+    n_fft = scipy_fft.next_fast_len(padded.shape[0] + kernel_len - 1, real=True)
+    spectrum = scipy_fft.rfft(padded, n_fft, axis=0)
+    del padded
+
+    # First sample of the filtered signal in the full convolution ('same' alignment plus the padding)
+    start = (kernel_len - 1) // 2 + padlen
+    shape = (-1,) + (1,) * (signal.ndim - 1)
+    for fitted_filter in fitted_filters:
+        kernel_spectrum = scipy_fft.rfft(zero_phase_kernel(fitted_filter.b), n_fft)
+        filtered = scipy_fft.irfft(spectrum * kernel_spectrum.reshape(shape), n_fft, axis=0)
+        yield filtered[start:start + n_samples]
+
+
+def clear_filter_cache():
+    """
+        Removes all the designed filters from the cache
+    """
+    _design_fir_filter.cache_clear()
+
+
+def filter_cache_info():
+    """
+        Returns the hits, misses and size of the filters cache
+    """
+    return _design_fir_filter.cache_info()
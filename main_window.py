@@ -106,6 +106,7 @@ class MainWindow(QtWidgets.QMainWindow, ui_main_window):
         self.update_ui()
 
         self.preproc_widget.band_config_changed.connect(self.parameters_widget.reset_relative_power)
+        self.preproc_widget.band_config_changed.connect(self.parameters_widget.reset_spectral_bands)
 
     def go_next(self):
         """
@@ -413,6 +414,13 @@ class MainWindow(QtWidgets.QMainWindow, ui_main_window):
     def _warn(self, title, message):
         QtWidgets.QMessageBox.warning(self, title, message)
 
+    def closeEvent(self, event):
+        # The pipeline thread must finish before its widgets are destroyed: the window is closed again when it stops
+        if self.save_widget.stop_pipeline():
+            event.ignore()
+            return
+        super().closeEvent(event)
+
 
 if __name__ == "__main__":
     app = QApplication(sys.argv)
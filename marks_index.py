@@ -0,0 +1,131 @@
+"""
+    Index of the marks (conditions and events) of a recording, used for segmentation. It is built once per recording:
+    the time vector is checked to be sorted (and uniform) and the marks are grouped by label, so each lookup costs
+    O(log N) (or O(1) for uniform time vectors) instead of rebuilding and scanning the arrays.
+"""
+import numpy as np
+
+
+class MarksIndex:
+    """
+        Lookup of samples and marks of one recording. The results are the same as the exhaustive search: the nearest
+        sample to a time is the first one with the minimum distance, and the marks are returned in their original
+        order
+    """
+
+    def __init__(self, times, conditions_labels=None, conditions_times=None, events_labels=None, events_times=None):
+        self.times = np.asarray(times)
+        diffs = np.diff(self.times)
+        self.sorted = self.times.size < 2 or bool(np.all(diffs >= 0))
+        # Uniform time vectors: the nearest sample is estimated with the sampling period and refined locally
+        self.uniform = self.sorted and self.times.size > 2 and bool(np.allclose(diffs, diffs[0], rtol=1e-6, atol=0)) \
+            and diffs[0] > 0
+        self.period = diffs[0] if self.uniform else None
+
+        self.conditions_labels = conditions_labels
+        self.conditions_times = np.asarray(conditions_times if conditions_times is not None else [])
+        self.conditions_by_label = self._group(conditions_labels)
+        self.events_labels = events_labels
+        self.events_times = np.asarray(events_times if events_times is not None else [])
+        self.events_by_label = self._group(events_labels)
+        # Positions of the events of each label sorted by time (for range queries)
+        self.events_by_time = {label: pos[np.argsort(self.events_times[pos], kind='stable')]
+                               for label, pos in self.events_by_label.items()}
+
+    @classmethod
+    def from_recording(cls, data):
+        """
+            Builds the index of a medusa Recording (data.eeg.times and data.marks)
+        """
+        marks = getattr(data, 'marks', None)
+        return cls(data.eeg.times,
+                   getattr(marks, 'conditions_labels', None), getattr(marks, 'conditions_times', None),
+                   getattr(marks, 'events_labels', None), getattr(marks, 'events_times', None))
+
+    def decimated(self, factor):
+        """
+            Index of the same marks for the signal decimated by factor (one of every factor samples is kept)
+        """
+        if factor == 1:
+            return self
+        return MarksIndex(self.times[::factor], self.conditions_labels, self.conditions_times, self.events_labels,
+                          self.events_times)
+
+    @staticmethod
+    def _group(labels):
+        """
+            Dict {label: positions} with the positions of each label in ascending order
+        """
+        labels = np.asarray(labels if labels is not None else [])
+        if labels.size == 0:
+            return {}
+        order = np.argsort(labels, kind='stable')
+        unique, starts = np.unique(labels[order], return_index=True)
+        return {label: positions for label, positions in zip(unique.tolist(), np.split(order, starts[1:]))}
+
+    def nearest_index(self, time):
+        """
+            Index of the sample nearest to time (same result as np.argmin(np.abs(times - time)))
+        """
+        n = self.times.size
+        if not self.sorted:
+            return int(np.abs(self.times - time).argmin())
+        pos = None
+        if self.uniform:
+            # Insertion point computed from the sampling period. It is checked against the neighbouring samples, so
+            # rounding errors fall back to the binary search
+            guess = int(np.clip(np.floor((time - self.times[0]) / self.period) + 1, 0, n))
+            if (guess == 0 or self.times[guess - 1] < time) and (guess == n or self.times[guess] >= time):
+                pos = guess
+        if pos is None:
+            pos = int(np.searchsorted(self.times, time))
+        candidates = np.arange(max(pos - 1, 0), min(pos + 1, n))
+        nearest = candidates[np.abs(self.times[candidates] - time).argmin()]
+        # argmin returns the first sample with the minimum distance (repeated times)
+        return int(np.searchsorted(self.times, self.times[nearest], side='left'))
+
+    def nearest_times(self, query_times):
+        """
+            Time of the nearest sample to each query time (same result as find_nearest_index_array)
+        """
+        query_times = np.asarray(query_times)
+        indices = np.clip(np.searchsorted(self.times, query_times), 1, len(self.times) - 1)
+        left = self.times[indices - 1]
+        right = self.times[indices]
+        return np.where(np.abs(query_times - left) < np.abs(query_times - right), left, right)
+
+    def condition_positions(self, label):
+        """
+            Positions of the condition marks with the given label
+        """
+        return self.conditions_by_label.get(label, np.array([], dtype=int))
+
+    def condition_samples(self, label):
+        """
+            List of (start, end) sample indices of the condition segments with the given label. Returns None if the
+            condition does not have an even number of marks (start and end of all the segments)
+        """
+        positions = self.condition_positions(label)
+        if len(positions) % 2 != 0:
+            return None
+        bounds = [self.nearest_index(t) for t in self.conditions_times[positions]]
+        return list(zip(bounds[0::2], bounds[1::2]))
+
+    def event_positions(self, label, start_time=None, end_time=None):
+        """
+            Positions of the event marks with the given label. If start_time and end_time are given, only the events
+            within [start_time, end_time] are returned
+        """
+        if start_time is None and end_time is None:
+            return self.events_by_label.get(label, np.array([], dtype=int))
+        by_time = self.events_by_time.get(label, np.array([], dtype=int))
+        times = self.events_times[by_time]
+        first = np.searchsorted(times, start_time, side='left') if start_time is not None else 0
+        last = np.searchsorted(times, end_time, side='right') if end_time is not None else len(times)
+        return np.sort(by_time[first:last])
+
+    def event_times(self, label, start_time=None, end_time=None):
+        """
+            Times of the event marks with the given label (optionally within [start_time, end_time])
+        """
+        return self.events_times[self.event_positions(label, start_time, end_time)]
@@ -0,0 +1,256 @@
+"""
+    Nonlinear utilities of the processing engine. Sample entropy is computed by counting the template matches with a
+    KD-tree (Chebyshev distance) instead of computing all the pairwise distances, which gives the same values as
+    medusa.signal_metrics.sample_entropy with much lower time and memory costs. The coarse-grained series and the
+    entropies of each scale are computed once per set of epochs and shared by sample entropy and multiscale entropy.
+    Lempel-Ziv complexity (LZC) and multiscale LZC binarize all the epochs and channels at once and parse the binary
+    sequences in one batch, which can be distributed among the processes of an executor shared by the whole run.
+"""
+import warnings
+import numpy as np
+from scipy.signal import decimate
+from scipy.spatial import cKDTree
+
+# Available backends: 'fast' (KD-tree template matching) and 'reference' (medusa implementation)
+ENTROPY_METHODS = ('fast', 'reference')
+
+
+def count_matches(series, m, tolerance):
+    """
+        Number of pairs of templates of length m (i < j) of the 1D series whose Chebyshev distance is lower than or
+        equal to the tolerance
+    """
+    n_templates = series.shape[0] - m + 1
+    templates = np.lib.stride_tricks.sliding_window_view(series, m)[:n_templates]
+    tree = cKDTree(templates)
+    # count_neighbors counts the ordered pairs, including each template with itself
+    return (tree.count_neighbors(tree, tolerance, p=np.inf) - n_templates) // 2
+
+
+def fast_sample_entropy(signal, m, r):
+    """
+        Sample entropy [n_epochs x n_channels] of the signal [n_epochs x n_samples x n_channels]. Same definition as
+        medusa.signal_metrics.sample_entropy (Chebyshev distance, tolerance r times the standard deviation of the
+        first epoch)
+    """
+    signal = np.asarray(signal, dtype=float)
+    if signal.ndim == 1:
+        signal = signal[:, None]
+    if signal.ndim == 2:
+        signal = signal[None]
+    n_epochs, n_samples, n_channels = signal.shape
+    if m > n_samples:
+        raise ValueError('Embedding dimension must be smaller than the signal length (m<N).')
+
+    sigma = np.std(signal, axis=1)
+    value = np.empty((n_epochs, n_channels))
+    for e_idx in range(n_epochs):
+        for ch_idx in range(n_channels):
+            tolerance = sigma[0, ch_idx] * r
+            series = signal[e_idx, :, ch_idx]
+            b = count_matches(series, m, tolerance)
+            a = count_matches(series, m + 1, tolerance) if b > 0 else 0
+            if a == 0 or b == 0:
+                value[e_idx, ch_idx] = -np.log(2 / ((n_samples - m - 2) * (n_samples - m - 1)))
+            else:
+                value[e_idx, ch_idx] = -np.log((a / b) * ((n_samples - m) / (n_samples - m - 2)))
+    return value
+
+
+class EntropyCache:
+    """
+        Cache of the coarse-grained series and sample entropies of one set of epochs. Each scale is coarse-grained
+        only once and each (scale, m, r) entropy is computed only once, so the scales shared by sample entropy and
+        multiscale entropy (e.g., scale 1) are not computed again. It must be created for each set of epochs (e.g.,
+        in each call to compute_parameters). If the epochs are a part of a larger set (e.g., one segment), reference
+        is the first epoch of the whole set [n_samples x n_channels], whose standard deviation sets the tolerance of
+        the sample entropy as if it was computed for the whole set
+    """
+
+    def __init__(self, epoched, method='fast', reference=None):
+        if method not in ENTROPY_METHODS:
+            raise ValueError(f"Unknown sample entropy method '{method}'. Available: {', '.join(ENTROPY_METHODS)}")
+        # The reference epoch is computed as the first one and its values are dropped
+        self.skip = 0 if reference is None else 1
+        self.epoched = epoched if reference is None else np.concatenate([np.asarray(reference)[None], epoched])
+        self.method = method
+        self.coarse = {}
+        self.entropies = {}
+
+    def coarse_grained(self, scale):
+        """
+            Coarse-grained series of the epochs, as in medusa.signal_metrics.multiscale_entropy (decimation)
+        """
+        if scale not in self.coarse:
+            self.coarse[scale] = self.epoched if scale == 1 else decimate(self.epoched, scale, axis=1)
+        return self.coarse[scale]
+
+    def sample_entropy(self, m, r, scale=1):
+        """
+            Sample entropy [n_epochs x n_channels] of the given scale
+        """
+        key = (scale, m, r)
+        if key not in self.entropies:
+            if self.method == 'fast':
+                self.entropies[key] = fast_sample_entropy(self.coarse_grained(scale), m, r)
+            else:
+                # The reference backends are only imported when they are used
+                from medusa.signal_metrics import sample_entropy
+                self.entropies[key] = sample_entropy.sample_entropy(self.coarse_grained(scale), m, r)
+        return self.entropies[key][self.skip:]
+
+    def multiscale_entropy(self, max_scale, m, r):
+        """
+            Multiscale entropy [n_epochs x max_scale x n_channels]
+        """
+        if self.method == 'reference':
+            from medusa.signal_metrics import multiscale_entropy
+            value = multiscale_entropy.multiscale_entropy(self.epoched, max_scale, m, r)
+            return value[self.skip:]
+        return np.stack([self.sample_entropy(m, r, scale) for scale in range(1, max_scale + 1)], axis=1)
+
+
+def lempel_ziv(sequence):
+    """
+        Lempel-Ziv complexity (Kaspar & Schuster algorithm) of a binary sequence given as bytes. Each component is
+        the shortest substring that has not been seen before (overlaps allowed), and it is searched with bytes.find
+        instead of comparing symbol by symbol. Same values as the LZ algorithm of medusa.signal_metrics
+    """
+    n = len(sequence)
+    c, l = 1, 1
+    while l < n:
+        length = 1
+        # Grow the component while it can be copied from a position before l
+        while sequence.find(sequence[l:l + length], 0, l + length - 1) != -1:
+            if l + length >= n:
+                return (c + 1) * (np.log2(n) / n)
+            length += 1
+        c += 1
+        l += length
+    return c * (np.log2(n) / n)
+
+
+def lempel_ziv_batch(binarized, executor=None, n_workers=None):
+    """
+        Lempel-Ziv complexity of each series of the binarized array [n_epochs x n_samples x n_channels]. Returns
+        [n_epochs x n_channels]. If executor (a concurrent.futures.ProcessPoolExecutor) is given, the sequences are
+        parsed by its processes. n_workers is the number of processes of executor (by default, its max_workers)
+    """
+    n_epochs, _, n_channels = binarized.shape
+    sequences = [np.ascontiguousarray(binarized[e_idx, :, ch_idx]).tobytes()
+                 for e_idx in range(n_epochs) for ch_idx in range(n_channels)]
+    if executor is not None and len(sequences) > 1:
+        if n_workers is None:
+            n_workers = getattr(executor, '_max_workers', None) or 1
+        # About four chunks per process, so the processes are balanced without sending each sequence on its own
+        chunksize = max(1, len(sequences) // (4 * n_workers))
+        values = list(executor.map(lempel_ziv, sequences, chunksize=chunksize))
+    else:
+        values = [lempel_ziv(sequence) for sequence in sequences]
+    return np.array(values).reshape(n_epochs, n_channels)
+
+
+def median_binarization(epoched):
+    """
+        Binarizes each series of the epochs [n_epochs x n_samples x n_channels] with its median, as in
+        medusa.signal_metrics.lempelziv_complexity
+    """
+    return (epoched >= np.median(epoched, axis=1, keepdims=True)).astype(np.uint8)
+
+
+def largest_window(scales):
+    """
+        Window that sets the length of the binarized series of the multiscale LZC: the largest scale plus the step
+        between scales, as in medusa. With a single scale there is no step, so the series are not shortened
+    """
+    if len(scales) == 1:
+        return scales[0]
+    return scales[-1] + (scales[1] - scales[0])
+
+
+def multiscale_binarization(epoched, w_length, w_max):
+    """
+        Binarizes the epochs [n_epochs x n_samples x n_channels] with a moving median of width w_length, as in
+        medusa.signal_metrics.multiscale_lempelziv_complexity. The signals are shortened according to the largest
+        window (w_max) so all the scales have the same length
+    """
+    if w_length % 2 == 0:
+        raise ValueError('Width of window must be an odd value.')
+    n_samples = epoched.shape[1]
+    half_wind = (w_length - 1) // 2
+    length_diff = w_max - w_length
+    trim = length_diff // 2
+    # Moving median. As in medusa, the window of each sample spans [samp - half_wind, samp + half_wind)
+    n_windows = n_samples - w_length + 1
+    smoothed = np.empty((epoched.shape[0], n_windows, epoched.shape[2]))
+    with warnings.catch_warnings():
+        # With w_length = 1 the windows are empty and the median is NaN (no sample is set to 1), as in medusa
+        warnings.simplefilter('ignore', RuntimeWarning)
+        for e_idx, epoch in enumerate(epoched):
+            windows = np.lib.stride_tricks.sliding_window_view(epoch, w_length - 1, axis=0)[:n_windows]
+            smoothed[e_idx] = np.median(windows, axis=-1)
+    smoothed = smoothed[:, trim:n_windows - trim]
+    shortened = epoched[:, half_wind:n_samples - half_wind][:, trim:n_windows - trim]
+    return (shortened >= smoothed).astype(np.uint8)
+
+
+class ComplexityCache:
+    """
+        Binarized series and Lempel-Ziv complexities of one set of epochs. Use prepare to parse all the sequences
+        needed by LZC and multiscale LZC in a single batch (distributed among the processes of executor, if given). It
+        must be created for each set of epochs (e.g., in each call to compute_parameters)
+    """
+
+    def __init__(self, epoched, executor=None):
+        epoched = np.asarray(epoched, dtype=float)
+        if epoched.ndim == 1:
+            epoched = epoched[:, None]
+        self.epoched = epoched[None] if epoched.ndim == 2 else epoched
+        self.executor = executor
+        self.complexities = {}
+
+    def binarized(self, w_length=None, w_max=None):
+        """
+            Median binarization (w_length None) or multiscale binarization with window w_length
+        """
+        if w_length is None:
+            return median_binarization(self.epoched)
+        return multiscale_binarization(self.epoched, w_length, w_max)
+
+    def prepare(self, lzc=False, scales=None):
+        """
+            Computes the LZC and/or the multiscale LZC of the given scales (window lengths) in one batch
+        """
+        keys = []
+        if lzc:
+            keys.append((None, None))
+        if scales:
+            w_max = largest_window(scales)
+            keys += [(w, w_max) for w in scales]
+        keys = [key for key in keys if key not in self.complexities]
+        if not keys:
+            return
+        binarized = [self.binarized(*key) for key in keys]
+        lengths = [b.shape[1] for b in binarized]
+        if len(set(lengths)) == 1:
+            # All the sequences have the same length, so they are parsed together
+            values = lempel_ziv_batch(np.concatenate(binarized, axis=2), self.executor)
+            values = np.split(values, len(keys), axis=1)
+        else:
+            values = [lempel_ziv_batch(b, self.executor) for b in binarized]
+        self.complexities.update(zip(keys, values))
+
+    def lempel_ziv_complexity(self):
+        """
+            LZC [n_epochs x n_channels]
+        """
+        self.prepare(lzc=True)
+        return self.complexities[(None, None)]
+
+    def multiscale_lempel_ziv_complexity(self, scales):
+        """
+            Multiscale LZC [n_epochs x n_scales x n_channels]
+        """
+        self.prepare(scales=scales)
+        w_max = largest_window(scales)
+        return np.stack([self.complexities[(w, w_max)] for w in scales], axis=1)
@@ -0,0 +1,380 @@
+"""
+    Output backends of the processing engine. The outputs of a run (preprocessed signals, segmented signals and
+    parameters) can be stored as one .mat file per file, band, condition (and event), which is the default layout, or
+    in a hierarchical HDF5 store (subject/band/condition/event) with chunked and compressed datasets. The HDF5 store
+    can be read partially (e.g., one parameter of all the subjects) without loading the rest of the results.
+
+    AsyncOutputWriter writes the outputs of any of the stores in a background thread, so the writes overlap with the
+    computation of the next condition or band.
+"""
+import os
+import copy
+import threading
+from collections import deque
+from os.path import join, exists
+import numpy as np
+from scipy.io import savemat
+
+try:
+    import h5py
+except ImportError:  # Optional dependency, only needed by the HDF5 backend
+    h5py = None
+
+# Available output formats: one .mat file per output, one HDF5 store per run or one HDF5 store per subject
+OUTPUT_FORMATS = ('mat', 'hdf5', 'hdf5-subject')
+HDF5_STORE_NAME = "results.h5"
+HDF5_SUBJECTS_FOLDER = "Results"
+# Maximum size of the outputs waiting to be written by AsyncOutputWriter
+DEFAULT_WRITE_BUFFER_BYTES = 512 * 1024 ** 2
+
+
+class MatOutputStore:
+    """
+        One .mat file per output, in the Preprocessed_signals, Segmented_signals and Signal_parameters folders
+    """
+
+    def __init__(self, output_folder, log):
+        self.output_folder = output_folder
+        self.log = log
+
+    def save(self, key, data, location, base_name, suffix):
+        # Stores the preprocessed signals
+        if key == 'prep':
+            output_dir = join(self.output_folder, "Preprocessed_signals")
+            makedirs(output_dir)
+            output_path = join(output_dir, f"{base_name}_preprocessing_{suffix}.mat")
+            savemat(output_path, recording_mat_dict(data))
+            self.log(f"Preprocessed saved in: {output_path}")
+
+        # Stores the segmented signals
+        if key == 'seg':
+            output_dir = join(self.output_folder, "Segmented_signals")
+            makedirs(output_dir)
+            output_path = join(output_dir, f"{base_name}_{suffix}.mat")
+            savemat(output_path, {'epochs': data})
+            self.log(f"Segmentation saved in: {output_path}")
+
+        # Stores the parameters
+        if key == 'param':
+            output_dir = join(self.output_folder, "Signal_parameters")
+            makedirs(output_dir)
+            self.log(f"Parameters: folder ready in {output_dir}")
+            output_path = join(output_dir, f"{base_name}_{suffix}.mat")
+            savemat(output_path, {'parameters': data})
+            self.log(f"Parameters saved in: {output_path}")
+
+    def close(self):
+        pass
+
+
+class HDF5OutputStore:
+    """
+        Hierarchical store of the outputs: /subject/band/preprocessed (signal, times), /subject/band/condition[/event]
+        /epochs and /subject/band/condition[/event]/parameters/name. Datasets are chunked and compressed. If
+        per_subject is True, each subject is stored in its own file (path is then the folder of the stores). Outputs
+        that already exist (e.g., resumed runs) are replaced. The file is flushed after each output, so an interrupted
+        run keeps the outputs stored so far
+    """
+
+    def __init__(self, path, log, per_subject=False, compression='gzip', compression_opts=4):
+        if h5py is None:
+            raise ImportError("The HDF5 output format requires h5py (pip install h5py)")
+        self.path = path
+        self.log = log
+        self.per_subject = per_subject
+        self.compression = compression
+        self.compression_opts = compression_opts
+        self.file = None
+        self.file_path = None
+
+    def store_path(self, subject):
+        return join(self.path, f"{subject}.h5") if self.per_subject else self.path
+
+    def open(self, subject):
+        """
+            Opens (in append mode) the store of the subject
+        """
+        path = self.store_path(subject)
+        if self.file is not None and self.file_path == path:
+            return self.file
+        self.close()
+        makedirs(os.path.dirname(path) or '.')
+        self.file = h5py.File(path, 'a')
+        self.file_path = path
+        return self.file
+
+    def group(self, location, *names):
+        """
+            Group of the location (dict with subject, band, condition and event), created if needed
+        """
+        parts = [location.get('subject'), location.get('band')]
+        if location.get('condition') is not None:
+            parts.append(location['condition'])
+        if location.get('event') is not None:
+            parts.append(location['event'])
+        parts += names
+        group = self.open(location.get('subject'))
+        for part in parts:
+            group = group.require_group(group_name(part))
+        return group
+
+    def write(self, group, name, value):
+        """
+            Writes one dataset, replacing it if it already exists. Arrays are chunked and compressed
+        """
+        name = group_name(name)
+        if name in group:
+            del group[name]
+        value = np.asarray(value)
+        if value.dtype.kind in 'US':
+            group.create_dataset(name, data=value.astype(h5py.string_dtype()))
+        elif value.ndim == 0 or value.size < 2:
+            group.create_dataset(name, data=value)
+        else:
+            group.create_dataset(name, data=value, chunks=True, compression=self.compression,
+                                 compression_opts=self.compression_opts, shuffle=True)
+
+    def save(self, key, data, location, base_name, suffix):
+        if key == 'prep':
+            group = self.group(location, 'preprocessed')
+            self.write(group, 'signal', data.eeg.signal)
+            self.write(group, 'times', data.eeg.times)
+            group.attrs['fs'] = data.eeg.fs
+            channel_set = getattr(data.eeg, 'channel_set', None)
+            if getattr(channel_set, 'l_cha', None) is not None:
+                self.write(group, 'channels', np.array(channel_set.l_cha, dtype=str))
+            self.log(f"Preprocessed saved in: {self.file_path}:{group.name}")
+        elif key == 'seg':
+            group = self.group(location)
+            self.write(group, 'epochs', data)
+            self.log(f"Segmentation saved in: {self.file_path}:{group.name}/epochs")
+        elif key == 'param':
+            group = self.group(location, 'parameters')
+            for name, value in data.items():
+                self.write(group, name, value)
+            self.log(f"Parameters saved in: {self.file_path}:{group.name}")
+        self.file.flush()
+
+    def merge(self, path):
+        """
+            Copies the subjects stored in the file path (e.g., written by a worker process) into this store and
+            removes it
+        """
+        if not exists(path):
+            return
+        with h5py.File(path, 'r') as source:
+            for subject in source:
+                merge_group(source[subject], self.open(subject).require_group(subject))
+                self.file.flush()
+        os.remove(path)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+        self.file = None
+        self.file_path = None
+
+
+def recording_mat_dict(recording):
+    """
+        Contents of the .mat file of a recording, the same as Recording.save_to_mat. It is built without modifying
+        the recording (save_to_mat replaces its attributes with serializable copies) and the arrays (e.g., the
+        preprocessed signal) are written directly instead of being converted to lists
+    """
+    return serializable(recording)
+
+
+def serializable(obj):
+    """
+        Copy of the containers of obj (objects are converted to dicts of their attributes) with None replaced by
+        'null', as scipy.io.savemat cannot store None. Arrays and other values are not copied
+    """
+    if obj is None:
+        return 'null'
+    if isinstance(obj, np.ndarray):
+        return obj
+    if isinstance(obj, dict):
+        return {k: serializable(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [serializable(v) for v in obj]
+    if hasattr(obj, '__dict__'):
+        return serializable(vars(obj))
+    return obj
+
+
+class AsyncOutputWriter:
+    """
+        Writes the outputs of store in a background thread. save returns as soon as the output is queued, so the
+        computation continues while the previous outputs are written. The queue is bounded: if the outputs waiting to
+        be written exceed max_bytes, save blocks until there is room (an output larger than max_bytes is accepted when
+        the queue is empty). The outputs are written in order. The errors of the writes are collected and returned by
+        flush, so the caller decides how to report them. Call close at the end of the run
+    """
+
+    def __init__(self, store, max_bytes=DEFAULT_WRITE_BUFFER_BYTES):
+        self.store = store
+        self.max_bytes = max_bytes
+        self.queue = deque()
+        self.queued_bytes = 0
+        self.errors = []
+        self.closed = False
+        self.condition = threading.Condition()
+        self.thread = None
+
+    def save(self, key, data, location, base_name, suffix):
+        """
+            Queues one output (same arguments as the save method of the stores)
+        """
+        if key == 'prep':
+            # The recording is reused by the next band: its current signal is kept in a snapshot
+            data = recording_snapshot(data)
+        size = payload_bytes(data)
+        with self.condition:
+            if self.closed:
+                raise RuntimeError("The output writer is closed")
+            # Backpressure: waits until the queued outputs are written
+            while self.queue and self.queued_bytes + size > self.max_bytes:
+                self.condition.wait()
+            self.queue.append((size, (key, data, location, base_name, suffix)))
+            self.queued_bytes += size
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.write_loop, name="output-writer", daemon=True)
+                self.thread.start()
+            self.condition.notify_all()
+
+    def write_loop(self):
+        """
+            Writes the queued outputs until the writer is closed. An output is removed from the queue (and its size
+            released) when it has been written
+        """
+        while True:
+            with self.condition:
+                while not self.queue and not self.closed:
+                    self.condition.wait()
+                if not self.queue:
+                    return
+                size, args = self.queue[0]
+            try:
+                self.store.save(*args)
+            except Exception as e:
+                key, _, _, base_name, suffix = args
+                with self.condition:
+                    self.errors.append(f"{key} output of {base_name} ({suffix}): {e}")
+            with self.condition:
+                self.queue.popleft()
+                self.queued_bytes -= size
+                self.condition.notify_all()
+
+    def flush(self):
+        """
+            Waits until all the queued outputs are written. Returns the errors found since the last flush
+        """
+        with self.condition:
+            while self.queue:
+                self.condition.wait()
+            errors, self.errors = self.errors, []
+        return errors
+
+    def close(self):
+        """
+            Writes the queued outputs and stops the writer thread. Returns the errors found since the last flush. The
+            store is not closed
+        """
+        errors = self.flush()
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        return errors
+
+
+def recording_snapshot(recording):
+    """
+        Shallow copy of the recording and its EEG, so the signal that is being stored does not change if the EEG
+        signal of the recording is replaced afterwards. The arrays are not copied
+    """
+    snapshot = copy.copy(recording)
+    if getattr(recording, 'eeg', None) is not None:
+        snapshot.eeg = copy.copy(recording.eeg)
+    return snapshot
+
+
+def array_bytes(array):
+    """
+        Bytes of the buffer spanned by the array. For strided views (e.g., the overlapping epochs of epoch_views), this
+        is the part of the signal they read, which can be much smaller than nbytes (number of elements x item size)
+    """
+    if array.size == 0:
+        return 0
+    offsets = [(n - 1) * stride for n, stride in zip(array.shape, array.strides)]
+    span = sum(offset for offset in offsets if offset > 0) - sum(offset for offset in offsets if offset < 0)
+    return min(array.nbytes, span + array.itemsize)
+
+
+def payload_bytes(data):
+    """
+        Approximate size in bytes of the memory kept by an output (arrays, dicts of arrays or recordings) while it is
+        queued
+    """
+    if isinstance(data, np.ndarray):
+        return array_bytes(data)
+    if isinstance(data, dict):
+        return sum(payload_bytes(value) for value in data.values())
+    if getattr(data, 'eeg', None) is not None:
+        return payload_bytes(data.eeg.signal)
+    return 0
+
+
+def merge_group(source, destination):
+    """
+        Copies the datasets of the HDF5 group source into destination, replacing the existing ones and keeping the
+        rest (e.g., outputs of a resumed run)
+    """
+    destination.attrs.update(source.attrs)
+    for name, item in source.items():
+        if isinstance(item, h5py.Group):
+            merge_group(item, destination.require_group(name))
+        else:
+            if name in destination:
+                del destination[name]
+            source.copy(item, destination, name=name)
+
+
+def group_name(name):
+    """
+        Valid HDF5 name for a subject, band, condition, event or parameter
+    """
+    return str(name).replace('/', '_')
+
+
+def makedirs(folder):
+    os.makedirs(folder, exist_ok=True)
+
+
+def open_output_store(output_format, output_folder, log, path=None):
+    """
+        Creates the output backend of the format. path overrides the location of the HDF5 store (file, or folder of
+        the stores of each subject)
+    """
+    if output_format == 'mat':
+        return MatOutputStore(output_folder, log)
+    if output_format == 'hdf5':
+        return HDF5OutputStore(path or join(output_folder, HDF5_STORE_NAME), log)
+    if output_format == 'hdf5-subject':
+        return HDF5OutputStore(path or join(output_folder, HDF5_SUBJECTS_FOLDER), log, per_subject=True)
+    raise ValueError(f"Unknown output format '{output_format}'. Available: {', '.join(OUTPUT_FORMATS)}")
+
+
+def read_parameters(path, subject, band, condition, event=None, names=None):
+    """
+        Reads the parameters of one subject, band, condition (and event) from an HDF5 store. If names is given, only
+        those parameters are read
+    """
+    if h5py is None:
+        raise ImportError("Reading HDF5 stores requires h5py (pip install h5py)")
+    parts = [subject, band, condition] + ([event] if event is not None else []) + ['parameters']
+    with h5py.File(path, 'r') as f:
+        group = f['/'.join(group_name(p) for p in parts)]
+        return {name: group[name][()] for name in (names if names is not None else group)}
@@ -0,0 +1,308 @@
+"""
+    Loading of the recordings processed by the pipeline. RecordingPrefetcher loads the next recordings of a run in a
+    background thread while the current one is processed, so the time spent reading and decoding the files (e.g.,
+    large .rec.bson files on network shares) overlaps with the computation.
+
+    If a sidecar folder is given (they are disabled by default, as they take as much disk as the recordings), the
+    first time a .rec.bson recording is loaded, it is also converted to a sidecar: the signals and timestamps of
+    its biosignals as .npy files and the rest of the recording (metadata and marks) as a small BSON header. The next
+    loads only read the header and memory-map the signals, so only the samples that are used are read from disk.
+    The sidecars are keyed by the path, size and modification time of the recording: editing a recording creates a new
+    sidecar and removes the old one. The total size of the sidecars is capped: when a new sidecar is created, the least
+    recently loaded ones are removed.
+"""
+import hashlib
+import os
+import tempfile
+import threading
+from glob import glob
+from os.path import join, expanduser, abspath, exists
+import bson
+import numpy as np
+import medusa
+
+# Default look-ahead of the prefetcher: number of recordings and total size of their files
+DEFAULT_PREFETCH_DEPTH = 2
+DEFAULT_PREFETCH_BYTES = 2 * 1024 ** 3
+
+# Changes of the layout of the sidecars must increase the version, so the sidecars of previous versions are rebuilt
+SIDECAR_VERSION = 1
+DEFAULT_SIDECAR_DIR = join(expanduser('~'), '.medusa_analyzer', 'recordings')
+DEFAULT_SIDECAR_MAX_BYTES = 10 * 1024 ** 3
+# Arrays of the biosignals stored as .npy files
+SIDECAR_ARRAYS = ('signal', 'times')
+
+
+def load_recording(file, sidecar_dir=None, max_bytes=DEFAULT_SIDECAR_MAX_BYTES):
+    """
+        Loads the recording stored in file. If sidecar_dir is given, the .bson recordings are loaded from their
+        sidecar in that folder, which is created if needed (by default, the recording is loaded from the file). After
+        creating a sidecar, the least recently loaded ones are removed until the sidecars take less than max_bytes
+        (None to disable the limit)
+    """
+    if sidecar_dir is None or not file.endswith('.bson'):
+        return medusa.components.Recording.load(file)
+    prefix, key = sidecar_key(file)
+    header_path = join(sidecar_dir, f"{key}.header.bson")
+    if exists(header_path):
+        try:
+            return load_sidecar(sidecar_dir, key)
+        except Exception:
+            # Incomplete or corrupted sidecar (e.g., removed by another process): it is created again
+            pass
+    with open(file, 'rb') as f:
+        ser_obj_dict = bson.loads(f.read())
+    try:
+        write_sidecar(sidecar_dir, prefix, key, ser_obj_dict)
+    except OSError:  # Not writable sidecar folder: the recording is used without sidecar
+        return medusa.components.Recording.from_serializable_obj(ser_obj_dict)
+    # The new sidecar is used, so the signals are not copied again by the biosignal constructors
+    del ser_obj_dict
+    recording = load_sidecar(sidecar_dir, key)
+    evict_sidecars(sidecar_dir, max_bytes, keep=(key,))
+    return recording
+
+
+def sidecar_key(file):
+    """
+        Prefix (path of the recording) and key (path, size and modification time) of the sidecar of file
+    """
+    stat = os.stat(file)
+    prefix = hashlib.sha256(abspath(file).encode('utf-8')).hexdigest()[:16]
+    version = hashlib.sha256(f"{SIDECAR_VERSION}:{stat.st_size}:{stat.st_mtime_ns}".encode('utf-8')).hexdigest()[:16]
+    return prefix, f"{prefix}_{version}"
+
+
+def write_sidecar(sidecar_dir, prefix, key, ser_obj_dict):
+    """
+        Stores the serialized recording as a sidecar and removes the previous sidecars of the same recording. The
+        arrays are converted to numpy arrays in ser_obj_dict (as Recording.from_serializable_obj would do). The header
+        is written last, so a sidecar is only used when it is complete
+    """
+    os.makedirs(sidecar_dir, exist_ok=True)
+    for old in glob(join(sidecar_dir, f"{prefix}_*")):
+        if not os.path.basename(old).startswith(key):
+            try:
+                os.remove(old)
+            except OSError:
+                pass
+    header = dict(ser_obj_dict)
+    for biosignal in ser_obj_dict.get('biosignals', {}):
+        biosignal_dict = ser_obj_dict.get(biosignal)
+        if not isinstance(biosignal_dict, dict):
+            continue
+        header[biosignal] = dict(biosignal_dict)
+        for name in SIDECAR_ARRAYS:
+            if name not in biosignal_dict:
+                continue
+            biosignal_dict[name] = np.array(biosignal_dict[name])
+            atomic_write(join(sidecar_dir, f"{key}.{biosignal}.{name}.npy"),
+                         lambda f, array=biosignal_dict[name]: np.save(f, array))
+            # The header keeps the shape of the array, used to build the biosignal before mapping the array
+            header[biosignal][name] = None
+            header[biosignal][f"sidecar_{name}_shape"] = list(biosignal_dict[name].shape)
+    atomic_write(join(sidecar_dir, f"{key}.header.bson"), lambda f: f.write(bson.dumps(header)))
+
+
+def load_sidecar(sidecar_dir, key):
+    """
+        Recording stored in a sidecar. The arrays of the biosignals are memory-mapped (copy-on-write, so they can be
+        modified in memory without changing the sidecar)
+    """
+    header_path = join(sidecar_dir, f"{key}.header.bson")
+    with open(header_path, 'rb') as f:
+        ser_obj_dict = bson.loads(f.read())
+    try:
+        # The modification time of the header is the last use of the sidecar (see evict_sidecars)
+        os.utime(header_path)
+    except OSError:
+        pass
+    arrays = {}
+    for biosignal in ser_obj_dict.get('biosignals', {}):
+        biosignal_dict = ser_obj_dict.get(biosignal)
+        if not isinstance(biosignal_dict, dict):
+            continue
+        for name in SIDECAR_ARRAYS:
+            shape = biosignal_dict.pop(f"sidecar_{name}_shape", None)
+            if shape is None:
+                continue
+            arrays[(biosignal, name)] = np.load(join(sidecar_dir, f"{key}.{biosignal}.{name}.npy"), mmap_mode='c')
+            # Empty placeholder with the same number of channels: the biosignal constructor copies its arrays
+            biosignal_dict[name] = np.empty((0,) + tuple(shape[1:]))
+    recording = medusa.components.Recording.from_serializable_obj(ser_obj_dict)
+    for (biosignal, name), array in arrays.items():
+        setattr(getattr(recording, biosignal), name, array)
+    return recording
+
+
+def sidecar_entries(sidecar_dir):
+    """
+        List of (last use, size, paths) of the sidecars stored in sidecar_dir. The last use is the latest
+        modification time of its files (the header is touched when the sidecar is loaded), so the sidecars that are
+        being written are not the first ones to be removed
+    """
+    sidecars = {}
+    if sidecar_dir is None or not os.path.isdir(sidecar_dir):
+        return []
+    for entry in os.scandir(sidecar_dir):
+        if entry.name.endswith('.tmp') or not entry.is_file():
+            continue
+        try:
+            stat = entry.stat()
+        except OSError:  # Removed by another process
+            continue
+        key = entry.name.split('.')[0]
+        last_use, size, paths = sidecars.get(key, (0, 0, []))
+        if entry.name.endswith('.header.bson'):
+            paths.insert(0, entry.path)
+        else:
+            paths.append(entry.path)
+        sidecars[key] = (max(last_use, stat.st_mtime), size + stat.st_size, paths)
+    return list(sidecars.values())
+
+
+def sidecars_size(sidecar_dir):
+    return sum(size for _, size, _ in sidecar_entries(sidecar_dir))
+
+
+def evict_sidecars(sidecar_dir, max_bytes=DEFAULT_SIDECAR_MAX_BYTES, keep=()):
+    """
+        Removes the least recently loaded sidecars until the sidecars in sidecar_dir take less than max_bytes. The
+        sidecars whose key is in keep are not removed. Returns the number of removed sidecars
+    """
+    if sidecar_dir is None or max_bytes is None:
+        return 0
+    entries = sorted(sidecar_entries(sidecar_dir), key=lambda entry: entry[0])
+    total = sum(size for _, size, _ in entries)
+    removed = 0
+    for _, size, paths in entries:
+        if total <= max_bytes:
+            break
+        if os.path.basename(paths[0]).split('.')[0] in keep:
+            continue
+        # The header is removed first, so a sidecar that is partially removed is not used
+        for path in paths:
+            try:
+                os.remove(path)
+            except OSError:  # In use (memory-mapped on Windows) or removed by another process
+                pass
+        total -= size
+        removed += 1
+    return removed
+
+
+def clear_sidecars(sidecar_dir=DEFAULT_SIDECAR_DIR):
+    """
+        Removes all the sidecars stored in sidecar_dir. They are created again when the recordings are loaded
+    """
+    return evict_sidecars(sidecar_dir, 0)
+
+
+def atomic_write(path, write):
+    """
+        Writes a file with write(f) in a temporary file that is renamed to path when it is complete
+    """
+    fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            write(f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def file_size(file):
+    try:
+        return os.path.getsize(file)
+    except OSError:
+        return 0
+
+
+class RecordingPrefetcher:
+    """
+        Loads the recordings of files in order, in a background thread, ahead of the caller. At most depth recordings
+        are kept loaded and not requested yet, and the total size of their files (used as an estimation of their size
+        in memory) must be below max_bytes; a recording that does not fit is loaded when it is requested. Call get with
+        the files in the same order, and close at the end (the loaded recordings that were not requested are
+        discarded)
+    """
+
+    def __init__(self, files, depth=DEFAULT_PREFETCH_DEPTH, max_bytes=DEFAULT_PREFETCH_BYTES, loader=load_recording):
+        self.files = list(files)
+        self.depth = depth
+        self.max_bytes = max_bytes
+        self.loader = loader
+        # Loaded recordings: index -> (recording, exception, size)
+        self.ready = {}
+        self.ready_bytes = 0
+        # Index of the next file that will be requested
+        self.next_index = 0
+        self.closed = False
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.load_loop, name="recording-prefetcher", daemon=True)
+        self.thread.start()
+
+    def can_prefetch(self, index, size):
+        """
+            True if the recording index can be loaded now: it has been requested, or it fits in the look-ahead
+        """
+        if index < self.next_index:
+            return True
+        return len(self.ready) < self.depth and self.ready_bytes + size <= self.max_bytes
+
+    def load_loop(self):
+        for index, file in enumerate(self.files):
+            size = file_size(file)
+            with self.condition:
+                while not self.closed and not self.can_prefetch(index, size):
+                    self.condition.wait()
+                if self.closed:
+                    return
+            try:
+                entry = (self.loader(file), None, size)
+            except Exception as e:  # Raised when the recording is requested
+                entry = (None, e, size)
+            with self.condition:
+                if self.closed:
+                    return
+                self.ready[index] = entry
+                self.ready_bytes += size
+                self.condition.notify_all()
+
+    def get(self, file):
+        """
+            Returns the recording of file, waiting for it if it is being loaded. Exceptions of the load are raised
+            here. Files requested out of order are loaded directly
+        """
+        with self.condition:
+            index = self.next_index
+            if self.closed or index >= len(self.files) or self.files[index] != file:
+                index = None
+            else:
+                self.next_index += 1
+                self.condition.notify_all()
+                while index not in self.ready and not self.closed:
+                    self.condition.wait()
+                if index in self.ready:
+                    recording, exception, size = self.ready.pop(index)
+                    self.ready_bytes -= size
+                    self.condition.notify_all()
+                else:
+                    index = None
+        if index is None:
+            return self.loader(file)
+        if exception is not None:
+            raise exception
+        return recording
+
+    def close(self):
+        """
+            Stops the prefetching. A load in progress is finished in the background and discarded
+        """
+        with self.condition:
+            self.closed = True
+            self.ready = {}
+            self.ready_bytes = 0
+            self.condition.notify_all()
@@ -0,0 +1,280 @@
+"""
+    Header-only probe of the recordings. probe_recording reads the metadata of a recording (biosignals, sampling
+    frequency, channels, duration and the conditions and events of its marks) without loading its signals, so the
+    selected files can be checked (e.g., different sampling frequencies) in seconds, before they are processed.
+
+    The .bson recordings are probed from the header of their sidecar (if a sidecar folder is given, see
+    recording_loader) or, if they do not have one, scanning the BSON document of the file: the signals and timestamps
+    of the biosignals are not decoded. The elements of the timestamps are parsed (without decoding their values) to
+    count them, and the signals are skipped (seek instead of read), since they have one sample per timestamp.
+"""
+import io
+import struct
+from concurrent.futures import ThreadPoolExecutor
+from os.path import join, exists
+import bson
+import numpy as np
+from recording_loader import load_recording, sidecar_key, SIDECAR_ARRAYS
+
+# Size of the values of the BSON types with fixed size
+BSON_FIXED_SIZES = {0x01: 8, 0x07: 12, 0x08: 1, 0x09: 8, 0x0A: 0, 0x10: 4, 0x11: 8, 0x12: 8, 0x13: 16, 0x7F: 0,
+                    0xFF: 0}
+# Probes run concurrently: they mostly wait for the disk
+DEFAULT_PROBE_WORKERS = 8
+
+
+def probe_recording(file, sidecar_dir=None):
+    """
+        Metadata of the recording stored in file, without loading its signals. Returns a dict with the file, the
+        biosignals (name -> dict with class_name, module_name, fs, channels, n_cha, n_samples and duration in
+        seconds) and the names of the conditions and events of its marks. Recordings that are not .bson are loaded
+    """
+    if file.endswith('.bson'):
+        header_path = join(sidecar_dir, f"{sidecar_key(file)[1]}.header.bson") if sidecar_dir is not None else None
+        if header_path is not None and exists(header_path):
+            with open(header_path, 'rb') as f:
+                header = bson.loads(f.read())
+        else:
+            header = read_bson_header(file)
+    else:
+        header = recording_header(load_recording(file, sidecar_dir))
+    return recording_info(file, header)
+
+
+def probe_recordings(files, sidecar_dir=None, max_workers=DEFAULT_PROBE_WORKERS):
+    """
+        Probes the files concurrently. Returns a list with the probe of each file (see probe_recording), or the
+        exception raised by the probe
+    """
+    def probe(file):
+        try:
+            return probe_recording(file, sidecar_dir)
+        except Exception as e:
+            return e
+
+    files = list(files)
+    if len(files) <= 1:
+        return [probe(file) for file in files]
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(files))) as executor:
+        return list(executor.map(probe, files))
+
+
+def probe_duration(probe):
+    """
+        Duration in seconds of a probed recording (duration of its first biosignal), or 0 if it is unknown
+    """
+    if isinstance(probe, Exception) or not probe['biosignals']:
+        return 0
+    return next(iter(probe['biosignals'].values()))['duration'] or 0
+
+
+def recording_info(file, header):
+    """
+        Probe of a recording from its serialized header (the biosignal arrays replaced by their shapes)
+    """
+    biosignals = {}
+    for name, description in (header.get('biosignals') or {}).items():
+        biosignal = header.get(name) or {}
+        channel_set = biosignal.get('channel_set') or {}
+        channels = channel_set.get('l_cha')
+        fs = biosignal.get('fs')
+        shape = biosignal.get('sidecar_signal_shape') or biosignal.get('sidecar_times_shape') or [0]
+        biosignals[name] = {
+            'class_name': description.get('class_name'),
+            'module_name': description.get('module_name'),
+            'fs': fs,
+            'channels': channels,
+            'n_cha': channel_set.get('n_cha', len(channels) if channels is not None else None),
+            'n_samples': shape[0],
+            'duration': shape[0] / fs if fs else None,
+        }
+    marks = header.get('marks') or {}
+    return {
+        'file': file,
+        'biosignals': biosignals,
+        'conditions': marks_names(marks, 'conditions'),
+        'events': marks_names(marks, 'events'),
+    }
+
+
+def marks_names(marks, kind):
+    """
+        Names of the conditions or events (kind) that appear in the marks, in order of appearance
+    """
+    labels = marks.get(f"{kind}_labels") or []
+    names = {info.get('label'): name for name, info in
+             ((marks.get('app_settings') or {}).get(kind) or {}).items() if isinstance(info, dict)}
+    found = []
+    for label in labels:
+        name = names.get(label, str(label))
+        if name not in found:
+            found.append(name)
+    return found
+
+
+def recording_header(recording):
+    """
+        Serialized header (as stored in the sidecars) of a loaded recording
+    """
+    header = {'biosignals': recording.biosignals}
+    for name in recording.biosignals:
+        biosignal = getattr(recording, name)
+        channel_set = getattr(biosignal, 'channel_set', None)
+        header[name] = {
+            'fs': getattr(biosignal, 'fs', None),
+            'channel_set': vars(channel_set) if channel_set is not None and not isinstance(channel_set, dict)
+            else channel_set or {},
+            'sidecar_signal_shape': list(biosignal.signal.shape),
+        }
+    marks = getattr(recording, 'marks', None)
+    if marks is not None:
+        header['marks'] = vars(marks)
+    return header
+
+
+def read_bson_header(file):
+    """
+        Reads a BSON recording skipping the signals and timestamps of the biosignals, which are replaced by their
+        shapes (as in the headers of the sidecars)
+    """
+    with open(file, 'rb') as f:
+        return read_document(f, 0, scan_nested=True)
+
+
+def read_int32(f, position):
+    f.seek(position)
+    return struct.unpack('<i', f.read(4))[0]
+
+
+def read_cstring(f):
+    chars = bytearray()
+    while True:
+        char = f.read(1)
+        if not char or char == b'\x00':
+            return chars.decode('utf-8')
+        chars += char
+
+
+def value_size(f, element_type, position):
+    """
+        Size in bytes of the BSON value of element_type that starts at position
+    """
+    if element_type in BSON_FIXED_SIZES:
+        return BSON_FIXED_SIZES[element_type]
+    if element_type in (0x02, 0x0D, 0x0E):  # Strings: length and bytes
+        return 4 + read_int32(f, position)
+    if element_type in (0x03, 0x04, 0x0F):  # Documents, arrays and code with scope: total length
+        return read_int32(f, position)
+    if element_type == 0x05:  # Binary: length, subtype and bytes
+        return 5 + read_int32(f, position)
+    if element_type == 0x0C:  # DBPointer: string and ObjectId
+        return 4 + read_int32(f, position) + 12
+    if element_type == 0x0B:  # Regular expression: two strings
+        f.seek(position)
+        pattern, options = read_cstring(f), read_cstring(f)
+        return len(pattern.encode('utf-8')) + len(options.encode('utf-8')) + 2
+    raise ValueError(f"Unknown BSON type {element_type:#x}")
+
+
+def read_document(f, start, scan_nested=False):
+    """
+        Reads the BSON document that starts at start. The arrays named as SIDECAR_ARRAYS are skipped. If scan_nested
+        is True, the embedded documents (e.g., the biosignals) are read in the same way; otherwise they are decoded
+    """
+    end = start + read_int32(f, start)
+    document = {}
+    skipped = {}
+    position = start + 4
+    while position < end - 1:
+        f.seek(position)
+        element_type = f.read(1)[0]
+        name = read_cstring(f)
+        value_position = f.tell()
+        size = value_size(f, element_type, value_position)
+        if element_type == 0x03 and scan_nested:
+            document[name] = read_document(f, value_position)
+        elif element_type == 0x04 and name in SIDECAR_ARRAYS:
+            document[name] = None
+            skipped[name] = value_position
+        else:
+            f.seek(position)
+            element = f.read(value_position + size - position)
+            document.update(bson.loads(struct.pack('<i', len(element) + 5) + element + b'\x00'))
+        position = value_position + size
+    # The signal has one sample per timestamp: its length is only measured if there are no timestamps
+    if 'times' in skipped:
+        document['sidecar_times_shape'] = [array_length(f, skipped['times'])]
+    if 'signal' in skipped:
+        n_samples = document['sidecar_times_shape'][0] if 'times' in skipped else None
+        document['sidecar_signal_shape'] = array_shape(f, skipped['signal'], n_samples)
+    return document
+
+
+def array_length(f, start):
+    """
+        Number of elements of the BSON array that starts at start, parsing the length of each element. The elements
+        are read but not decoded. Arrays of fixed size values (e.g., numbers) are parsed at once (see
+        fixed_size_length); the elements of other arrays are walked one by one
+    """
+    size = read_int32(f, start)
+    f.seek(start + 4)
+    # Elements of the array, without its length and the null that ends it
+    body = f.read(size - 5)
+    if len(body) != size - 5:
+        raise ValueError(f"Truncated BSON array at {start}")
+    length = fixed_size_length(body)
+    if length is not None:
+        return length
+    elements = io.BytesIO(body)
+    length = 0
+    position = 0
+    while position < len(body):
+        # Type, key (null-terminated) and value
+        value_position = body.index(b'\x00', position + 1) + 1
+        position = value_position + value_size(elements, body[position], value_position)
+        length += 1
+    if position != len(body):
+        raise ValueError(f"Malformed BSON array at {start}")
+    return length
+
+
+def fixed_size_length(body):
+    """
+        Number of elements of the body of a BSON array whose elements have the fixed size type of the first one, or
+        None if it is not such an array. The keys of the elements are their indices, so the position of each element
+        is known from the length of the previous keys: the type and the end of the key of every element are checked
+    """
+    if not body or body[0] not in BSON_FIXED_SIZES:
+        return None
+    element_type, value_size_ = body[0], BSON_FIXED_SIZES[body[0]]
+    # Number of elements: keys with 1, 2, 3... digits until the body is filled
+    length, remaining, digits = 0, len(body), 1
+    while remaining > 0:
+        count = 10 if digits == 1 else 9 * 10 ** (digits - 1)
+        element_size = 2 + digits + value_size_
+        if remaining >= count * element_size:
+            length, remaining, digits = length + count, remaining - count * element_size, digits + 1
+        elif remaining % element_size:
+            return None
+        else:
+            length, remaining = length + remaining // element_size, 0
+    key_digits = np.searchsorted(10 ** np.arange(1, 19, dtype=np.int64), np.arange(length), side='right') + 1
+    starts = np.concatenate(([0], np.cumsum(2 + key_digits + value_size_)[:-1]))
+    data = np.frombuffer(body, dtype=np.uint8)
+    if np.any(data[starts] != element_type) or np.any(data[starts + 1 + key_digits] != 0):
+        return None
+    return length
+
+
+def array_shape(f, start, length=None):
+    """
+        Shape of the BSON array that starts at start: [n] or, if its elements are arrays (e.g., the samples of a
+        signal), [n, length of the first element]. If length is given, it is used as n
+    """
+    shape = [array_length(f, start) if length is None else length]
+    if shape[0] > 0:
+        f.seek(start + 4)
+        if f.read(1)[0] == 0x04:
+            read_cstring(f)
+            shape.append(array_length(f, f.tell()))
+    return shape
@@ -0,0 +1,176 @@
+"""
+    Persistent on-disk cache of the results of the pipeline, used for incremental re-runs. The entries (preprocessed
+    band signals, epochs and the outputs of each parameter) are content-addressed: the key is a hash of the contents
+    of the input file and of the settings that the result depends on. Changing one setting only invalidates the
+    results that depend on it, and editing a recording invalidates all of its results. The total size of the cache is
+    capped: the least recently used entries are evicted.
+"""
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from os.path import join, expanduser, isdir
+import numpy as np
+
+# Changes of the stored format or of the results of the pipeline must increase the version, so the entries of
+# previous versions are not used
+CACHE_VERSION = 1
+
+DEFAULT_CACHE_DIR = join(expanduser('~'), '.medusa_analyzer', 'cache')
+DEFAULT_MAX_BYTES = 5 * 1024 ** 3
+
+
+def file_digest(path, chunk_size=1 << 20):
+    """
+        SHA-256 of the contents of the file, read in chunks of chunk_size bytes
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _json_default(value):
+    """
+        Serialization of the numpy values of the settings for the cache keys
+    """
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    return str(value)
+
+
+class ResultCache:
+    """
+        Content-addressed cache of dicts of arrays, stored as .npz files in folder. Writes are atomic (temporary file
+        and rename), so several processes can share the same folder. The size is checked when evict is called (e.g.,
+        after each file), removing the least recently used entries until it is below max_bytes
+    """
+
+    def __init__(self, folder=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.file_digests = {}
+
+    def key(self, *parts):
+        """
+            Key of an entry: hash of the version of the cache and the given parts (strings, numbers, lists and dicts)
+        """
+        serialized = json.dumps([CACHE_VERSION, *parts], sort_keys=True, default=_json_default)
+        return hashlib.sha256(serialized.encode('utf-8')).hexdigest()
+
+    def file_key(self, path):
+        """
+            Digest of the contents of the file. It is computed once per (path, size, modification time)
+        """
+        stat = os.stat(path)
+        signature = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+        if signature not in self.file_digests:
+            self.file_digests[signature] = file_digest(path)
+        return self.file_digests[signature]
+
+    def path(self, key):
+        return join(self.folder, key[:2], f"{key}.npz")
+
+    def contains(self, key):
+        return os.path.exists(self.path(key))
+
+    def get(self, key):
+        """
+            Returns the dict of arrays stored with the key, or None if it is not cached. Reading an entry marks it as
+            recently used
+        """
+        path = self.path(key)
+        try:
+            with np.load(path, allow_pickle=False) as entry:
+                value = {name: entry[name] for name in entry.files}
+        except FileNotFoundError:
+            return None
+        except Exception:
+            # Corrupted or unreadable entry (e.g., interrupted write of an older version): it is recomputed
+            self.remove(key)
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return value
+
+    def put(self, key, value):
+        """
+            Stores the dict of arrays value with the key. Values that cannot be stored without pickling are skipped
+        """
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        arrays = {name: np.asarray(val) for name, val in value.items()}
+        if any(array.dtype.hasobject for array in arrays.values()):
+            return
+        fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(f, **arrays)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def remove(self, key):
+        try:
+            os.remove(self.path(key))
+        except OSError:
+            pass
+
+    def entries(self):
+        """
+            List of (modification time, size, path) of the stored entries
+        """
+        entries = []
+        if not isdir(self.folder):
+            return entries
+        for subdir in os.scandir(self.folder):
+            if not subdir.is_dir():
+                continue
+            for entry in os.scandir(subdir.path):
+                if entry.name.endswith('.npz'):
+                    try:
+                        stat = entry.stat()
+                    except OSError:  # Removed by another process
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return entries
+
+    def size(self):
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self):
+        """
+            Removes the least recently used entries until the size of the cache is below max_bytes. Returns the number
+            of removed entries
+        """
+        if self.max_bytes is None:
+            return 0
+        entries = sorted(self.entries())
+        total = sum(size for _, size, _ in entries)
+        removed = 0
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+            removed += 1
+        return removed
+
+    def clear(self):
+        """
+            Invalidates the whole cache
+        """
+        if isdir(self.folder):
+            shutil.rmtree(self.folder, ignore_errors=True)
+        self.file_digests = {}
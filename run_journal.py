@@ -0,0 +1,89 @@
+"""
+    Journal of a run, stored in the output folder. It records the completed units of work (preprocessed band
+    signals, segmentation units and whole files) as they are finished, so an interrupted run (crash, reboot or
+    cancellation) can be resumed skipping the units that are already stored.
+"""
+import hashlib
+import json
+import os
+from os.path import join, exists
+
+JOURNAL_NAME = "run_journal.jsonl"
+
+
+def settings_hash(settings_dic, outputs=None):
+    """
+        Hash of the settings (except the list of files) and the selected outputs of a run. A run can only be resumed
+        with the same settings
+    """
+    settings = {section: {k: v for k, v in values.items() if k != 'selected_files'} if isinstance(values, dict)
+                else values for section, values in settings_dic.items()}
+    serialized = json.dumps([settings, outputs], sort_keys=True, default=str)
+    return hashlib.sha256(serialized.encode('utf-8')).hexdigest()
+
+
+def has_journal(folder):
+    """
+        True if the folder contains the journal of a previous run
+    """
+    return exists(join(folder, JOURNAL_NAME))
+
+
+class RunJournal:
+    """
+        Append-only journal of the completed units of a run. Each line is a JSON record; the first one identifies the
+        settings of the run. Every record is written with a single append and flushed to disk, so several processes
+        can share the journal and an interrupted write only loses the last record. If resume is False, the journal of
+        a previous run is discarded
+    """
+
+    def __init__(self, output_folder, settings_dic, outputs=None, resume=False):
+        self.path = join(output_folder, JOURNAL_NAME)
+        self.settings = settings_hash(settings_dic, outputs)
+        self.completed = set()
+        if resume and exists(self.path):
+            self.load()
+        else:
+            os.makedirs(output_folder, exist_ok=True)
+            with open(self.path, "w") as f:
+                f.write(json.dumps({'settings': self.settings}) + "\n")
+
+    def load(self):
+        """
+            Reads the completed units of the previous run. Raises ValueError if it used other settings
+        """
+        with open(self.path, "r") as f:
+            lines = f.read().splitlines()
+        header = json.loads(lines[0]) if lines else {}
+        if header.get('settings') != self.settings:
+            raise ValueError(f"The run in {os.path.dirname(self.path)} cannot be resumed: it used other settings or "
+                             f"outputs. Select an empty folder to start a new run")
+        for line in lines[1:]:
+            try:
+                record = json.loads(line)
+            except ValueError:  # Last record of an interrupted write
+                continue
+            self.completed.add(self.key(record.get('stage'), record.get('file'), record.get('band'),
+                                        record.get('unit')))
+
+    @staticmethod
+    def key(stage, file, band=None, unit=None):
+        return stage, file, band, tuple(unit) if unit is not None else None
+
+    def is_done(self, stage, file, band=None, unit=None):
+        """
+            True if the unit was completed. Stage is 'file' (whole file), 'prep' (preprocessed signal of a band) or
+            'seg' (segmentation unit of a band: (condition,) or (condition, event))
+        """
+        return self.key(stage, file, band, unit) in self.completed
+
+    def mark_done(self, stage, file, band=None, unit=None):
+        """
+            Records a completed unit
+        """
+        self.completed.add(self.key(stage, file, band, unit))
+        record = {'stage': stage, 'file': file, 'band': band, 'unit': list(unit) if unit is not None else None}
+        with open(self.path, "a") as f:
+            f.write(json.dumps(record) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
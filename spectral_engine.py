@@ -0,0 +1,92 @@
+"""
+    Spectral utilities of the processing engine. The Welch PSD of a set of epochs is computed once per configuration
+    and shared by all the spectral parameters (PSD, relative and absolute power, median frequency and spectral
+    entropy). The parameters of several bands can be obtained from one broadband PSD with band_metrics.
+"""
+import numpy as np
+import medusa.transforms
+
+
+class SpectralCache:
+    """
+        Cache of the PSDs of one set of epochs. Each (segment_pct, overlap_pct, window) combination is computed only
+        once. It must be created for each set of epochs (e.g., in each call to compute_parameters)
+    """
+
+    def __init__(self, epoched, fs):
+        self.epoched = epoched
+        self.fs = fs
+        self.psds = {}
+
+    def psd(self, segment_pct=None, overlap_pct=None, window=None):
+        """
+            Returns (fxx, psd). If no configuration is given, the default settings of
+            medusa.transforms.power_spectral_density are used
+        """
+        key = (segment_pct, overlap_pct, window)
+        if key not in self.psds:
+            if key == (None, None, None):
+                self.psds[key] = medusa.transforms.power_spectral_density(self.epoched, self.fs)
+            else:
+                self.psds[key] = medusa.transforms.power_spectral_density(self.epoched, self.fs, segment_pct,
+                                                                           overlap_pct, window)
+        return self.psds[key]
+
+
+def band_metrics(psd, fs, bands, metrics=('band_power', 'median_frequency', 'spectral_entropy')):
+    """
+        Computes the band power, median frequency and/or Shannon spectral entropy of several bands from one PSD
+        [n_epochs x n_freqs x n_channels] in one vectorized pass. The frequency bins of each band are selected as in
+        medusa.signal_metrics (band power includes both edges; median frequency and spectral entropy exclude the
+        upper one).
+
+        Returns a dict {metric: [n_bands x n_epochs x n_channels]}, with the bands in the same order as "bands"
+        (list of [min, max] ranges in Hz).
+    """
+    psd = np.asarray(psd)
+    n_freqs = psd.shape[1]
+    freqs = np.linspace(0, fs / 2, n_freqs)
+    bands = np.asarray(bands, dtype=float).reshape(-1, 2)
+    first = np.searchsorted(freqs, bands[:, 0], side='left')
+    last_closed = np.searchsorted(freqs, bands[:, 1], side='right')
+    last_open = np.searchsorted(freqs, bands[:, 1], side='left')
+
+    # Cumulative sums along the frequency axis with a leading zero: the sum of the bins [i, j) is cum[j] - cum[i]
+    def cumulative(values):
+        cum = np.zeros((values.shape[0], n_freqs + 1, values.shape[2]))
+        np.cumsum(values, axis=1, out=cum[:, 1:, :])
+        return cum
+
+    results = {}
+    cum_psd = cumulative(psd)
+    if 'band_power' in metrics:
+        power = cum_psd[:, last_closed, :] - cum_psd[:, first, :]
+        results['band_power'] = np.moveaxis(power, 1, 0) * (fs / (2 * n_freqs))
+
+    total_power = cum_psd[:, last_open, :] - cum_psd[:, first, :]
+    if 'spectral_entropy' in metrics:
+        # SE = -sum(p / T * log(p / T)) / log(n) = (log(T) - sum(p * log(p)) / T) / log(n)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            plogp = np.abs(psd) * np.log(np.abs(psd))
+            # Bins where p * log(p) is not defined (e.g., a null PSD at 0 Hz) give NaN in their bands only, as in
+            # medusa, instead of spreading through the cumulative sum to the next bands
+            undefined = np.isnan(plogp)
+            cum_plogp = cumulative(np.where(undefined, 0, plogp))
+            cum_undefined = cumulative(undefined.astype(float))
+            plogp = cum_plogp[:, last_open, :] - cum_plogp[:, first, :]
+            n_bins = (last_open - first)[None, :, None]
+            se = (np.log(total_power) - plogp / total_power) / np.log(n_bins)
+            se[(cum_undefined[:, last_open, :] - cum_undefined[:, first, :]) > 0] = np.nan
+        results['spectral_entropy'] = np.moveaxis(se, 1, 0)
+
+    if 'median_frequency' in metrics:
+        # Last bin whose cumulative power (within the band) does not exceed half of the band power
+        median_freqs = []
+        for i0, i1 in zip(first, last_open):
+            cum_power = np.cumsum(psd[:, i0:i1, :], axis=1)
+            half_power = cum_power[:, -1:, :] / 2
+            n_below = np.sum(cum_power <= half_power, axis=1)
+            median_freqs.append(freqs[i0:i1][np.maximum(n_below - 1, 0)])
+        results['median_frequency'] = np.array(median_freqs)
+
+    return results
@@ -0,0 +1,34 @@
+"""
+    Shared fixtures of the tests. The modules of MEDUSA Analyzer are in the root folder of the repository
+"""
+import os
+import sys
+import numpy as np
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+EXAMPLE_FILES = [os.path.join(ROOT, "Example signals", "R3.rec.bson"),
+                 os.path.join(ROOT, "Example signals", "R4.rec.bson")]
+
+
+@pytest.fixture
+def epochs():
+    """
+        Random epochs [n_epochs x n_samples x n_channels] sampled at 250 Hz
+    """
+    return np.random.default_rng(0).standard_normal((6, 500, 4))
+
+
+@pytest.fixture
+def settings():
+    """
+        Minimal settings dictionary for compute_parameters (broadband, no parameters enabled)
+    """
+    return {
+        'preprocessing': {'fs': 250.0, 'band_segmentation': False, 'broadband_min': 1, 'broadband_max': 40},
+        'segmentation': {'average': False},
+        'parameters': {'psd_segment_pct': 40, 'psd_overlap_pct': 10, 'psd_window': 'hamming'},
+    }
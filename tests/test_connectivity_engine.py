@@ -0,0 +1,49 @@
+import numpy as np
+from scipy.signal import hilbert
+import connectivity_engine
+from connectivity_engine import ConnectivityEngine
+
+
+def pair_metrics(x, y):
+    """
+        PLV, PLI, wPLI and AEC of two series, computed directly from their definitions
+    """
+    phase_x, phase_y = np.angle(hilbert(x)), np.angle(hilbert(y))
+    imz = np.sin(phase_x - phase_y)
+    plv = np.abs(np.mean(np.exp(1j * (phase_x - phase_y))))
+    pli = np.abs(np.mean(np.sign(imz)))
+    wpli = np.abs(np.mean(imz)) / np.mean(np.abs(imz))
+    aec = np.corrcoef(np.log(np.abs(hilbert(x)) ** 2), np.log(np.abs(hilbert(y)) ** 2))[0, 1]
+    return plv, pli, wpli, aec
+
+
+def test_metrics_match_definitions(epochs):
+    engine = ConnectivityEngine(epochs)
+    results = engine.plv(), engine.pli(), engine.wpli(), engine.aec(ort=False)
+    for e_idx in range(epochs.shape[0]):
+        for i in range(epochs.shape[2]):
+            for j in range(epochs.shape[2]):
+                if i == j:
+                    continue
+                expected = pair_metrics(epochs[e_idx, :, i], epochs[e_idx, :, j])
+                assert np.allclose([result[e_idx, i, j] for result in results], expected)
+
+
+def test_orthogonalized_aec_matches_definition(epochs):
+    aec = ConnectivityEngine(epochs).aec(ort=True)
+    x, y = epochs[0, :, 0], epochs[0, :, 1]
+    # Leakage correction: each signal orthogonalized regarding the other one
+    y_ort = y - np.dot(y, x) / np.dot(x, x) * x
+    x_ort = x - np.dot(x, y) / np.dot(y, y) * y
+    half = [np.corrcoef(np.log(np.abs(hilbert(a)) ** 2), np.log(np.abs(hilbert(b)) ** 2))[0, 1]
+            for a, b in ((y_ort, x), (x_ort, y))]
+    assert np.isclose(aec[0, 0, 1], np.abs(sum(half)) / 2)
+    assert np.isclose(aec[0, 1, 0], aec[0, 0, 1])
+
+
+def test_analytic_signal_is_shared(monkeypatch, epochs):
+    calls = []
+    monkeypatch.setattr(connectivity_engine, 'hilbert', lambda x, axis: calls.append(1) or hilbert(x, axis=axis))
+    engine = ConnectivityEngine(epochs)
+    engine.plv(), engine.pli(), engine.wpli(), engine.aec(), engine.iac()
+    assert calls == [1]
@@ -0,0 +1,66 @@
+import os
+import shutil
+import numpy as np
+import pytest
+pytest.importorskip('medusa.signal_metrics')
+import core_process
+from conftest import EXAMPLE_FILES
+
+
+def test_duplicate_subjects_are_rejected(tmp_path):
+    files = []
+    for folder in ('a', 'b'):
+        os.makedirs(tmp_path / folder)
+        files.append(shutil.copy(EXAMPLE_FILES[0], tmp_path / folder))
+    assert list(core_process.duplicate_subjects(files + EXAMPLE_FILES[1:])) == ['R3.rec']
+
+    messages = []
+    settings = {'preprocessing': {'selected_files': files}}
+    engine = core_process.PipelineEngine(settings, str(tmp_path / 'out'),
+                                         log_callback=lambda msg, style=None: messages.append(style))
+    assert engine.run() is False
+    assert messages == ['error']
+    assert not os.path.exists(tmp_path / 'out')
+
+
+def test_chunked_signal_statistics():
+    signal = np.random.default_rng(0).standard_normal((10007, 3)) * [1, 5, 100] + [0, -2, 1e4]
+    signal[::7, 1] = np.nan
+    mean, std = core_process.signal_statistics(signal)
+    chunked_mean, chunked_std = core_process.signal_statistics(signal, 1000)
+    assert np.allclose(chunked_mean, mean) and np.allclose(chunked_std[[0, 2]], std[[0, 2]])
+    # As in np.std, NaNs propagate to the standard deviation
+    assert np.isnan(chunked_std[1]) and np.isnan(std[1])
+
+
+def test_cropped_bands_match_the_whole_signal():
+    signal = np.random.default_rng(1).standard_normal((20000, 2))
+    cfg = {'fs': 250.0, 'apply_preprocessing': True, 'bandpass': True, 'bp_order': 101, 'bp_win': 'hamming',
+           'notch': False, 'car': True, 'band_segmentation': True}
+    bands = [{'name': 'theta', 'min': 4, 'max': 8}, {'name': 'alpha', 'min': 8, 'max': 13}]
+    intervals = [(3000, 3500), (3400, 4000), (15000, 15010)]
+    margin, max_order = core_process.filter_margin(cfg)
+    crops = core_process.crop_intervals(intervals, len(signal), margin, 3 * max_order + 1)
+    # The overlapping intervals are merged and the short one is made long enough for the filter padding
+    assert len(crops) == 2 and crops[1][1] - crops[1][0] >= 3 * max_order + 1
+    full = core_process.band_signals(signal, 250.0, bands, cfg)
+    cropped = core_process.cropped_band_signals(signal, 250.0, bands, cfg, crops)
+    for expected, band_signal in zip(full, cropped):
+        for start, end in intervals:
+            assert np.allclose(band_signal[start:end], expected[start:end], atol=1e-10)
+        assert np.isnan(band_signal[:crops[0][0]]).all()
+
+
+def test_multirate_decimation_factor():
+    cfg = {'fs': 1000.0, 'apply_preprocessing': True, 'bandpass': True, 'bp_order': 1000, 'band_segmentation': True,
+           'multirate': True}
+    delta, beta = {'min': 1, 'max': 4}, {'min': 13, 'max': 30}
+    for band in (delta, beta):
+        factor = core_process.decimation_factor(1000.0, cfg, band)
+        new_fs = 1000.0 / factor
+        # Integer rate above the oversampling and the transition of the band-pass filter
+        assert 1000 % factor == 0 and new_fs >= 4 * band['max'] and new_fs / 2 >= band['max'] + 4 * 1000.0 / 1000
+    assert core_process.decimation_factor(1000.0, cfg, delta) > core_process.decimation_factor(1000.0, cfg, beta) > 1
+    # Not decimated without multirate or without band-pass filter
+    assert core_process.decimation_factor(1000.0, {**cfg, 'multirate': False}, delta) == 1
+    assert core_process.decimation_factor(1000.0, {**cfg, 'bandpass': False}, delta) == 1
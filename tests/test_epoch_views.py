@@ -0,0 +1,59 @@
+import numpy as np
+import pytest
+import medusa
+from epoch_views import EpochSegments, get_epochs_view, get_segments_epochs, materialize
+
+SEGMENTS = [(0, 700), (900, 1500), (2000, 2600)]
+
+
+@pytest.fixture
+def signal():
+    return np.random.default_rng(1).standard_normal((3000, 4))
+
+
+def test_epochs_view_is_medusa_epochs(signal):
+    view = get_epochs_view(signal, 200, 100)
+    assert np.shares_memory(view, signal)
+    assert not view.flags.writeable
+    np.testing.assert_array_equal(view, medusa.get_epochs(signal, 200, stride=100))
+
+
+def test_segments_are_views(signal):
+    epochs = get_segments_epochs(signal, SEGMENTS, 200, 100)
+    assert isinstance(epochs, EpochSegments)
+    assert len(epochs.segments) == len(SEGMENTS)
+    assert all(np.shares_memory(segment, signal) for segment in epochs)
+    expected = np.concatenate([medusa.get_epochs(signal[start:end], 200, stride=100) for start, end in SEGMENTS])
+    assert epochs.shape == expected.shape
+    np.testing.assert_array_equal(materialize(epochs), expected)
+    np.testing.assert_array_equal(epochs.first_epoch(), expected[0])
+
+
+def test_segments_map_drops_empty_segments(signal):
+    epochs = get_segments_epochs(signal, SEGMENTS, 200)
+    kept = epochs.map(lambda segment: segment[:1] if segment is epochs.segments[1] else segment[:0])
+    assert isinstance(kept, EpochSegments) and kept.shape == (1, 200, 4)
+    empty = epochs.map(lambda segment: segment[:0])
+    assert isinstance(empty, np.ndarray) and empty.shape == (0, 200, 4)
+
+
+def test_single_channel_segments_are_concatenated(signal):
+    # The squeeze of medusa.get_epochs removes the channel axis, so the epochs are a single array
+    epochs = get_segments_epochs(signal[:, :1], SEGMENTS, 200)
+    assert isinstance(epochs, np.ndarray) and epochs.shape == (9, 200)
+
+
+@pytest.mark.parametrize('average', [False, True])
+def test_segment_parameters_match_concatenated_epochs(signal, settings, average):
+    pytest.importorskip('medusa.signal_metrics')
+    from core_process import compute_parameters
+    settings['segmentation']['average'] = average
+    settings['parameters'].update({'mean': True, 'kurtosis': True, 'psd': True, 'absolute_power': True,
+                                   'sample_entropy': True, 'sample_entropy_m': 2, 'sample_entropy_r': 0.2,
+                                   'lzc': True, 'multiscale_lzc_scales': None, 'relative_power': average})
+    epochs = get_segments_epochs(signal, SEGMENTS, 200, 100)
+    segmented = compute_parameters(epochs, settings, 250.0, None)
+    expected = compute_parameters(epochs.array(), settings, 250.0, None)
+    assert segmented.keys() == expected.keys()
+    for key in expected:
+        np.testing.assert_allclose(segmented[key], expected[key], err_msg=key)
@@ -0,0 +1,29 @@
+import numpy as np
+import pytest
+from feature_table import FeatureTable, read_feature_table
+
+
+def test_rows_of_each_parameter(tmp_path):
+    pytest.importorskip('pandas')
+    settings = {'parameters': {'multiscale_lzc_scales': [2, 4]}}
+    table = FeatureTable(str(tmp_path), settings, lambda *args, **kwargs: None)
+    rng = np.random.default_rng(0)
+    params = {'mean': rng.random((3, 2)), 'plv': rng.random((3, 2, 2)), 'multiscale_lzc': rng.random((3, 2, 2)),
+              'psd_broadband': rng.random((3, 10, 2)), 'iac': rng.random((3, 2, 2, 5))}
+    table.add(params, {'subject': 'R3', 'band': 'alpha', 'condition': 'open'}, channels=['Fz', 'Cz'])
+    table.add({'mean': params['mean'].mean(axis=0)}, {'subject': 'R3', 'band': 'beta', 'condition': 'open'},
+              channels=['Fz', 'Cz'], averaged=True)
+    assert table.flush('R3') is not None and table.flush('R3') is None
+
+    rows = read_feature_table(str(tmp_path))
+    # Spectra and IAC are not included
+    assert sorted(set(rows['metric'])) == ['mean', 'multiscale_lzc_2', 'multiscale_lzc_4', 'plv']
+    assert len(rows) == 3 * 2 + 3 * 4 + 3 * 2 * 2 + 2
+    plv = rows[(rows['metric'] == 'plv') & (rows['epoch'] == 1) & (rows['channel'] == 'Fz')
+               & (rows['channel2'] == 'Cz')]
+    assert plv['value'].tolist() == [params['plv'][1, 0, 1]]
+    lzc = rows[(rows['metric'] == 'multiscale_lzc_4') & (rows['epoch'] == 2) & (rows['channel'] == 'Cz')]
+    assert lzc['value'].tolist() == [params['multiscale_lzc'][2, 1, 1]]
+    averaged = rows[rows['band'] == 'beta']
+    assert averaged['epoch'].tolist() == [-1, -1] and np.allclose(averaged['value'], params['mean'].mean(axis=0))
+    assert set(rows['event']) == {''}
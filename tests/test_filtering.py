@@ -0,0 +1,47 @@
+import numpy as np
+import pytest
+from scipy import signal as scipy_signal
+from filtering import filtfilt_fft, fir_filter, get_fir_filter, clear_filter_cache, filter_cache_info, \
+    use_fft_filtering, filter_bank
+
+
+@pytest.mark.parametrize('n_taps', [33, 201])
+def test_filtfilt_fft_matches_scipy(n_taps):
+    b = scipy_signal.firwin(n_taps, [4, 8], pass_zero=False, fs=250)
+    signal = np.random.default_rng(0).standard_normal((3000, 3))
+    expected = scipy_signal.filtfilt(b, 1, signal, axis=0)
+    assert np.allclose(filtfilt_fft(b, signal), expected, atol=1e-10)
+
+
+def test_fft_and_direct_methods_match():
+    signal = np.random.default_rng(1).standard_normal((4000, 2))
+    direct = fir_filter(signal, 250, 100, [1, 40], 'bandpass', method='direct')
+    fft = fir_filter(signal, 250, 100, [1, 40], 'bandpass', method='fft')
+    assert np.allclose(direct, fft, atol=1e-10)
+
+
+def test_filter_designs_are_cached():
+    clear_filter_cache()
+    first = get_fir_filter(100, [1, 40], 'bandpass', 'hamming', 250)
+    # Same key with other argument types (e.g., from the settings JSON)
+    assert get_fir_filter(100.0, (1.0, 40.0), 'bandpass', 'hamming', 250.0) is first
+    assert get_fir_filter(100, [1, 40], 'bandpass', 'hamming', 500) is not first
+    info = filter_cache_info()
+    assert (info.hits, info.misses) == (1, 2)
+
+
+def test_fft_method_selection():
+    # High-order kernels use the FFT, unless the signal is too short for the padding of filtfilt
+    assert use_fft_filtering(101, 10000)
+    assert not use_fft_filtering(11, 10000)
+    assert use_fft_filtering(11, 10000, 'fft')
+    assert not use_fft_filtering(101, 10000, 'direct')
+    assert not use_fft_filtering(101, 303, 'fft')
+
+
+def test_filter_bank_matches_fir_filter():
+    signal = np.random.default_rng(2).standard_normal((5000, 3))
+    cutoffs = [[1, 4], [4, 8], [8, 13], [13, 30]]
+    bank = filter_bank(signal, 250, cutoffs, 200)
+    for cutoff, filtered in zip(cutoffs, bank):
+        assert np.allclose(filtered, fir_filter(signal, 250, 200, cutoff, 'bandpass', method='direct'), atol=1e-10)
@@ -0,0 +1,41 @@
+import numpy as np
+import medusa
+from conftest import EXAMPLE_FILES
+from marks_index import MarksIndex
+
+
+def test_nearest_index_matches_exhaustive_search():
+    rng = np.random.default_rng(0)
+    uniform = np.arange(1000) / 250 + 12.5
+    irregular = np.sort(rng.uniform(0, 10, 500))
+    repeated = np.repeat(np.arange(100) / 10, 2)
+    for times in (uniform, irregular, repeated, rng.uniform(0, 10, 50)):
+        index = MarksIndex(times)
+        for t in np.concatenate((rng.uniform(times.min() - 1, times.max() + 1, 200), times[:20])):
+            assert index.nearest_index(t) == np.argmin(np.abs(times - t))
+
+
+def test_marks_lookups():
+    times = np.arange(0, 100, 0.5)
+    index = MarksIndex(times, conditions_labels=[1, 2, 1, 2, 3], conditions_times=[1.1, 10, 5.2, 20, 30],
+                       events_labels=[7, 8, 7, 7], events_times=[15.0, 2.0, 3.0, 50.0])
+    assert index.condition_samples(1) == [(2, 10)]
+    assert index.condition_samples(2) == [(20, 40)]
+    # Odd number of marks: the segments are not defined
+    assert index.condition_samples(3) is None
+    assert index.condition_samples(4) == []
+    assert list(index.event_positions(7)) == [0, 2, 3]
+    assert list(index.event_times(7, 2.5, 20)) == [15.0, 3.0]
+    assert list(index.nearest_times([0.2, 0.3, 99.9])) == [0.0, 0.5, 99.5]
+    assert index.decimated(2).nearest_index(1.6) == 2
+
+
+def test_recording_conditions_match_exhaustive_search():
+    recording = medusa.components.Recording.load(EXAMPLE_FILES[0])
+    index = MarksIndex.from_recording(recording)
+    times = recording.eeg.times
+    labels = np.asarray(recording.marks.conditions_labels)
+    for condition in recording.marks.app_settings['conditions'].values():
+        marks = np.asarray(recording.marks.conditions_times)[labels == condition['label']]
+        bounds = [int(np.argmin(np.abs(times - t))) for t in marks]
+        assert index.condition_samples(condition['label']) == list(zip(bounds[0::2], bounds[1::2]))
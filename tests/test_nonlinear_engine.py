@@ -0,0 +1,111 @@
+import numpy as np
+import pytest
+from nonlinear_engine import lempel_ziv, lempel_ziv_batch, multiscale_binarization, ComplexityCache, EntropyCache, \
+    fast_sample_entropy
+
+
+def reference_lempel_ziv(sequence):
+    """
+        Kaspar & Schuster algorithm, comparing symbol by symbol
+    """
+    n = len(sequence)
+    i, k, l, c, k_max = 0, 1, 1, 1, 1
+    while True:
+        if sequence[i + k - 1] == sequence[l + k - 1]:
+            k += 1
+            if l + k > n:
+                c += 1
+                break
+        else:
+            k_max = max(k, k_max)
+            i += 1
+            if i == l:
+                c += 1
+                l += k_max
+                if l + 1 > n:
+                    break
+                i, k, k_max = 0, 1, 1
+            else:
+                k = 1
+    return c * np.log2(n) / n
+
+
+def test_lempel_ziv_matches_reference():
+    rng = np.random.default_rng(0)
+    sequences = [rng.integers(0, 2, n).astype(np.uint8) for n in (2, 3, 10, 257, 1000)]
+    sequences += [np.zeros(64, np.uint8), np.tile([0, 1], 50).astype(np.uint8),
+                  (np.arange(300) % 7 < 3).astype(np.uint8)]
+    for sequence in sequences:
+        assert np.isclose(lempel_ziv(sequence.tobytes()), reference_lempel_ziv(sequence.tolist())), sequence
+
+
+def test_batch_and_single_scale():
+    epochs = np.random.default_rng(1).standard_normal((3, 200, 2))
+    binarized = (epochs >= 0).astype(np.uint8)
+    values = lempel_ziv_batch(binarized)
+    assert values.shape == (3, 2)
+    assert np.isclose(values[2, 1], reference_lempel_ziv(binarized[2, :, 1].tolist()))
+
+    # One scale: the series are not shortened by a second scale
+    multiscale = ComplexityCache(epochs).multiscale_lempel_ziv_complexity([5])
+    assert multiscale.shape == (3, 1, 2)
+    assert np.allclose(multiscale[:, 0], lempel_ziv_batch(multiscale_binarization(epochs, 5, 5)))
+
+
+class MapExecutor:
+    """
+        Executor that records the chunksize of map and runs it in this process
+    """
+
+    def __init__(self, max_workers):
+        self._max_workers = max_workers
+        self.chunksizes = []
+
+    def map(self, func, iterable, chunksize=1):
+        self.chunksizes.append(chunksize)
+        return map(func, iterable)
+
+
+def test_batch_chunks_follow_the_pool_size():
+    binarized = (np.random.default_rng(2).standard_normal((10, 100, 8)) >= 0).astype(np.uint8)
+    executor = MapExecutor(2)
+    values = lempel_ziv_batch(binarized, executor)
+    assert executor.chunksizes == [10]
+    lempel_ziv_batch(binarized, executor, n_workers=20)
+    assert executor.chunksizes == [10, 1]
+    assert np.array_equal(values, lempel_ziv_batch(binarized))
+
+
+def medusa_sample_entropy():
+    """
+        Sample entropy of medusa (signal_metrics or, in the released package, local_activation)
+    """
+    try:
+        from medusa.signal_metrics.sample_entropy import sample_entropy
+    except ImportError:
+        sample_entropy = pytest.importorskip('medusa.local_activation.nonlinear_parameters').sample_entropy
+    return sample_entropy
+
+
+@pytest.mark.parametrize('m, r', [(1, 0.25), (2, 0.2), (3, 0.5)])
+def test_fast_sample_entropy_matches_medusa(m, r):
+    epochs = np.random.default_rng(3).standard_normal((3, 150, 2))
+    # A regular epoch, with many matches
+    epochs[1, :, 0] = np.sin(np.arange(150) / 5)
+    assert np.allclose(fast_sample_entropy(epochs, m, r), medusa_sample_entropy()(epochs, m, r))
+
+
+def test_entropy_scales_are_shared(epochs):
+    cache = EntropyCache(epochs)
+    multiscale = cache.multiscale_entropy(3, 2, 0.2)
+    assert multiscale.shape == (epochs.shape[0], 3, epochs.shape[2])
+    # Scale 1 of the multiscale entropy is the sample entropy, which is not computed again
+    assert sorted(cache.entropies) == [(1, 2, 0.2), (2, 2, 0.2), (3, 2, 0.2)]
+    assert np.array_equal(multiscale[:, 0], cache.sample_entropy(2, 0.2))
+    assert len(cache.entropies) == 3 and sorted(cache.coarse) == [1, 2, 3]
+
+
+def test_reference_epoch_sets_the_tolerance(epochs):
+    # Entropy of a part of the epochs with the tolerance of the whole set
+    expected = fast_sample_entropy(epochs, 2, 0.2)[3:]
+    assert np.allclose(EntropyCache(epochs[3:], reference=epochs[0]).sample_entropy(2, 0.2), expected)
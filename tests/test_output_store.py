@@ -0,0 +1,109 @@
+import copy
+import threading
+import time
+import types
+import numpy as np
+import pytest
+import medusa
+from scipy.io import loadmat
+from conftest import EXAMPLE_FILES
+from output_store import payload_bytes, AsyncOutputWriter, open_output_store, read_parameters, HDF5_STORE_NAME
+
+
+def test_payload_of_overlapping_views():
+    signal = np.zeros((10000, 8))
+    # 9001 overlapping epochs of 1000 samples: the view reads the signal once
+    epochs = np.lib.stride_tricks.sliding_window_view(signal, 1000, axis=0)
+    assert payload_bytes(epochs) == signal.nbytes
+    assert payload_bytes({'epochs': epochs, 'mean': np.zeros(8)}) == signal.nbytes + 64
+    assert payload_bytes(signal[:, 0]) == signal[:, 0].nbytes
+
+
+class ListStore:
+    def __init__(self, fail=()):
+        self.saved = []
+        self.fail = fail
+
+    def save(self, key, data, location, base_name, suffix):
+        time.sleep(0.001)
+        if suffix in self.fail:
+            raise IOError("disk full")
+        self.saved.append(suffix)
+
+
+def test_async_writer_keeps_order_and_reports_errors():
+    store = ListStore(fail=('3',))
+    # A small buffer: save waits for the previous outputs (backpressure)
+    writer = AsyncOutputWriter(store, max_bytes=100)
+    for i in range(10):
+        writer.save('param', {'value': np.zeros(10)}, {}, 'subject', str(i))
+    errors = writer.flush()
+    assert store.saved == [str(i) for i in range(10) if i != 3]
+    assert len(errors) == 1 and 'param output of subject (3)' in errors[0]
+    assert writer.flush() == []
+    assert writer.close() == []
+    with pytest.raises(RuntimeError):
+        writer.save('param', {}, {}, 'subject', '10')
+
+
+class SignalStore:
+    def __init__(self):
+        self.signals = []
+        self.release = threading.Event()
+
+    def save(self, key, data, location, base_name, suffix):
+        self.release.wait(5)
+        self.signals.append(data.eeg.signal)
+
+
+def test_queued_recording_keeps_its_signal():
+    recording = types.SimpleNamespace(eeg=types.SimpleNamespace(signal=np.zeros((100, 2))))
+    store = SignalStore()
+    writer = AsyncOutputWriter(store)
+    for band in range(3):
+        # The pipeline replaces the signal of the recording with the signal of each band
+        recording.eeg.signal = np.full((100, 2), band)
+        writer.save('prep', recording, {}, 'subject', str(band))
+    store.release.set()
+    assert writer.close() == []
+    assert [signal[0, 0] for signal in store.signals] == [0, 1, 2]
+
+
+def test_hdf5_store_round_trip_and_merge(tmp_path):
+    pytest.importorskip('h5py')
+    location = {'subject': 'R3', 'band': 'alpha', 'condition': 'eyes/open'}
+    params = {'mean': np.arange(4.0), 'plv': np.random.default_rng(0).random((5, 4, 4))}
+    store = open_output_store('hdf5', str(tmp_path), lambda *args, **kwargs: None)
+    store.save('param', params, location, 'R3', 'alpha')
+    # A resumed run replaces the outputs
+    store.save('param', {'mean': np.ones(4)}, location, 'R3', 'alpha')
+
+    # The store of a worker process is merged into the main one
+    worker = open_output_store('hdf5', str(tmp_path), lambda *args, **kwargs: None, path=str(tmp_path / 'w.h5'))
+    worker.save('seg', np.zeros((2, 10, 4)), {**location, 'subject': 'R4'}, 'R4', 'alpha')
+    worker.save('param', params, {**location, 'subject': 'R4'}, 'R4', 'alpha')
+    worker.close()
+    store.merge(str(tmp_path / 'w.h5'))
+    store.close()
+
+    path = str(tmp_path / HDF5_STORE_NAME)
+    stored = read_parameters(path, 'R3', 'alpha', 'eyes/open')
+    assert np.array_equal(stored['mean'], np.ones(4)) and np.array_equal(stored['plv'], params['plv'])
+    assert np.array_equal(read_parameters(path, 'R4', 'alpha', 'eyes/open', names=['mean'])['mean'], params['mean'])
+    assert not (tmp_path / 'w.h5').exists()
+
+
+def test_preprocessed_mat_matches_save_to_mat(tmp_path):
+    recording = medusa.components.Recording.load(EXAMPLE_FILES[0])
+    signal = recording.eeg.signal
+    open_output_store('mat', str(tmp_path), lambda *args, **kwargs: None).save('prep', recording, {}, 'R3', 'alpha')
+    # The recording is not modified
+    assert recording.eeg.signal is signal and not isinstance(recording.marks, dict)
+
+    copy.deepcopy(recording).save_to_mat(str(tmp_path / 'expected.mat'))
+    stored = loadmat(str(tmp_path / 'Preprocessed_signals' / 'R3_preprocessing_alpha.mat'))
+    expected = loadmat(str(tmp_path / 'expected.mat'))
+    assert sorted(k for k in stored if not k.startswith('__')) == sorted(k for k in expected if not k.startswith('__'))
+    assert np.array_equal(stored['eeg']['signal'][0, 0], expected['eeg']['signal'][0, 0])
+    assert np.array_equal(stored['eeg']['times'][0, 0], expected['eeg']['times'][0, 0])
+    assert np.array_equal(stored['marks']['conditions_times'][0, 0], expected['marks']['conditions_times'][0, 0])
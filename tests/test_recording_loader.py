@@ -0,0 +1,77 @@
+import os
+import time
+import numpy as np
+import pytest
+import medusa
+from conftest import EXAMPLE_FILES
+from recording_loader import load_recording, load_sidecar, sidecar_key, evict_sidecars, clear_sidecars, \
+    sidecar_entries, RecordingPrefetcher
+
+
+def write_sidecar_files(folder, key, size, last_use):
+    paths = [os.path.join(folder, f"{key}.header.bson"), os.path.join(folder, f"{key}.eeg.signal.npy")]
+    for path in paths:
+        with open(path, 'wb') as f:
+            f.write(b'\0' * size)
+        os.utime(path, (last_use, last_use))
+
+
+def test_evict_least_recently_loaded(tmp_path):
+    folder = str(tmp_path)
+    for i, key in enumerate(['a_1', 'b_1', 'c_1']):
+        write_sidecar_files(folder, key, 100, i)
+    # The sidecar being created is kept, even if it is the oldest
+    assert evict_sidecars(folder, 250, keep=('a_1',)) == 2
+    assert sorted(os.listdir(folder)) == ['a_1.eeg.signal.npy', 'a_1.header.bson']
+    clear_sidecars(folder)
+    assert sidecar_entries(folder) == []
+
+
+def test_sidecar_matches_recording(tmp_path):
+    folder = str(tmp_path)
+    expected = medusa.components.Recording.load(EXAMPLE_FILES[0])
+    created = load_recording(EXAMPLE_FILES[0], folder)
+    prefix, key = sidecar_key(EXAMPLE_FILES[0])
+    assert os.path.exists(os.path.join(folder, f"{key}.header.bson"))
+    for recording in (created, load_sidecar(folder, key)):
+        assert recording.eeg.fs == expected.eeg.fs
+        assert recording.eeg.channel_set.l_cha == expected.eeg.channel_set.l_cha
+        assert np.array_equal(recording.eeg.signal, expected.eeg.signal)
+        assert np.array_equal(recording.eeg.times, expected.eeg.times)
+        assert np.array_equal(recording.marks.conditions_times, expected.marks.conditions_times)
+        assert np.array_equal(recording.marks.events_labels, expected.marks.events_labels)
+
+
+def test_sidecars_are_opt_in(tmp_path):
+    recording = load_recording(EXAMPLE_FILES[0])
+    assert not isinstance(recording.eeg.signal, np.memmap)
+    assert isinstance(load_recording(EXAMPLE_FILES[0], str(tmp_path)).eeg.signal, np.memmap)
+
+
+def test_prefetcher_order_budget_and_errors(tmp_path):
+    files = []
+    for i, size in enumerate([10, 10, 100, 10]):
+        path = tmp_path / f"{i}.bson"
+        path.write_bytes(b'\0' * size)
+        files.append(str(path))
+    loaded = []
+
+    def loader(file):
+        loaded.append(file)
+        if file == files[1]:
+            raise IOError("corrupt file")
+        return file.upper()
+
+    prefetcher = RecordingPrefetcher(files, depth=2, max_bytes=50, loader=loader)
+    time.sleep(0.2)
+    # Two recordings ahead at most, and the third one does not fit in the budget
+    assert loaded == files[:2]
+    assert prefetcher.get(files[0]) == files[0].upper()
+    with pytest.raises(IOError):
+        prefetcher.get(files[1])
+    # A recording larger than the budget is loaded when it is requested
+    assert prefetcher.get(files[2]) == files[2].upper()
+    # Out of order requests are loaded directly
+    assert prefetcher.get(files[0]) == files[0].upper()
+    prefetcher.close()
+    assert loaded.count(files[0]) == 2 and loaded.count(files[2]) == 1
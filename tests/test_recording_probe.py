@@ -0,0 +1,31 @@
+import io
+import bson
+import pytest
+import medusa
+from conftest import EXAMPLE_FILES
+from recording_probe import probe_recording, array_length
+
+
+def bson_array_length(values):
+    data = bson.dumps({'a': values})
+    # Document length, type and key of the array
+    return array_length(io.BytesIO(data), 4 + 1 + 2)
+
+
+@pytest.mark.parametrize('values', [
+    [], [1.5], [i * 0.1 for i in range(12345)], list(range(1000)), [True] * 11, [None] * 105, ['x'] * 30,
+    [1, 2.5, 'ab', None] * 40, [[1.0, 2.0]] * 200,
+    # The elements change of size (int32 and int64) after the first ones
+    list(range(3)) + [2 ** 40] * 200,
+])
+def test_array_length_is_exact(values):
+    assert bson_array_length(values) == len(values)
+
+
+def test_probe_matches_recording():
+    probe = probe_recording(EXAMPLE_FILES[0])
+    recording = medusa.components.Recording.load(EXAMPLE_FILES[0])
+    eeg = probe['biosignals']['eeg']
+    assert eeg['n_samples'] == recording.eeg.signal.shape[0]
+    assert eeg['fs'] == recording.eeg.fs
+    assert eeg['channels'] == recording.eeg.channel_set.l_cha
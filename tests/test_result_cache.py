@@ -0,0 +1,89 @@
+import copy
+import glob
+import os
+import numpy as np
+import pytest
+from result_cache import ResultCache
+
+
+def test_round_trip(tmp_path):
+    cache = ResultCache(str(tmp_path))
+    key = cache.key('param', 'file', {'m': 2})
+    assert cache.get(key) is None
+    cache.put(key, {'value': np.arange(6.0).reshape(2, 3), 'label': np.array('alpha')})
+    entry = cache.get(key)
+    assert np.array_equal(entry['value'], np.arange(6.0).reshape(2, 3))
+    assert entry['label'] == 'alpha'
+    # Other settings, other key
+    assert cache.key('param', 'file', {'m': 3}) != key
+
+
+def test_evict_least_recently_used(tmp_path):
+    cache = ResultCache(str(tmp_path))
+    keys = [cache.key(i) for i in range(3)]
+    for i, key in enumerate(keys):
+        cache.put(key, {'value': np.zeros(1000)})
+        os.utime(cache.path(key), (i, i))
+    cache.max_bytes = cache.size() - 1
+    assert cache.evict() == 1
+    assert not cache.contains(keys[0]) and cache.contains(keys[2])
+
+
+def test_partial_rerun_matches_uncached(tmp_path, epochs, settings):
+    """
+        Parameters added to a cached run must be computed with the same PSD settings as without the cache
+    """
+    pytest.importorskip('medusa.signal_metrics')
+    import core_process
+    cache = ResultCache(str(tmp_path))
+    first = copy.deepcopy(settings)
+    first['parameters']['psd'] = True
+    core_process.cached_parameters(epochs, first, 250.0, None, cache, 'epochs')
+
+    second = copy.deepcopy(first)
+    second['parameters'].update(absolute_power=True, relative_power=True)
+    cached = core_process.cached_parameters(epochs, second, 250.0, None, cache, 'epochs')
+    expected = core_process.compute_parameters(epochs, second, 250.0, None)
+    assert sorted(cached) == sorted(expected)
+    for name in expected:
+        assert np.allclose(cached[name], expected[name], equal_nan=True), name
+
+    # All the parameters are cached now: they are returned without the epochs
+    only_cached = core_process.cached_parameters(None, second, 250.0, None, cache, 'epochs')
+    assert all(np.allclose(only_cached[name], expected[name], equal_nan=True) for name in expected)
+
+
+def test_units_store_parameters_not_epochs(tmp_path, epochs, settings):
+    """
+        The cache only keeps the parameters of a segmentation unit: the epochs are not recomputed when the segmented
+        signals are not stored and all the parameters are cached
+    """
+    pytest.importorskip('medusa.signal_metrics')
+    import core_process
+    cache = ResultCache(str(tmp_path))
+    settings['parameters']['absolute_power'] = True
+    engine = core_process.PipelineEngine(settings, str(tmp_path), output_callback=lambda key: key != 'seg',
+                                         n_workers=1, cache=cache)
+    calls = []
+
+    def make_epochs():
+        calls.append(1)
+        return epochs
+
+    epoched, params = engine.unit_results('band', ('cond',), make_epochs, 250.0, None)
+    assert epoched is epochs and calls == [1]
+    assert all('epochs' not in cache.get(key) for key in cache_keys(cache))
+    assert engine.unit_cached('band', ('cond',))
+
+    epoched, cached = engine.unit_results('band', ('cond',), make_epochs, 250.0, None)
+    assert epoched is None and calls == [1]
+    assert all(np.array_equal(cached[name], params[name]) for name in params)
+
+    # Units without epochs are not segmented again either
+    assert engine.unit_results('band', ('empty',), lambda: None, 250.0, None) == (None, None)
+    assert engine.unit_results('band', ('empty',), make_epochs, 250.0, None) == (None, None)
+    assert calls == [1]
+
+
+def cache_keys(cache):
+    return [os.path.basename(path)[:-len('.npz')] for path in glob.glob(os.path.join(cache.folder, '*', '*.npz'))]
@@ -0,0 +1,39 @@
+import pytest
+from run_journal import RunJournal, has_journal, JOURNAL_NAME
+
+
+def test_resume_skips_completed_units(tmp_path, settings):
+    folder = str(tmp_path)
+    journal = RunJournal(folder, settings, {'prep': True})
+    journal.mark_done('prep', 'a.rec.bson', 'alpha')
+    journal.mark_done('seg', 'a.rec.bson', 'alpha', ('eyes-open', 'blink'))
+    journal.mark_done('file', 'a.rec.bson')
+    assert has_journal(folder)
+
+    resumed = RunJournal(folder, settings, {'prep': True}, resume=True)
+    assert resumed.is_done('prep', 'a.rec.bson', 'alpha')
+    assert resumed.is_done('seg', 'a.rec.bson', 'alpha', ['eyes-open', 'blink'])
+    assert resumed.is_done('file', 'a.rec.bson')
+    assert not resumed.is_done('prep', 'a.rec.bson', 'theta')
+    assert not resumed.is_done('file', 'b.rec.bson')
+
+    # A new run (resume False) discards the previous journal
+    assert not RunJournal(folder, settings, {'prep': True}).is_done('file', 'a.rec.bson')
+
+
+def test_interrupted_record_is_ignored(tmp_path, settings):
+    folder = str(tmp_path)
+    RunJournal(folder, settings).mark_done('file', 'a.rec.bson')
+    with open(tmp_path / JOURNAL_NAME, 'a') as f:
+        f.write('{"stage": "file", "file": "b.r')
+    resumed = RunJournal(folder, settings, resume=True)
+    assert resumed.is_done('file', 'a.rec.bson') and not resumed.is_done('file', 'b.rec.bson')
+
+
+def test_other_settings_cannot_resume(tmp_path, settings):
+    RunJournal(str(tmp_path), settings, {'prep': True})
+    with pytest.raises(ValueError):
+        RunJournal(str(tmp_path), settings, {'prep': False}, resume=True)
+    # The list of files is not part of the settings of the run
+    settings['preprocessing']['selected_files'] = ['c.rec.bson']
+    RunJournal(str(tmp_path), settings, {'prep': True}, resume=True)
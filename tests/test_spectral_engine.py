@@ -0,0 +1,46 @@
+import numpy as np
+import pytest
+import medusa.transforms
+from spectral_engine import SpectralCache, band_metrics
+
+
+def test_psd_is_computed_once_per_configuration(monkeypatch, epochs):
+    calls = []
+    psd = medusa.transforms.power_spectral_density
+
+    def counted_psd(*args, **kwargs):
+        calls.append(args[2:])
+        return psd(*args, **kwargs)
+
+    monkeypatch.setattr(medusa.transforms, 'power_spectral_density', counted_psd)
+    cache = SpectralCache(epochs, 250.0)
+    first = cache.psd(40, 10, 'hamming')
+    assert cache.psd(40, 10, 'hamming') is first
+    cache.psd(50, 10, 'hamming')
+    assert calls == [(40, 10, 'hamming'), (50, 10, 'hamming')]
+    fxx, values = first
+    assert values.shape[0] == epochs.shape[0] and values.shape[1] == len(fxx)
+
+
+def test_relative_power_uses_the_shared_psd(epochs, settings):
+    pytest.importorskip('medusa.signal_metrics')
+    from core_process import compute_parameters
+    settings['parameters'].update(psd=True, relative_power=True)
+    params = compute_parameters(epochs, settings, 250.0, None)
+    fxx, psd = SpectralCache(epochs, 250.0).psd(40, 10, 'hamming')
+    assert np.array_equal(params['psd_broadband'], psd)
+    assert np.array_equal(params['psd_freq_broadband'], fxx)
+
+
+def test_band_metrics_match_medusa(epochs):
+    pytest.importorskip('medusa.signal_metrics')
+    from medusa.signal_metrics import band_power, median_frequency, shannon_spectral_entropy
+    _, psd = SpectralCache(epochs, 250.0).psd()
+    # Some epochs have a null PSD at 0 Hz: their spectral entropy is NaN in the first band only
+    bands = [[0, 4], [1, 4], [4, 8], [8, 13], [13, 30]]
+    results = band_metrics(psd, 250.0, bands)
+    for i, band in enumerate(bands):
+        assert np.allclose(results['band_power'][i], band_power.band_power(psd, 250.0, band))
+        assert np.allclose(results['median_frequency'][i], median_frequency.median_frequency(psd, 250.0, band))
+        assert np.allclose(results['spectral_entropy'][i],
+                           shannon_spectral_entropy.shannon_spectral_entropy(psd, 250.0, band), equal_nan=True)